@@ -0,0 +1,240 @@
+"""
+Micro benchmarks for the hot paths of the Sparkplug client.
+
+Run all benchmarks with `python benchmarks.py`, or a single one with `python benchmarks.py <name>`.
+"""
+import contextlib
+import io
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import Sequence
+
+import sparkplug_client as spc
+from wire_encoder import WireEncoder
+
+def synthetic_birth_certificate(n_devices: int, n_metrics: int) -> spc.BirthCertificate:
+    """
+    Creates a birth certificate with n_devices devices of n_metrics float metrics each, with properties similar
+    to those of solar_bess.json.
+    """
+    def metric(i):
+        return {
+            "datatype": "float",
+            "value": 0,
+            "properties": {
+                "EngUnit": {"value": "V" if i % 2 else "A", "datatype": "string"},
+                "ReadOnly": {"value": True, "datatype": "bool"},
+            },
+        }
+    node_metrics = {f'node/metric_{i}': metric(i) for i in range(n_metrics)}
+    devices = {f'device_{d}': {"metrics": {f'group_{i % 10}/metric_{i}': metric(i) for i in range(n_metrics)}} for d in range(n_devices)}
+    return spc.BirthCertificate(node_metrics, devices)
+
+def _max_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_state_construction(n_devices: int = 100, n_metrics: int = 1_000):
+    birth_certificate = synthetic_birth_certificate(n_devices, n_metrics)
+    rss_before = _max_rss_kb()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        state = spc.State(birth_certificate)
+    elapsed = time.perf_counter() - start
+    rss_after = _max_rss_kb()
+    total = n_metrics*(n_devices + 1)
+    print(f'State construction, {total} metrics: {elapsed:.3f} s, {1e6*elapsed/total:.2f} us/metric, '
+          f'peak RSS +{(rss_after - rss_before)/1024:.1f} MiB')
+    return state
+
+def bench_handles(n_writes: int = 200_000):
+    from columnar_state import ColumnarState
+    birth_certificate = spc.BirthCertificate.from_file(Path(__file__).parent / 'solar_bess.json')
+    names = list(birth_certificate.devices['bess']['metrics'])
+    for state_class in (spc.State, ColumnarState):
+        state = state_class(birth_certificate)
+        handles = [state.handle('bess', name) for name in names]
+        n = n_writes//len(names)
+
+        start = time.perf_counter()
+        for i in range(n):
+            for name in names:
+                state.set_device_metric('bess', name, i)
+        by_name = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(n):
+            for handle in handles:
+                handle.set(i)
+        by_handle = time.perf_counter() - start
+
+        writes = n*len(names)
+        print(f'{state_class.__name__} writes: set_device_metric {1e9*by_name/writes:.0f} ns/write, '
+              f'handle.set {1e9*by_handle/writes:.0f} ns/write ({by_name/by_handle:.1f}x)')
+
+def bench_payload_encoding(sizes: Sequence[int] = (10, 100, 1_000), n_messages: int = 20_000):
+    names = [f'group_{i % 10}/metric_{i}' for i in range(max(sizes))]
+    schemas = [spc.MetricSchema(name, spc.sparkplug.MetricDataType.Float) for name in names]
+    for size in sizes:
+        changes = [spc.MetricChangeEvent(name, spc.Metric(schema, 1.5)) for name, schema in zip(names[:size], schemas)]
+        n = max(1, n_messages//size)
+
+        start = time.perf_counter()
+        for i in range(n):
+            payload = spc.sparkplug.getDdataPayload()
+            payload.seq = i % 256
+            for change in changes:
+                spc.sparkplug.addMetric(payload, change.metric_name, None, change.datatype_sp, change.new_value)
+            payload.SerializeToString()
+        fresh = time.perf_counter() - start
+
+        template = spc.PayloadTemplate()
+        timestamp = int(round(time.time() * 1000))
+        start = time.perf_counter()
+        for i in range(n):
+            template.fill(changes, i % 256, timestamp).SerializeToString()
+        reused = time.perf_counter() - start
+
+        print(f'DDATA encode, {size} changes: addMetric {1e6*fresh/n:.1f} us/message, '
+              f'PayloadTemplate {1e6*reused/n:.1f} us/message ({fresh/reused:.1f}x)')
+
+def bench_wire_encoder(sizes: Sequence[int] = (10, 100, 1_000), n_metrics: int = 20_000):
+    birth_certificate = synthetic_birth_certificate(1, max(sizes))
+    with contextlib.redirect_stdout(io.StringIO()):
+        state = spc.State(birth_certificate)
+    metrics = state.devices['device_0'].metrics
+    encoder = WireEncoder(state)
+    timestamp = int(round(time.time() * 1000))
+    for size in sizes:
+        changes = [spc.MetricChangeEvent(name, metric) for name, metric in list(metrics.items())[:size]]
+        for change, value in zip(changes, range(size)):
+            change.new_value = value*1.5
+        n = max(1, n_metrics//size)
+        template = spc.PayloadTemplate()
+
+        start = time.perf_counter()
+        for i in range(n):
+            template.fill(changes, i % 256, timestamp).SerializeToString()
+        protobuf = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(n):
+            encoder.encode('device_0', changes, i % 256, timestamp)
+        wire = time.perf_counter() - start
+
+        print(f'DDATA encode, {size} changes: protobuf {size*n/protobuf/1e6:.2f} M metrics/s, '
+              f'WireEncoder {size*n/wire/1e6:.2f} M metrics/s ({protobuf/wire:.1f}x)')
+
+def bench_alias_bytes():
+    birth_certificate = spc.BirthCertificate.from_file(Path(__file__).parent / 'solar_bess.json')
+    state = spc.State(birth_certificate)
+    timestamp = int(round(time.time() * 1000))
+    owners = [(None, state.node_metrics)] + [(device_name, device.metrics) for device_name, device in state.devices.items()]
+    for device_name, metrics in owners:
+        changes = [spc.MetricChangeEvent(metric_name, metric) for metric_name, metric in metrics.items()]
+        # Metrics of Template instances are named "<device>/<metric>" when sent by name, as in Client._encode_changes
+        prefix = state.metric_prefix(device_name)
+        by_name = len(spc.PayloadTemplate(use_aliases=False, prefix=prefix).fill(changes, 0, timestamp).SerializeToString())
+        by_alias = len(spc.PayloadTemplate(use_aliases=True, prefix=prefix).fill(changes, 0, timestamp).SerializeToString())
+        print(f'{"NDATA" if device_name is None else "DDATA " + device_name}, all {len(changes)} metrics changed: '
+              f'{by_name} bytes with names, {by_alias} bytes with aliases ({100*(by_name - by_alias)/by_name:.0f}% smaller)')
+
+def bench_birth(n_metrics: int = 2_000, n_properties: int = 20, n_births: int = 20):
+    metrics = {
+        f'group_{i % 10}/metric_{i}': {
+            "datatype": "float",
+            "value": 0,
+            "properties": {f'Property{p}': {"value": f'value {p} of {i % 50}', "datatype": "string"} for p in range(n_properties)},
+        } for i in range(n_metrics)
+    }
+    client = spc.Client('bench')
+    client.set_birth_certificate(spc.BirthCertificate({}, {'device': {'metrics': metrics}}))
+    client.set_id('group', 'node')
+    timestamp = int(round(time.time() * 1000))
+
+    start = time.perf_counter()
+    for i in range(n_births):
+        # Every metric and property built from scratch, as before birth templates were cached
+        payload = spc.sparkplug_b_pb2.Payload()
+        payload.timestamp = timestamp
+        payload.seq = i % 256
+        for metric, value in client.state.birth_snapshot('device'):
+            sp_metric = spc.sparkplug.addMetric(payload, metric.name, metric.alias, metric.datatype_sp, value, timestamp)
+            sp_metric.properties.keys.extend([prop.name for prop in metric.properties])
+            for prop in metric.properties:
+                sp_prop = sp_metric.properties.values.add()
+                sp_prop.type = prop.datatype_sp
+                spc.CODECS[prop.datatype_sp].set_value(sp_prop, prop.value)
+        payload.SerializeToString()
+    scratch = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client._birth_payload('device', 0, timestamp)
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(n_births):
+        client._birth_payload('device', i % 256, timestamp).SerializeToString()
+    cached = time.perf_counter() - start
+
+    print(f'DBIRTH, {n_metrics} metrics with {n_properties} properties: from scratch {1e3*scratch/n_births:.1f} ms, '
+          f'first (template built) {1e3*first:.1f} ms, cached template {1e3*cached/n_births:.1f} ms ({scratch/cached:.1f}x)')
+
+def bench_compression(n_metrics: int = 2_000):
+    from compression import CompressionPolicy, GZIP, DEFLATE
+    birth_certificate = spc.BirthCertificate.from_file(Path(__file__).parent / 'solar_bess.json')
+    metrics = birth_certificate.devices['bess']['metrics']
+    device = {f'{i}/{name}': metric for i in range(n_metrics//len(metrics) + 1) for name, metric in metrics.items()}
+    client = spc.Client('bench')
+    client.set_birth_certificate(spc.BirthCertificate({}, {'device': {'metrics': device}}))
+    payload_bytes = client._birth_payload('device', 0, int(round(time.time() * 1000))).SerializeToString()
+    for algorithm in (GZIP, DEFLATE):
+        for level in (1, 6, 9):
+            policy = CompressionPolicy(algorithm, level=level)
+            policy.compress('DBIRTH', payload_bytes)
+            print(f'DBIRTH of {len(device)} metrics, {algorithm} level {level}: {len(payload_bytes)/1024:.0f} KiB, '
+                  f'ratio {policy.ratio:.1f}, {1e3*policy.cpu_seconds:.1f} ms CPU')
+
+def bench_dataset(rows: int = 500, n_messages: int = 200):
+    from dataset import DataSetLayout
+    columns = (('string', spc.sparkplug.DataSetDataType.UInt16), ('current', spc.sparkplug.DataSetDataType.Float),
+               ('voltage', spc.sparkplug.DataSetDataType.Float), ('ok', spc.sparkplug.DataSetDataType.Boolean))
+    layout = DataSetLayout.get(columns)
+    table = layout.dataset({'string': range(rows), 'current': [i*0.01 for i in range(rows)], 'voltage': [600.0]*rows, 'ok': [True]*rows})
+    values = [column.tolist() for column in table.columns]
+
+    start = time.perf_counter()
+    for _ in range(n_messages):
+        # One element per cell set through the protobuf API
+        message = spc.sparkplug_b_pb2.Payload.DataSet(num_of_columns=len(columns), columns=layout.names, types=layout.types)
+        for i in range(rows):
+            row = message.rows.add()
+            for datatype, column in zip(layout.types, values):
+                spc.sparkplug.PARAMETER_CODECS[datatype].set_value(row.elements.add(), column[i])
+        message.SerializeToString()
+    per_cell = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n_messages):
+        table.encode()
+    vectorized = time.perf_counter() - start
+
+    print(f'DataSet of {rows} rows x {len(columns)} columns: per cell {1e3*per_cell/n_messages:.2f} ms, '
+          f'vectorized {1e3*vectorized/n_messages:.2f} ms ({per_cell/vectorized:.1f}x)')
+
+BENCHMARKS = {
+    'state_construction': bench_state_construction,
+    'handles': bench_handles,
+    'payload_encoding': bench_payload_encoding,
+    'alias_bytes': bench_alias_bytes,
+    'wire_encoder': bench_wire_encoder,
+    'birth': bench_birth,
+    'compression': bench_compression,
+    'dataset': bench_dataset,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
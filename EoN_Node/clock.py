@@ -0,0 +1,41 @@
+import time
+
+class Clock():
+    """
+    The time source of a client and its state. `now_ms()` is the wall clock time stamped on payloads and metrics,
+    sampled once per publish cycle, and `monotonic()` is the time used for intervals such as max_silence.
+    """
+
+    def now_ms(self) -> int:
+        """
+        Returns the current time in milliseconds since the epoch.
+        """
+        return int(round(time.time() * 1000))
+
+    def monotonic(self) -> float:
+        """
+        Returns the current time in seconds from a clock that never goes backwards.
+        """
+        return time.monotonic()
+
+class ManualClock(Clock):
+    """
+    A `Clock` that only moves when told to, for tests.
+    """
+
+    def __init__(self, now_ms: int = 0, monotonic: float = 0.0):
+        self._now_ms = now_ms
+        self._monotonic = monotonic
+
+    def now_ms(self) -> int:
+        return self._now_ms
+
+    def monotonic(self) -> float:
+        return self._monotonic
+
+    def advance(self, seconds: float):
+        """
+        Moves both the wall clock and the monotonic clock forward.
+        """
+        self._now_ms += int(round(seconds * 1000))
+        self._monotonic += seconds
@@ -0,0 +1,369 @@
+import numpy as np
+import threading
+import sparkplug_b as sparkplug
+from clock import Clock
+from sparkplug_client import BirthCertificate, State, Metric, MetricSchema, MetricChangeEvent, DeviceChangeEvent, sparkplug_type_from_str
+from typing import List, Sequence, Tuple
+
+NUMPY_DTYPE_FROM_SPARKPLUG_TYPE = {
+    sparkplug.MetricDataType.Boolean: np.bool_,
+    sparkplug.MetricDataType.String: np.object_,
+    sparkplug.MetricDataType.Float: np.float32,
+    sparkplug.MetricDataType.Double: np.float64,
+    sparkplug.MetricDataType.Int8: np.int8,
+    sparkplug.MetricDataType.UInt8: np.uint8,
+    sparkplug.MetricDataType.Int16: np.int16,
+    sparkplug.MetricDataType.UInt16: np.uint16,
+    sparkplug.MetricDataType.Int32: np.int32,
+    sparkplug.MetricDataType.UInt32: np.uint32,
+    sparkplug.MetricDataType.Int64: np.int64,
+    sparkplug.MetricDataType.UInt64: np.uint64,
+    sparkplug.MetricDataType.DateTime: np.int64,
+    sparkplug.MetricDataType.Text: np.object_,
+    sparkplug.MetricDataType.UUID: np.object_,
+}
+
+# Values of these types are converted when written, e.g. datetime objects to milliseconds since the epoch
+CONVERTED_SPARKPLUG_TYPES = {sparkplug.MetricDataType.DateTime, sparkplug.MetricDataType.UUID}
+
+class Column():
+    """
+    Contiguous storage for every metric of one Sparkplug data type, with the last published values kept in a
+    parallel array.
+    """
+
+    def __init__(self, datatype_sp: int, size: int):
+        self.datatype_sp = datatype_sp
+        self.values = np.zeros(size, dtype=NUMPY_DTYPE_FROM_SPARKPLUG_TYPE[datatype_sp])
+        if self.values.dtype == np.object_:
+            self.values[:] = ""
+        self.published = self.values.copy()
+        self.convert = sparkplug.CODECS[datatype_sp].encode if datatype_sp in CONVERTED_SPARKPLUG_TYPES else None
+        # Integers out of the range of the column wrap to its width, as they do on the wire
+        self.wrap = sparkplug.CODECS[datatype_sp].wire if self.values.dtype.kind in 'iu' and self.convert is None else None
+        # Report by exception settings per slot, see Metric.should_publish()
+        self.deadband = np.zeros(size)
+        self.deadband_percent = np.zeros(size)
+        self.max_silence = np.full(size, np.inf)
+        self.last_published = np.zeros(size)
+        self.has_deadband = False
+        self.min_interval = np.zeros(size)
+        self.has_min_interval = False
+        # Scan class of each slot, as 1 + its position in State.scan_periods, or 0 for metrics without a scan class
+        self.scan_index = np.zeros(size, dtype=np.intp)
+        # owners[slot] is the device name of the metric in that slot, or None for node metrics
+        self.owners = [None]*size
+        self.names = [None]*size
+        self.metrics = [None]*size
+        self.size = 0
+
+    def get(self, slot: int):
+        value = self.values[slot]
+        return value if self.values.dtype == np.object_ else value.item()
+
+    def set(self, slot: int, value):
+        if self.convert is not None:
+            value = self.convert(value)
+        try:
+            self.values[slot] = value
+        except OverflowError:
+            if self.wrap is None:
+                raise
+            self.values[slot] = self.wrap(value)
+
+    def set_report_by_exception(self, slot: int, metric: Metric):
+        schema = metric.schema
+        self.deadband[slot] = schema.deadband
+        self.deadband_percent[slot] = schema.deadband_percent
+        if schema.max_silence is not None:
+            self.max_silence[slot] = schema.max_silence
+        self.last_published[slot] = metric.last_published
+        self.has_deadband = self.has_deadband or bool(schema.deadband or schema.deadband_percent)
+        self.min_interval[slot] = schema.min_interval
+        self.has_min_interval = self.has_min_interval or bool(schema.min_interval)
+
+    def changed_slots(self, now: float, due: np.ndarray = None, flush: bool = False) -> Tuple[np.ndarray, int, float]:
+        """
+        Returns the slots whose value should be published and marks them as published, along with the number of
+        changed slots that were suppressed by their deadband and the time at which the earliest change held back by
+        its minimum publish interval may be published, or None.
+
+        Args:
+        now (float): The current clock.monotonic() time, used for the maximum silence interval.
+        due (np.ndarray): Whether each scan class is due, indexed like `scan_index`. Slots of other scan classes
+            are left unpublished. None if every slot is due.
+        flush (bool): Publish changed slots within their minimum publish interval.
+        """
+        changed = self.values != self.published
+        if self.values.dtype.kind == 'f':
+            # NaN never compares equal to itself, but a NaN that stays NaN is not a change
+            changed &= ~(np.isnan(self.values) & np.isnan(self.published))
+        if due is not None:
+            changed &= due[self.scan_index]
+        slots = np.flatnonzero(changed)
+
+        suppressed = 0
+        if self.has_deadband and len(slots):
+            values = self.values[slots].astype(np.float64)
+            published = self.published[slots].astype(np.float64)
+            band = np.maximum(self.deadband[slots], np.abs(published)*self.deadband_percent[slots]/100)
+            publish = (np.abs(values - published) > band) | (now - self.last_published[slots] >= self.max_silence[slots])
+            suppressed = len(slots) - int(np.count_nonzero(publish))
+            slots = slots[publish]
+
+        pending_due = None
+        if self.has_min_interval and not flush and len(slots):
+            # Held back slots keep their last published value, so the latest value is published when the interval
+            # expires
+            next_allowed = self.last_published[slots] + self.min_interval[slots]
+            held_back = next_allowed > now
+            if held_back.any():
+                pending_due = float(next_allowed[held_back].min())
+                slots = slots[~held_back]
+
+        self.published[slots] = self.values[slots]
+        self.last_published[slots] = now
+        return slots, suppressed, pending_due
+
+class ColumnMetric(Metric):
+    """
+    A `Metric` whose value lives in a slot of a `Column` rather than on the object itself.
+    """
+    __slots__ = ('_column', '_slot')
+
+    def __init__(self, schema: MetricSchema, value, column: Column, slot: int, last_published: float = 0.0):
+        self._column = column
+        self._slot = slot
+        super().__init__(schema, value, last_published)
+
+    @property
+    def value(self):
+        return self._column.get(self._slot)
+
+    @value.setter
+    def value(self, value):
+        self._column.set(self._slot, value)
+
+class ColumnHandle():
+    """
+    A `MetricHandle` for a `ColumnarState` metric, reading and writing its column slot directly.
+    """
+    __slots__ = ('_column', '_values', '_slot', '_lock')
+
+    def __init__(self, column: Column, slot: int, lock: threading.RLock):
+        self._column = column
+        self._values = column.values
+        self._slot = slot
+        self._lock = lock
+
+    def set(self, value):
+        with self._lock:
+            if self._column.convert is None:
+                try:
+                    self._values[self._slot] = value
+                    return
+                except OverflowError:
+                    pass
+            self._column.set(self._slot, value)
+
+    def get(self):
+        return self._column.get(self._slot)
+
+    def __repr__(self):
+        return f"ColumnHandle({self._column.metrics[self._slot]})"
+
+class ColumnIndex():
+    """
+    A set of metrics of the same data type resolved to their slots in a column, for bulk array reads and writes.
+    """
+
+    def __init__(self, column: Column, slots: np.ndarray):
+        self.column = column
+        self.slots = slots
+
+class ColumnarState(State):
+    """
+    A `State` that keeps the values of each data type in a contiguous NumPy array. Change detection is a single
+    vectorized comparison per data type against a parallel array of last published values, and whole vectors of
+    values can be read and written at once with `get_array`/`set_array`.
+    """
+
+    def __init__(self, birth_certificate: BirthCertificate, clock: Clock = None, timestamp_writes: bool = False):
+        """
+        Creates a new instance of the `ColumnarState` class, allocating one column per data type in the birth
+        certificate.
+
+        Args:
+        birth_certificate (BirthCertificate): An instance of the `BirthCertificate` class.
+        clock (Clock): The time source for max_silence intervals.
+        timestamp_writes (bool): Not supported, columns hold values only.
+
+        Raises:
+        ValueError: If timestamp_writes is True.
+        """
+        if timestamp_writes:
+            raise ValueError("timestamp_writes is not supported by ColumnarState")
+        sizes = {}
+        all_metrics = list(birth_certificate.node_metrics.values())
+        for device in birth_certificate.devices.values():
+            all_metrics.extend(device['metrics'].values())
+        for metric in all_metrics:
+            datatype_sp = sparkplug_type_from_str(metric['datatype'])
+            if datatype_sp in NUMPY_DTYPE_FROM_SPARKPLUG_TYPE:
+                sizes[datatype_sp] = sizes.get(datatype_sp, 0) + 1
+        self.columns = {datatype_sp: Column(datatype_sp, size) for datatype_sp, size in sizes.items()}
+        self._indexes = {}
+
+        super().__init__(birth_certificate, clock)
+
+        # Values from the birth certificate are published in the birth messages
+        for column in self.columns.values():
+            column.published[:] = column.values
+
+    def _create_metric(self, device_name: str, metric_name: str, metric: dict) -> Metric:
+        schema = self._schema(device_name, metric_name, metric)
+        if schema.max_samples:
+            # Columns hold one value per metric, use State for metrics that buffer samples
+            raise ValueError(f"max_samples of metric {metric_name} is not supported by ColumnarState")
+        if schema.datatype_sp not in self.columns:
+            raise ValueError(f"Metric {metric_name} of type {schema.datatype_str} is not supported by ColumnarState")
+        column = self.columns[schema.datatype_sp]
+        slot = column.size
+        column.size += 1
+        column.owners[slot] = device_name
+        column.names[slot] = metric_name
+        column.metrics[slot] = ColumnMetric(schema, metric.get('value', None), column, slot, self._created)
+        column.set_report_by_exception(slot, column.metrics[slot])
+        if schema.scan_class is not None:
+            column.scan_index[slot] = 1 + list(self.scan_periods).index(schema.scan_class)
+        return column.metrics[slot]
+
+    def set_node_metric(self, metric_name: str, value):
+        if metric_name not in self.node_metrics:
+            raise ValueError(f"Metric {metric_name} not found in node metrics")
+        with self._lock:
+            self.node_metrics[metric_name].value = value
+
+    def set_device_metric(self, device_name: str, metric_name: str, value):
+        if device_name not in self.devices:
+            raise ValueError(f"Device {device_name} not found in devices")
+        if metric_name not in self.devices[device_name].metrics:
+            raise ValueError(f"Metric {metric_name} not found in device {device_name} metrics")
+        with self._lock:
+            self.devices[device_name].metrics[metric_name].value = value
+
+    def _mark_published(self, metrics: dict[str, Metric], dirty: dict, held: dict, now: float):
+        for metric in metrics.values():
+            column = metric._column
+            column.published[metric._slot] = column.values[metric._slot]
+            column.last_published[metric._slot] = now
+
+    def _write_batch(self, metrics: dict[str, Metric], values: dict, dirty: dict, held: dict):
+        # Change detection compares the columns directly, so there is nothing to track
+        for metric_name, value in values.items():
+            metrics[metric_name].value = value
+
+    def _pending(self, metrics: dict[str, Metric], metric_names: List[str], dirty: dict, held: dict) -> List[str]:
+        pending = []
+        for metric_name in metric_names:
+            column, slot = metrics[metric_name]._column, metrics[metric_name]._slot
+            if column.values[slot] != column.published[slot]:
+                pending.append(metric_name)
+        return pending
+
+    def get_changes(self, flush: bool = False) -> Tuple[List[MetricChangeEvent], List[DeviceChangeEvent]]:
+        """
+        Compares every column to its last published values with one vectorized comparison per data type and
+        returns the changes. Deadbands are applied to the changed slots of each column in the same vectorized way,
+        and slots whose scan class is not due or that were published less than their min_interval ago are held
+        back.
+
+        Args:
+        flush (bool): Return every pending change, regardless of scan classes and minimum publish intervals.
+
+        Returns:
+        A tuple containing the changes to the node metrics and device metrics respectively.
+        """
+        now = self.clock.monotonic()
+        changes = {None: []}
+        changes.update((device_name, []) for device_name in self.devices)
+        with self._lock:
+            due = None
+            if self.scan_periods and not flush:
+                due_classes = self._due_scan_classes(now)
+                due = np.array([True] + [scan_class in due_classes for scan_class in self.scan_periods])
+            self._pending_due = None
+            for column in self.columns.values():
+                slots, suppressed, pending_due = column.changed_slots(now, due, flush)
+                if pending_due is not None and (self._pending_due is None or pending_due < self._pending_due):
+                    self._pending_due = pending_due
+                self.suppressed_samples += suppressed
+                self.published_samples += len(slots)
+                for slot in slots.tolist():
+                    changes[column.owners[slot]].append(MetricChangeEvent(column.names[slot], column.metrics[slot]))
+
+        node_changes = changes.pop(None)
+        device_changes = [DeviceChangeEvent(device_name, metric_changes) for device_name, metric_changes in changes.items() if metric_changes]
+        return node_changes, device_changes
+
+    def _metric(self, device_name: str, metric_name: str) -> ColumnMetric:
+        if device_name is None:
+            metrics = self.node_metrics
+        elif device_name in self.devices:
+            metrics = self.devices[device_name].metrics
+        else:
+            raise ValueError(f"Device {device_name} not found in devices")
+        if metric_name not in metrics:
+            raise ValueError(f"Metric {metric_name} not found in {device_name or 'node'} metrics")
+        return metrics[metric_name]
+
+    def handle(self, device_name: str, metric_name: str) -> ColumnHandle:
+        metric = self._metric(device_name, metric_name)
+        return ColumnHandle(metric._column, metric._slot, self._lock)
+
+    def index(self, device_name: str, metric_names: Sequence[str]) -> ColumnIndex:
+        """
+        Resolves metrics of one device to their column slots so that they can be read and written as an array.
+        Pass device_name=None for node metrics. Indexes are cached, so resolving the same names again is cheap.
+
+        Args:
+        device_name (str): The name of the device, or None for node metrics.
+        metric_names (Sequence[str]): The names of the metrics, all of which must have the same data type.
+
+        Returns:
+        ColumnIndex: The column and slots of the metrics, in the order given.
+
+        Raises:
+        ValueError: If a metric is not found or the metrics do not share a data type.
+        """
+        key = (device_name, tuple(metric_names))
+        if key in self._indexes:
+            return self._indexes[key]
+
+        resolved = [self._metric(device_name, metric_name) for metric_name in metric_names]
+        columns = {id(metric._column): metric._column for metric in resolved}
+        if len(columns) != 1:
+            raise ValueError(f"Metrics {list(metric_names)} must all have the same datatype to be indexed together")
+
+        index = ColumnIndex(next(iter(columns.values())), np.array([metric._slot for metric in resolved], dtype=np.intp))
+        self._indexes[key] = index
+        return index
+
+    def set_array(self, index: ColumnIndex, values):
+        """
+        Writes a vector of values to the metrics of an index in one operation.
+        """
+        with self._lock:
+            index.column.values[index.slots] = values
+
+    def get_array(self, index: ColumnIndex) -> np.ndarray:
+        """
+        Returns a copy of the current values of the metrics of an index.
+        """
+        return index.column.values[index.slots]
+
+    def set_device_array(self, device_name: str, metric_names: Sequence[str], values):
+        self.set_array(self.index(device_name, metric_names), values)
+
+    def get_device_array(self, device_name: str, metric_names: Sequence[str]) -> np.ndarray:
+        return self.get_array(self.index(device_name, metric_names))
@@ -0,0 +1,128 @@
+import gzip
+import time
+import zlib
+import sparkplug_b as sparkplug
+import sparkplug_b_pb2
+from typing import Iterable
+
+# Sparkplug B convention for compressed payloads: the outer payload has this uuid, the compressed inner payload in
+# its body and a String metric named "algorithm" holding the compression algorithm
+COMPRESSED_UUID = "SPBV1.0_COMPRESSED"
+ALGORITHM_METRIC = "algorithm"
+GZIP = "GZIP"
+DEFLATE = "DEFLATE"
+
+MESSAGE_TYPES = ("NBIRTH", "DBIRTH", "NDATA", "DDATA")
+
+def compress_bytes(algorithm: str, data: bytes, level: int = 6) -> bytes:
+    if algorithm == GZIP:
+        # mtime=0 keeps the output deterministic
+        return gzip.compress(data, level, mtime=0)
+    if algorithm == DEFLATE:
+        return zlib.compress(data, level)
+    raise ValueError(f"Invalid compression algorithm: {algorithm}")
+
+def decompress_bytes(algorithm: str, data: bytes) -> bytes:
+    if algorithm == GZIP:
+        return gzip.decompress(data)
+    if algorithm == DEFLATE:
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Raw deflate stream without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    raise ValueError(f"Invalid compression algorithm: {algorithm}")
+
+def decompress_payload(payload: sparkplug_b_pb2.Payload) -> sparkplug_b_pb2.Payload:
+    """
+    Returns the inner payload of a compressed payload, or the payload itself if it is not compressed. A compressed
+    payload without an algorithm metric is DEFLATE compressed.
+
+    Raises:
+    ValueError: If the algorithm is not supported.
+    """
+    if payload.uuid != COMPRESSED_UUID:
+        return payload
+    algorithm = DEFLATE
+    for metric in payload.metrics:
+        if metric.name == ALGORITHM_METRIC:
+            algorithm = metric.string_value.upper()
+    inner = sparkplug_b_pb2.Payload()
+    inner.ParseFromString(decompress_bytes(algorithm, payload.body))
+    return inner
+
+class CompressionPolicy():
+    """
+    Decides which outbound payloads are compressed and keeps counters of the compression ratio and CPU cost.
+
+    A payload is compressed when its message type is in `message_types` and its encoded size is at least
+    `threshold` bytes. If compressing does not make the message smaller, the payload is sent uncompressed.
+    """
+
+    def __init__(self, algorithm: str = GZIP, threshold: int = 1024, message_types: Iterable[str] = MESSAGE_TYPES, level: int = 6):
+        """
+        Args:
+        algorithm (str): GZIP or DEFLATE.
+        threshold (int): The minimum size in bytes of an encoded payload to compress.
+        message_types (Iterable[str]): The message types to compress, from NBIRTH, DBIRTH, NDATA and DDATA.
+        level (int): The compression level, from 1 (fastest) to 9 (smallest).
+
+        Raises:
+        ValueError: If the algorithm or a message type is not supported.
+        """
+        algorithm = algorithm.upper()
+        if algorithm not in (GZIP, DEFLATE):
+            raise ValueError(f"Invalid compression algorithm: {algorithm}")
+        self.message_types = frozenset(message_types)
+        for message_type in self.message_types:
+            if message_type not in MESSAGE_TYPES:
+                raise ValueError(f"Invalid message type for compression: {message_type}")
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.level = level
+
+        # Counters
+        self.compressed_messages = 0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_seconds = 0.0
+
+    @property
+    def ratio(self) -> float:
+        """
+        The uncompressed size over the compressed size of every payload compressed so far.
+        """
+        return self.uncompressed_bytes/self.compressed_bytes if self.compressed_bytes else 1.0
+
+    def compress(self, message_type: str, payload_bytes: bytes, seq: int = None, timestamp: int = None) -> bytes:
+        """
+        Returns the encoded payload to publish for a message: a compressed payload wrapping `payload_bytes` if the
+        policy applies to it, or `payload_bytes` unchanged.
+
+        Args:
+        message_type (str): NBIRTH, DBIRTH, NDATA or DDATA.
+        payload_bytes (bytes): The encoded payload.
+        seq (int): The sequence number of the payload, repeated on the compressed payload.
+        timestamp (int): The timestamp of the payload, repeated on the compressed payload.
+        """
+        if message_type not in self.message_types or len(payload_bytes) < self.threshold:
+            return payload_bytes
+
+        start = time.thread_time()
+        outer = sparkplug_b_pb2.Payload()
+        if timestamp is not None:
+            outer.timestamp = timestamp
+        if seq is not None:
+            outer.seq = seq
+        outer.uuid = COMPRESSED_UUID
+        outer.body = compress_bytes(self.algorithm, payload_bytes, self.level)
+        sparkplug.addMetric(outer, ALGORITHM_METRIC, None, sparkplug.MetricDataType.String, self.algorithm, timestamp or 0)
+        compressed = outer.SerializeToString()
+        self.cpu_seconds += time.thread_time() - start
+
+        if len(compressed) >= len(payload_bytes):
+            return payload_bytes
+        self.compressed_messages += 1
+        self.uncompressed_bytes += len(payload_bytes)
+        self.compressed_bytes += len(compressed)
+        return compressed
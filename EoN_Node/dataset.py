@@ -0,0 +1,266 @@
+import numpy as np
+import sparkplug_b as sparkplug
+import sparkplug_b_pb2
+from sparkplug_client import Metric, MetricSchema
+from wire_encoder import (DATASET_COLUMNS_TAG, DATASET_NUM_OF_COLUMNS_TAG, DATASET_ROWS_TAG, DATASET_TYPES_TAG,
+                          DATASET_VALUE_TAGS, ROW_ELEMENTS_TAG, encode_varint)
+from typing import List, Sequence, Tuple
+
+NUMPY_DTYPE_FROM_DATASET_TYPE = {
+    sparkplug.DataSetDataType.Int8: np.int8,
+    sparkplug.DataSetDataType.Int16: np.int16,
+    sparkplug.DataSetDataType.Int32: np.int32,
+    sparkplug.DataSetDataType.Int64: np.int64,
+    sparkplug.DataSetDataType.UInt8: np.uint8,
+    sparkplug.DataSetDataType.UInt16: np.uint16,
+    sparkplug.DataSetDataType.UInt32: np.uint32,
+    sparkplug.DataSetDataType.UInt64: np.uint64,
+    sparkplug.DataSetDataType.Float: np.float32,
+    sparkplug.DataSetDataType.Double: np.float64,
+    sparkplug.DataSetDataType.Boolean: np.bool_,
+    sparkplug.DataSetDataType.String: np.object_,
+    sparkplug.DataSetDataType.DateTime: np.int64,
+    sparkplug.DataSetDataType.Text: np.object_,
+}
+
+_SIGNED_BITS = {
+    sparkplug.DataSetDataType.Int8: 8,
+    sparkplug.DataSetDataType.Int16: 16,
+    sparkplug.DataSetDataType.Int32: 32,
+}
+
+######################################################################
+# Vectorized protobuf encoding
+#
+# Every part of a row is a (matrix, lengths) pair: row i of the part is
+# the first lengths[i] bytes of row i of the uint8 matrix. Joining the
+# parts of every row is then a single boolean mask over the matrices.
+######################################################################
+_VARINT_SHIFTS = np.arange(10, dtype=np.uint64)*np.uint64(7)
+_VARINT_LIMITS = np.array([1 << (7*k) for k in range(1, 10)], dtype=np.uint64)
+
+def _varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    values = np.asarray(values).astype(np.uint64)
+    lengths = 1 + np.count_nonzero(values[:, None] >= _VARINT_LIMITS, axis=1)
+    width = int(lengths.max()) if len(values) else 1
+    groups = (values[:, None] >> _VARINT_SHIFTS[:width]) & np.uint64(0x7f)
+    more = np.arange(width) < (lengths[:, None] - 1)
+    return (groups | (more.astype(np.uint64) << np.uint64(7))).astype(np.uint8), lengths
+
+def _constant(data: bytes, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    return np.tile(np.frombuffer(data, dtype=np.uint8), (n, 1)), np.full(n, len(data))
+
+def _fixed(values: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    matrix = values.astype(dtype).view(np.uint8).reshape(len(values), -1)
+    return matrix, np.full(len(values), matrix.shape[1])
+
+def _strings(values: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+    data = [value.encode('utf-8') for value in values.tolist()]
+    lengths = np.array([len(item) for item in data], dtype=np.intp)
+    matrix = np.array(data, dtype=bytes)
+    matrix = matrix.view(np.uint8).reshape(len(data), matrix.dtype.itemsize)
+    return [_varints(lengths), (matrix, lengths)]
+
+def _join(parts: Sequence[Tuple[np.ndarray, np.ndarray]]) -> bytes:
+    matrix = np.hstack([part for part, _ in parts])
+    mask = np.hstack([np.arange(part.shape[1]) < lengths[:, None] for part, lengths in parts])
+    return matrix[mask].tobytes()
+
+class DataSetLayout():
+    """
+    The columns of a DataSet metric: their names, Sparkplug types and NumPy dtypes. Identical layouts are shared
+    between metrics, see `DataSetLayout.get`.
+    """
+    __slots__ = ('names', 'types', 'dtypes', 'header', '_index')
+
+    _cache = {}
+
+    def __init__(self, columns: Tuple[Tuple[str, int], ...]):
+        self.names = tuple(name for name, _ in columns)
+        self.types = tuple(datatype for _, datatype in columns)
+        self.dtypes = tuple(NUMPY_DTYPE_FROM_DATASET_TYPE[datatype] for datatype in self.types)
+        self._index = {name: i for i, name in enumerate(self.names)}
+        # Everything before the rows in an encoded DataSet message
+        header = [DATASET_NUM_OF_COLUMNS_TAG, encode_varint(len(columns))]
+        for name in self.names:
+            data = name.encode('utf-8')
+            header += [DATASET_COLUMNS_TAG, encode_varint(len(data)), data]
+        for datatype in self.types:
+            header += [DATASET_TYPES_TAG, encode_varint(datatype)]
+        self.header = b''.join(header)
+
+    @classmethod
+    def get(cls, columns: Tuple[Tuple[str, int], ...]) -> 'DataSetLayout':
+        """
+        Returns the shared layout of the given (column name, DataSetDataType) pairs, creating it on first use.
+        """
+        layout = cls._cache.get(columns)
+        if layout is None:
+            layout = cls._cache[columns] = cls(columns)
+        return layout
+
+    def empty(self, rows: int = 0) -> 'DataSet':
+        """
+        Returns a DataSet of this layout with every value set to the default of its column type.
+        """
+        columns = []
+        for datatype, dtype in zip(self.types, self.dtypes):
+            column = np.zeros(rows, dtype=dtype)
+            if dtype == np.object_:
+                column[:] = sparkplug.CODECS[datatype].default
+            columns.append(column)
+        return DataSet(self, columns)
+
+    def dataset(self, value, current: 'DataSet' = None) -> 'DataSet':
+        """
+        Converts a value written to a DataSet metric to a DataSet of this layout. The value can be a DataSet, a
+        protobuf DataSet or a mapping of column names to sequences of values. Columns missing from a mapping keep
+        their values from `current`.
+
+        Raises:
+        ValueError: If a column is not in the layout, is missing, or the columns have different numbers of rows.
+        """
+        if isinstance(value, DataSet):
+            if value.layout is self:
+                return value
+            value = value.to_dict()
+        elif isinstance(value, sparkplug_b_pb2.Payload.DataSet):
+            value = self._from_message(value)
+
+        for name in value:
+            if name not in self._index:
+                raise ValueError(f"Column {name} not found in DataSet columns {list(self.names)}")
+        columns = []
+        for i, (name, dtype) in enumerate(zip(self.names, self.dtypes)):
+            if name in value:
+                columns.append(np.array(value[name], dtype=dtype))
+            elif current is not None:
+                columns.append(current.columns[i])
+            else:
+                raise ValueError(f"Missing values for DataSet column {name}")
+        return DataSet(self, columns)
+
+    def _from_message(self, message: sparkplug_b_pb2.Payload.DataSet) -> dict:
+        values = {}
+        for j, name in enumerate(message.columns):
+            if name in self._index:
+                codec = sparkplug.PARAMETER_CODECS[self.types[self._index[name]]]
+                values[name] = [codec.get_value(row.elements[j]) for row in message.rows]
+        return values
+
+class DataSet():
+    """
+    An immutable table of typed columns held as NumPy arrays, the value of a DataSet metric. Writing to a DataSet
+    metric replaces its DataSet, so a DataSet can be kept as the last published value and compared row by row with
+    `changed_rows()`.
+    """
+    __slots__ = ('layout', 'columns')
+
+    def __init__(self, layout: DataSetLayout, columns: Sequence[np.ndarray]):
+        rows = {len(column) for column in columns}
+        if len(rows) > 1:
+            raise ValueError(f"DataSet columns {list(layout.names)} have different numbers of rows")
+        self.layout = layout
+        self.columns = tuple(columns)
+        for column in self.columns:
+            column.flags.writeable = False
+
+    @property
+    def rows(self) -> int:
+        return len(self.columns[0]) if self.columns else 0
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Returns the values of a column as a read-only array.
+        """
+        return self.columns[self.layout.names.index(name)]
+
+    def to_dict(self) -> dict:
+        return dict(zip(self.layout.names, self.columns))
+
+    def changed_rows(self, other) -> np.ndarray:
+        """
+        Returns the indexes of the rows that differ from another DataSet, with one vectorized comparison per
+        column. Every row is changed if the other DataSet has a different layout or number of rows.
+        """
+        if other is self:
+            return np.empty(0, dtype=np.intp)
+        if not isinstance(other, DataSet) or other.layout is not self.layout or other.rows != self.rows:
+            return np.arange(self.rows)
+        changed = np.zeros(self.rows, dtype=bool)
+        for column, other_column in zip(self.columns, other.columns):
+            different = column != other_column
+            if column.dtype.kind == 'f':
+                # NaN never compares equal to itself, but a NaN that stays NaN is not a change
+                different &= ~(np.isnan(column) & np.isnan(other_column))
+            changed |= different
+        return np.flatnonzero(changed)
+
+    def encode(self) -> bytes:
+        """
+        Encodes the DataSet as a protobuf DataSet message, building every row of all columns at once with NumPy.
+        The output is byte for byte what `to_message().SerializeToString()` produces.
+        """
+        n = self.rows
+        if n == 0:
+            return self.layout.header
+        element_tag = _constant(ROW_ELEMENTS_TAG, n)
+        parts = []
+        row_lengths = np.zeros(n, dtype=np.intp)
+        for datatype, column in zip(self.layout.types, self.columns):
+            value_tag = _constant(DATASET_VALUE_TAGS[datatype], n)
+            if datatype in (sparkplug.DataSetDataType.String, sparkplug.DataSetDataType.Text):
+                value = _strings(column)
+            elif datatype == sparkplug.DataSetDataType.Float:
+                value = [_fixed(column, '<f4')]
+            elif datatype == sparkplug.DataSetDataType.Double:
+                value = [_fixed(column, '<f8')]
+            elif datatype == sparkplug.DataSetDataType.Boolean:
+                value = [_fixed(column, np.uint8)]
+            elif datatype in _SIGNED_BITS:
+                # Two's complement in the unsigned int_value field
+                value = [_varints(column.astype(np.int64).astype(np.uint64) & np.uint64((1 << _SIGNED_BITS[datatype]) - 1))]
+            else:
+                value = [_varints(column.view(np.uint64) if column.dtype.itemsize == 8 else column)]
+            element_lengths = value_tag[1] + sum(lengths for _, lengths in value)
+            element_length = _varints(element_lengths)
+            parts += [element_tag, element_length, value_tag, *value]
+            row_lengths += element_tag[1] + element_length[1] + element_lengths
+        return self.layout.header + _join([_constant(DATASET_ROWS_TAG, n), _varints(row_lengths), *parts])
+
+    def to_message(self) -> sparkplug_b_pb2.Payload.DataSet:
+        message = sparkplug_b_pb2.Payload.DataSet()
+        message.ParseFromString(self.encode())
+        return message
+
+    def __eq__(self, other):
+        return isinstance(other, DataSet) and other.layout is self.layout and other.rows == self.rows and len(self.changed_rows(other)) == 0
+
+    def __ne__(self, other: object) -> bool:
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return f"DataSet({self.rows} rows, columns={list(self.layout.names)})"
+
+class DataSetMetric(Metric):
+    """
+    A `Metric` whose value is a `DataSet`. Values written to it are converted with `DataSetLayout.dataset()`, and
+    it is published when any row differs from the last published DataSet.
+    """
+    __slots__ = ('_value', 'layout')
+
+    def __init__(self, schema: MetricSchema, value=None, last_published: float = 0.0, rows: int = 0):
+        self.layout = DataSetLayout.get(schema.columns)
+        self._value = self.layout.empty(rows)
+        super().__init__(schema, self._value if value is None else value, last_published)
+
+    @property
+    def value(self) -> DataSet:
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = self.layout.dataset(value, self._value)
+
+    def should_publish(self, published_value, now: float) -> bool:
+        return len(self._value.changed_rows(published_value)) > 0
@@ -0,0 +1,145 @@
+import mmap
+import os
+import sparkplug_b as sparkplug
+import sparkplug_b_pb2
+from wire_encoder import (METRIC_ALIAS_TAG, METRIC_BYTES_VALUE_TAG, METRIC_DATATYPE_TAG, METRIC_METADATA_TAG,
+                          METRIC_NAME_TAG, METRIC_PROPERTIES_TAG, METRIC_TIMESTAMP_TAG, PAYLOAD_METRIC_TAG,
+                          PAYLOAD_SEQ_TAG, PAYLOAD_TIMESTAMP_TAG, encode_varint)
+from typing import Tuple
+
+# Property of every chunk metric holding the position of the chunk in the file
+OFFSET_PROPERTY = "offset"
+
+_OFFSET_PROPERTY_NAME = OFFSET_PROPERTY.encode('utf-8')
+
+class FileTransfer():
+    """
+    A file published as ordered chunks of a File or Bytes metric, one chunk per NDATA/DDATA message. The file is
+    memory mapped and every chunk is a memoryview of the mapping, so a transfer only holds one encoded chunk in
+    memory at a time whatever the size of the file.
+
+    Each chunk metric carries multi-part metadata (the file name, the total size and the chunk number in `seq`)
+    and an "offset" UInt64 property with the position of its first byte. An interrupted transfer is resumed by
+    starting a new one at the `offset` the previous one reached.
+    """
+
+    def __init__(self, path: str, device_name: str, metric_name: str, alias: int = None, datatype_sp: int = sparkplug.MetricDataType.File, chunk_size: int = 64*1024, offset: int = 0, content_type: str = None):
+        """
+        Args:
+        path (str): The path of the file to send.
+        device_name (str): The device of the metric, or None for a node metric.
+        metric_name (str): The name of the File or Bytes metric to publish the chunks as.
+        alias (int): The alias of the metric. The chunks are identified by name if None.
+        datatype_sp (int): MetricDataType.File or MetricDataType.Bytes.
+        chunk_size (int): The number of bytes of the file in each chunk.
+        offset (int): The position in the file to start from, a multiple of chunk_size.
+        content_type (str): The MIME type of the file, if known.
+
+        Raises:
+        ValueError: If the chunk size or offset is invalid.
+        """
+        if chunk_size < 1:
+            raise ValueError(f"Invalid chunk size: {chunk_size}")
+        if offset % chunk_size:
+            raise ValueError(f"Offset {offset} is not a multiple of the chunk size {chunk_size}")
+        self.path = path
+        self.device_name = device_name
+        self.metric_name = metric_name
+        self.chunk_size = chunk_size
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        if offset > self.size:
+            self._file.close()
+            raise ValueError(f"Offset {offset} is beyond the end of {path} ({self.size} bytes)")
+        # Zero length files cannot be mapped, they are sent as a single empty chunk
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b'')
+        # Position of the next chunk to send
+        self.offset = offset
+        self.chunks_sent = 0
+        self._sent_empty = False
+
+        # Everything in a chunk metric besides the timestamp, chunk number, offset and data, encoded once
+        if alias is not None:
+            self._key = METRIC_ALIAS_TAG + encode_varint(alias)
+        else:
+            name = metric_name.encode('utf-8')
+            self._key = METRIC_NAME_TAG + encode_varint(len(name)) + name
+        self._datatype = METRIC_DATATYPE_TAG + encode_varint(datatype_sp)
+        metadata = sparkplug_b_pb2.Payload.MetaData(is_multi_part=True, size=self.size, file_name=os.path.basename(path))
+        if content_type is not None:
+            metadata.content_type = content_type
+        self._metadata = metadata
+
+    @property
+    def done(self) -> bool:
+        return self.offset >= self.size and (self.size > 0 or self._sent_empty)
+
+    @property
+    def progress(self) -> float:
+        """
+        The fraction of the file sent so far, from 0 to 1.
+        """
+        return self.offset/self.size if self.size else float(self.done)
+
+    def next_chunk(self) -> Tuple[int, memoryview]:
+        """
+        Returns the offset and data of the next chunk and moves past it.
+        """
+        offset = self.offset
+        chunk = self._view[offset:offset + self.chunk_size]
+        self.offset = offset + len(chunk)
+        self._sent_empty = True
+        self.chunks_sent += 1
+        return offset, chunk
+
+    def encode_chunk(self, seq: int, timestamp: int) -> bytes:
+        """
+        Encodes the next chunk as an NDATA/DDATA payload with a single metric. The chunk is copied once, into the
+        encoded payload.
+
+        Args:
+        seq (int): The sequence number of the message.
+        timestamp (int): The timestamp of the payload and the metric, in milliseconds since the epoch.
+        """
+        offset, chunk = self.next_chunk()
+        timestamp_varint = encode_varint(timestamp)
+        head = self._encode_head(offset, len(chunk), timestamp_varint)
+        return b''.join((PAYLOAD_TIMESTAMP_TAG, timestamp_varint, PAYLOAD_METRIC_TAG, encode_varint(len(head) + len(chunk)),
+                         head, chunk, PAYLOAD_SEQ_TAG, encode_varint(seq)))
+
+    def max_payload_size(self, timestamp: int) -> int:
+        """
+        Returns an upper bound on the size of the payloads from `encode_chunk()`: a full chunk with the largest
+        chunk number and offset of the file, and the largest seq.
+        """
+        timestamp_varint = encode_varint(timestamp)
+        head = self._encode_head(self.size, self.chunk_size, timestamp_varint)
+        metric_size = len(head) + self.chunk_size
+        return (len(PAYLOAD_TIMESTAMP_TAG) + len(timestamp_varint) + len(PAYLOAD_METRIC_TAG) + len(encode_varint(metric_size))
+                + metric_size + len(PAYLOAD_SEQ_TAG) + len(encode_varint(255)))
+
+    def _encode_head(self, offset: int, chunk_length: int, timestamp_varint: bytes) -> bytes:
+        # Everything in a chunk metric before the data
+        metadata = self._metadata
+        metadata.seq = offset//self.chunk_size
+        metadata_bytes = metadata.SerializeToString()
+        properties = sparkplug_b_pb2.Payload.PropertySet()
+        properties.keys.append(OFFSET_PROPERTY)
+        offset_value = properties.values.add()
+        offset_value.type = sparkplug.ParameterDataType.UInt64
+        offset_value.long_value = offset
+        properties_bytes = properties.SerializeToString()
+        return b''.join((self._key, METRIC_TIMESTAMP_TAG, timestamp_varint, self._datatype,
+                         METRIC_METADATA_TAG, encode_varint(len(metadata_bytes)), metadata_bytes,
+                         METRIC_PROPERTIES_TAG, encode_varint(len(properties_bytes)), properties_bytes,
+                         METRIC_BYTES_VALUE_TAG, encode_varint(chunk_length)))
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __repr__(self):
+        return f"FileTransfer('{self.path}', {self.offset}/{self.size} bytes)"
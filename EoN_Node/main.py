@@ -57,13 +57,19 @@ class SolarBess(spc.Client):
         self.handle_dcmd = self.handle_device_change_event
 
     def start(self):
+        # Resolve metric handles once so the simulation loop writes without name lookups
+        self.node = self.state.handles(None)
+        self.pv = self.state.handles('pv')
+        self.bess = self.state.handles('bess')
+        self.poc = self.state.handles('poc')
+
         now = datetime.datetime.now()
         self.time_secs = now.second + 60*now.minute + 3600*now.hour
         self.last_time_secs = self.time_secs
         self.start_time = self.time_secs
-        self.state.set_node_metric('hostname', socket.gethostname())
+        self.node['hostname'].set(socket.gethostname())
         self.local_falling_edge = self.state.node_metrics['local_mode']
-        self.state.set_device_metric('bess', 'battery/capacity', self.bess_capacity)
+        self.bess['battery/capacity'].set(self.bess_capacity)
 
     def set_pv_capacity(self, capacity):
         self.pv_area = capacity/(self.pv_irradiance_nominal*self.pv_efficiency)
@@ -75,8 +81,8 @@ class SolarBess(spc.Client):
         self.time_secs = now.microsecond*1e-6 + now.second + 60*now.minute + 3600*now.hour
         dt = self.time_secs - self.last_time_secs
 
-        self.state.set_node_metric('uptime', int(1000*(self.time_secs - self.start_time)))
-        self.state.set_node_metric('clock', str(datetime.datetime.now()))
+        self.node['uptime'].set(int(1000*(self.time_secs - self.start_time)))
+        self.node['clock'].set(now)
 
         # Weather
         self.set_irradiance(noise=1)
@@ -94,18 +100,18 @@ class SolarBess(spc.Client):
                 self.exit_local_mode()
 
         # Control and Dynamics
-        if self.state.node_metrics['local_mode'].value:
+        if self.node['local_mode'].get():
             self.set_bess_output_local(dt)
-        elif self.state.node_metrics['manual_mode'].value:
+        elif self.node['manual_mode'].get():
             self.mode_was_manual = True
             self.set_bess_output_manual(dt)
-            poc_p = self.state.get_device_metric_value('poc', 'ac/active_power')
-            self.state.set_device_metric('poc', 'power_setpoint', poc_p)
-            self.state.set_device_metric('poc', 'power_setpoint_readback', poc_p)
-        elif self.state.node_metrics['poc_sp_mode'].value:
+            poc_p = self.poc['ac/active_power'].get()
+            self.poc['power_setpoint'].set(poc_p)
+            self.poc['power_setpoint_readback'].set(poc_p)
+        elif self.node['poc_sp_mode'].get():
             self.mode_was_manual = False
-            kc = self.state.get_device_metric_value('poc', 'control_constants/kc')
-            tau_i = self.state.get_device_metric_value('poc', 'control_constants/tau_i')
+            kc = self.poc['control_constants/kc'].get()
+            tau_i = self.poc['control_constants/tau_i'].get()
             self.set_bess_output_poc_control(dt, kc, tau_i)
             
         self.set_poc_output()
@@ -123,31 +129,31 @@ class SolarBess(spc.Client):
             self.set_mode_poc_sp_control()
 
     def set_mode_local(self):
-        self.state.set_node_metric('local_mode', True)
-        self.state.set_node_metric('manual_mode', False)
-        self.state.set_node_metric('poc_sp_mode', False)
-        self.state.set_node_metric('mode_string', 'Local')
+        self.node['local_mode'].set(True)
+        self.node['manual_mode'].set(False)
+        self.node['poc_sp_mode'].set(False)
+        self.node['mode_string'].set('Local')
 
     def set_mode_manual(self):
-        self.state.set_node_metric('local_mode', False)
-        self.state.set_node_metric('manual_mode', True)
-        self.state.set_node_metric('poc_sp_mode', False)
-        self.state.set_node_metric('mode_string', 'Manual')
+        self.node['local_mode'].set(False)
+        self.node['manual_mode'].set(True)
+        self.node['poc_sp_mode'].set(False)
+        self.node['mode_string'].set('Manual')
     
     def set_mode_poc_sp_control(self):
-        self.state.set_node_metric('local_mode', False)
-        self.state.set_node_metric('manual_mode', False)
-        self.state.set_node_metric('poc_sp_mode', True)
-        self.state.set_node_metric('mode_string', 'PoC SP Control')
+        self.node['local_mode'].set(False)
+        self.node['manual_mode'].set(False)
+        self.node['poc_sp_mode'].set(True)
+        self.node['mode_string'].set('PoC SP Control')
 
     def set_irradiance(self, dawn=6.0, dusk=18.0, max=1000.0, noise=0.0):
         hours_since_midnight = self.time_secs/3600 % 24
         if hours_since_midnight < dawn or hours_since_midnight > dusk:
-            self.state.set_node_metric('irradiance', 0)
+            self.node['irradiance'].set(0)
         else:
             A = -4*max/(dusk - dawn)**2
             i = A*(hours_since_midnight - dawn)*(hours_since_midnight - dusk) + random.normalvariate(0, noise)
-            self.state.set_node_metric('irradiance', i)
+            self.node['irradiance'].set(i)
 
     def set_temperature(self, minimum=10.0, maximum=25.0, noise=0.0):
         hours_since_midnight = self.time_secs/3600 % 24
@@ -155,13 +161,13 @@ class SolarBess(spc.Client):
         avg = (maximum + minimum)/2
         MAX_TIME = 14
         t = avg + A*math.cos(2*math.pi/24*hours_since_midnight - MAX_TIME) + random.normalvariate(0, noise)
-        self.state.set_node_metric('ambient_temperature', t)
+        self.node['ambient_temperature'].set(t)
 
     def set_pv_output(self):
         # Cell temperature increases over ambient with irradiance
-        t = self.state.node_metrics['ambient_temperature'].value
+        t = self.node['ambient_temperature'].get()
         NOCT = self.pv_cell_temperature_nominal
-        ir = self.state.node_metrics['irradiance'].value
+        ir = self.node['irradiance'].get()
         I_NOM = self.pv_irradiance_nominal
         
         cell_temp = t + (NOCT - 25)*ir/I_NOM
@@ -173,59 +179,59 @@ class SolarBess(spc.Client):
         Tstc = self.pv_temperature_nominal
 
         p = ir*A*H*(1 - Tcp*(cell_temp - Tstc))
-        self.state.set_device_metric('pv', 'dc/power', p)
+        self.pv['dc/power'].set(p)
         p_active = self.pv_pcs_efficiency*p
-        self.state.set_device_metric('pv', 'ac/active_power', p_active)
+        self.pv['ac/active_power'].set(p_active)
 
         # PV Voltage
         V_NOM = self.pv_voltage_nominal
         Tcv = self.pv_voltage_temperature_coefficient
         
         v = V_NOM*(1 - Tcv*(cell_temp - Tstc))
-        self.state.set_device_metric('pv', 'dc/voltage', v)
+        self.pv['dc/voltage'].set(v)
         vac = self.ac_voltage_nominal + random.normalvariate(v - V_NOM, 0.000_1*self.ac_voltage_nominal)
-        self.state.set_device_metric('pv', 'ac/voltage', vac)
+        self.pv['ac/voltage'].set(vac)
 
         # PV Current
         i = p/v
-        self.state.set_device_metric('pv', 'dc/current', i)
+        self.pv['dc/current'].set(i)
         iac = p_active/vac
-        self.state.set_device_metric('pv', 'ac/current', iac)
+        self.pv['ac/current'].set(iac)
 
         # Reactive Power
-        self.state.set_device_metric('pv','ac/reactive_power', 0) 
+        self.pv['ac/reactive_power'].set(0) 
 
         # Frequency
         f = random.normalvariate(50, 0.005)
-        self.state.set_device_metric('pv','ac/frequency', f) 
+        self.pv['ac/frequency'].set(f) 
 
     def set_bess_output_local(self, dt: float):
         noise = 0.000_3
-        p = self.state.get_device_metric_value('bess', 'dc/power')
+        p = self.bess['dc/power'].get()
         p += random.normalvariate(0, noise*p)
-        self.state.set_device_metric('bess', 'dc/power', p)
+        self.bess['dc/power'].set(p)
         p_ac = p*self.bess_pcs_efficiency
-        self.state.set_device_metric('bess', 'ac/active_power', p_ac)
+        self.bess['ac/active_power'].set(p_ac)
 
         v_dc = random.normalvariate(self.bess_nominal_voltage, noise*self.bess_nominal_voltage)
-        self.state.set_device_metric('bess', 'dc/voltage', v_dc)
-        self.state.set_device_metric('bess', 'dc/current', p/v_dc)
+        self.bess['dc/voltage'].set(v_dc)
+        self.bess['dc/current'].set(p/v_dc)
 
         v_ac = random.normalvariate(self.ac_voltage_nominal, noise*self.ac_voltage_nominal)
-        self.state.set_device_metric('bess', 'ac/voltage', v_ac)
-        self.state.set_device_metric('bess', 'ac/current', p_ac/v_ac)
+        self.bess['ac/voltage'].set(v_ac)
+        self.bess['ac/current'].set(p_ac/v_ac)
 
         f = random.normalvariate(50, 0.005)
-        self.state.set_device_metric('bess', 'ac/frequency', f)
+        self.bess['ac/frequency'].set(f)
 
     def set_bess_output_manual(self, dt: float):
-        p = self.state.get_device_metric_value('bess', 'dc/power')
-        p_sp = self.state.get_device_metric_value('bess', 'power_setpoint')
-        ramp_rate = self.state.get_device_metric_value('bess', 'ramp_rate')
-        # p_ac = self.state.get_device_metric_value('bess', 'ac/active_power')
+        p = self.bess['dc/power'].get()
+        p_sp = self.bess['power_setpoint'].get()
+        ramp_rate = self.bess['ramp_rate'].get()
+        # p_ac = self.bess['ac/active_power'].get()
 
         p_sp_actual = self.bess_power_setpoint_clamp(p_sp)
-        self.state.set_device_metric('bess', 'power_setpoint_readback', p_sp_actual)
+        self.bess['power_setpoint_readback'].set(p_sp_actual)
 
         noise = 0.000_5
         # p = self.bess_ac_p_control(p_sp_actual, p, )
@@ -244,29 +250,29 @@ class SolarBess(spc.Client):
         else:
             p = p_sp_actual + random.normalvariate(0, noise*p)
 
-        self.state.set_device_metric('bess', 'dc/power', p)
+        self.bess['dc/power'].set(p)
         p_ac = p*self.bess_pcs_efficiency
-        self.state.set_device_metric('bess', 'ac/active_power', p_ac)
+        self.bess['ac/active_power'].set(p_ac)
 
         v_dc = random.normalvariate(self.bess_nominal_voltage, noise*self.bess_nominal_voltage)
-        self.state.set_device_metric('bess', 'dc/voltage', v_dc)
-        self.state.set_device_metric('bess', 'dc/current', p/v_dc)
+        self.bess['dc/voltage'].set(v_dc)
+        self.bess['dc/current'].set(p/v_dc)
 
         v_ac = random.normalvariate(self.ac_voltage_nominal, noise*self.ac_voltage_nominal)
-        self.state.set_device_metric('bess', 'ac/voltage', v_ac)
-        self.state.set_device_metric('bess', 'ac/current', p_ac/v_ac)
+        self.bess['ac/voltage'].set(v_ac)
+        self.bess['ac/current'].set(p_ac/v_ac)
 
         f = random.normalvariate(50, 0.005)
-        self.state.set_device_metric('bess', 'ac/frequency', f)
+        self.bess['ac/frequency'].set(f)
 
     def set_bess_output_poc_control(self, dt: float, kc = 1, tau_i = 100):
         # POC
-        poc_sp = self.state.get_device_metric_value('poc', 'power_setpoint')
-        self.state.set_device_metric('poc', 'power_setpoint_readback', poc_sp)
-        poc_p_ac = self.state.get_device_metric_value('poc', 'ac/active_power')
+        poc_sp = self.poc['power_setpoint'].get()
+        self.poc['power_setpoint_readback'].set(poc_sp)
+        poc_p_ac = self.poc['ac/active_power'].get()
         # BESS
-        bess_p_dc_sp = self.state.get_device_metric_value('bess', 'power_setpoint')
-        bess_ramp_rate = self.state.get_device_metric_value('bess', 'ramp_rate')
+        bess_p_dc_sp = self.bess['power_setpoint'].get()
+        bess_ramp_rate = self.bess['ramp_rate'].get()
         
         # PI Control
         error = poc_sp - poc_p_ac
@@ -281,13 +287,13 @@ class SolarBess(spc.Client):
 
         bess_p_dc_sp += delta_bess_p_dc_sp
 
-        self.state.set_device_metric('bess', 'power_setpoint', bess_p_dc_sp)
+        self.bess['power_setpoint'].set(bess_p_dc_sp)
         # Ramp battery to DC setpoint
         self.set_bess_output_manual(dt)
 
     def set_bess_soc(self, dt):
-        p = self.state.devices['bess'].metrics['dc/power'].value
-        e_max = self.state.devices['bess'].metrics['battery/capacity'].value
+        p = self.bess['dc/power'].get()
+        e_max = self.bess['battery/capacity'].get()
         # Convert from J to Wh in energy calculations
         if p > 0: # Discharging
             self.bess_stored_energy -= dt*p*(2 - self.bess_efficiency)/3_600
@@ -300,12 +306,12 @@ class SolarBess(spc.Client):
             self.bess_stored_energy = 0
 
         soc = self.bess_stored_energy/e_max*100
-        self.state.set_device_metric('bess', 'battery/soc', soc)
+        self.bess['battery/soc'].set(soc)
 
     def bess_power_setpoint_clamp(self, sp):
-        discharge_max = self.state.get_device_metric_value('bess', 'dc/power_max')
+        discharge_max = self.bess['dc/power_max'].get()
         charge_max = -discharge_max
-        soc = self.state.get_device_metric_value('bess', 'battery/soc')
+        soc = self.bess['battery/soc'].get()
 
         if soc < self.bess_soc_low_low:
             discharge_max = 0
@@ -345,16 +351,16 @@ class SolarBess(spc.Client):
         return p_dc
 
     def set_poc_output(self):
-        bess_p = self.state.get_device_metric_value('bess', 'ac/active_power')
-        pv_p = self.state.get_device_metric_value('pv', 'ac/active_power')
+        bess_p = self.bess['ac/active_power'].get()
+        pv_p = self.pv['ac/active_power'].get()
         p = self.poc_efficiency*(bess_p + pv_p)
-        self.state.set_device_metric('poc', 'ac/active_power', p)
+        self.poc['ac/active_power'].set(p)
 
-        v_pv = self.state.get_device_metric_value('pv', 'ac/voltage')
-        v_bess = self.state.get_device_metric_value('bess', 'ac/voltage')
+        v_pv = self.pv['ac/voltage'].get()
+        v_bess = self.bess['ac/voltage'].get()
         v_poc = (v_pv + v_bess)/2
-        self.state.set_device_metric('poc', 'ac/voltage', v_poc)
-        self.state.set_device_metric('poc', 'ac/current', v_poc)
+        self.poc['ac/voltage'].set(v_poc)
+        self.poc['ac/current'].set(v_poc)
 
     def handle_node_metric_change_event(self, event: spc.MetricChangeEvent):
         # Returns True to allow the NCMD to result in a node metric change and False otherwise.
@@ -405,12 +411,11 @@ for client in clients:
     client.start()
     client.connect(BROKER_ADDRESS, BROKER_PORT)
     time.sleep(0.2)
+    ## Publish changes by scan class, see scan_classes in the birth certificate
+    client.start_scan_scheduler()
 ## Main Loop
 while any(client.connected for client in clients):
     for client in clients:
         client.sim_loop()
 
-        ## Publish Changes
-        client.publish_changes()
-
-    time.sleep(0.5)
\ No newline at end of file
+    time.sleep(0.1)
\ No newline at end of file
@@ -11,6 +11,9 @@
 # *   Cirrus Link Solutions - initial implementation
 # ********************************************************************************/
 import sparkplug_b_pb2
+import datetime
+import math
+import struct
 import time
 from sparkplug_b_pb2 import Payload
 
@@ -90,12 +93,121 @@ class ParameterDataType:
     DateTime = 13
     Text = 14
 
+######################################################################
+# Type codecs, keyed by data type
+######################################################################
+class TypeCodec:
+    """
+    How values of one Sparkplug data type are stored in the value field of a Metric, PropertyValue or Parameter.
+
+    encode converts a value before it is set on the field and decode converts the field back to a value. Either is
+    None when the value is stored as is. For submessage fields encode returns the message to copy. wire converts a value to what a receiver will decode from the wire.
+    """
+    __slots__ = ('datatype', 'name', 'field', 'default', 'encode', 'decode', 'wire', 'numeric', 'message')
+
+    def __init__(self, datatype, name, field, default, encode=None, decode=None, wire=None, numeric=False, message=False):
+        self.datatype = datatype
+        self.name = name
+        self.field = field
+        self.default = default
+        self.encode = encode
+        self.decode = decode
+        self.wire = wire
+        self.numeric = numeric
+        # The field is a submessage, e.g. template_value, and is copied rather than assigned
+        self.message = message
+
+    def set_value(self, message, value):
+        if self.message:
+            getattr(message, self.field).CopyFrom(value if self.encode is None else self.encode(value))
+        else:
+            setattr(message, self.field, value if self.encode is None else self.encode(value))
+
+    def get_value(self, message):
+        value = getattr(message, self.field)
+        return value if self.decode is None else self.decode(value)
+
+    def __repr__(self):
+        return "TypeCodec(" + self.name + ")"
+
+_FLOAT32 = struct.Struct('<f')
+
+def _float32(value):
+    # Round trip through the 32 bit representation of float_value. Values beyond its range are sent as infinity
+    try:
+        return _FLOAT32.unpack(_FLOAT32.pack(value))[0]
+    except OverflowError:
+        return math.copysign(math.inf, value)
+
+def _unsigned(bits):
+    # Signed integers are sent as their two's complement in the unsigned value fields
+    mask = (1 << bits) - 1
+    return lambda value: int(value) & mask
+
+def _signed(bits):
+    mask = (1 << bits) - 1
+    sign_bit = 1 << (bits - 1)
+    return lambda value: ((int(value) & mask) ^ sign_bit) - sign_bit
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+def _datetime_ms(value):
+    # DateTime values are milliseconds since the epoch, given as a number or a datetime. Naive datetimes are in
+    # local time
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.astimezone()
+        return (value - _EPOCH)//_MILLISECOND
+    return int(value)
+
+def _dataset_message(value):
+    # Tables such as dataset.DataSet build their own DataSet message
+    return value if isinstance(value, Payload.DataSet) else value.to_message()
+
+def _signed_codec(datatype, name, field, bits):
+    encode, decode = _unsigned(bits), _signed(bits)
+    return TypeCodec(datatype, name, field, 0, encode, decode, decode, numeric=True)
+
+def _unsigned_codec(datatype, name, field, bits):
+    # The value sent is the value compared, wrapped to the width of the type
+    wrap = _unsigned(bits)
+    return TypeCodec(datatype, name, field, 0, wrap, None, wrap, numeric=True)
+
+CODECS = {codec.datatype: codec for codec in (
+    _signed_codec(MetricDataType.Int8, "int8", "int_value", 8),
+    _signed_codec(MetricDataType.Int16, "int16", "int_value", 16),
+    _signed_codec(MetricDataType.Int32, "int32", "int_value", 32),
+    _signed_codec(MetricDataType.Int64, "int64", "long_value", 64),
+    _unsigned_codec(MetricDataType.UInt8, "uint8", "int_value", 8),
+    _unsigned_codec(MetricDataType.UInt16, "uint16", "int_value", 16),
+    _unsigned_codec(MetricDataType.UInt32, "uint32", "int_value", 32),
+    _unsigned_codec(MetricDataType.UInt64, "uint64", "long_value", 64),
+    TypeCodec(MetricDataType.Float, "float", "float_value", 0, wire=_float32, numeric=True),
+    TypeCodec(MetricDataType.Double, "double", "double_value", 0, wire=float, numeric=True),
+    TypeCodec(MetricDataType.Boolean, "bool", "boolean_value", False, wire=bool),
+    TypeCodec(MetricDataType.String, "string", "string_value", "", wire=str),
+    TypeCodec(MetricDataType.DateTime, "datetime", "long_value", 0, _datetime_ms, wire=_datetime_ms),
+    TypeCodec(MetricDataType.Text, "text", "string_value", "", wire=str),
+    TypeCodec(MetricDataType.UUID, "uuid", "string_value", "", str, wire=str),
+    TypeCodec(MetricDataType.DataSet, "dataset", "dataset_value", None, _dataset_message, message=True),
+    TypeCodec(MetricDataType.Bytes, "bytes", "bytes_value", b"", wire=bytes),
+    TypeCodec(MetricDataType.File, "file", "bytes_value", b"", wire=bytes),
+    TypeCodec(MetricDataType.Template, "template", "template_value", None, message=True),
+)}
+
+# Properties and template parameters only support the scalar types up to Text
+PARAMETER_CODECS = {datatype: codec for datatype, codec in CODECS.items() if datatype <= ParameterDataType.Text}
+
+CODECS_BY_NAME = {codec.name: codec for codec in CODECS.values()}
+######################################################################
+
 ######################################################################
 # Always request this before requesting the Node Birth Payload
 ######################################################################
-def getNodeDeathPayload():
+def getNodeDeathPayload(timestamp=None):
     payload = sparkplug_b_pb2.Payload()
-    addMetric(payload, "bdSeq", None, MetricDataType.Int64, getBdSeqNum())
+    addMetric(payload, "bdSeq", None, MetricDataType.Int64, getBdSeqNum(), timestamp)
     return payload
 ######################################################################
 
@@ -182,80 +294,21 @@ def initTemplateMetric(payload, name, alias, templateRef):
 # Helper method for adding metrics to a container which can be a
 # payload or a template
 ######################################################################
-def addMetric(container, name, alias, type, value, timestamp=int(round(time.time() * 1000))):
+def addMetric(container, name, alias, type, value, timestamp=None):
     metric = container.metrics.add()
     if name is not None:
         metric.name = name
     if alias is not None:
         metric.alias = alias
-    metric.timestamp = timestamp
-
-    # print( "Type: " + str(type))
-
-    if type == MetricDataType.Int8:
-        metric.datatype = MetricDataType.Int8
-        if value < 0:
-            value = value + 2**8
-        metric.int_value = value
-    elif type == MetricDataType.Int16:
-        metric.datatype = MetricDataType.Int16
-        if value < 0:
-            value = value + 2**16
-        metric.int_value = value
-    elif type == MetricDataType.Int32:
-        metric.datatype = MetricDataType.Int32
-        if value < 0:
-            value = value + 2**32
-        metric.int_value = value
-    elif type == MetricDataType.Int64:
-        metric.datatype = MetricDataType.Int64
-        if value < 0:
-            value = value + 2**64
-        metric.long_value = value
-    elif type == MetricDataType.UInt8:
-        metric.datatype = MetricDataType.UInt8
-        metric.int_value = value
-    elif type == MetricDataType.UInt16:
-        metric.datatype = MetricDataType.UInt16
-        metric.int_value = value
-    elif type == MetricDataType.UInt32:
-        metric.datatype = MetricDataType.UInt32
-        metric.int_value = value
-    elif type == MetricDataType.UInt64:
-        metric.datatype = MetricDataType.UInt64
-        metric.long_value = value
-    elif type == MetricDataType.Float:
-        metric.datatype = MetricDataType.Float
-        metric.float_value = value
-    elif type == MetricDataType.Double:
-        metric.datatype = MetricDataType.Double
-        metric.double_value = value
-    elif type == MetricDataType.Boolean:
-        metric.datatype = MetricDataType.Boolean
-        metric.boolean_value = value
-    elif type == MetricDataType.String:
-        metric.datatype = MetricDataType.String
-        metric.string_value = value
-    elif type == MetricDataType.DateTime:
-        metric.datatype = MetricDataType.DateTime
-        metric.long_value = value
-    elif type == MetricDataType.Text:
-        metric.datatype = MetricDataType.Text
-        metric.string_value = value
-    elif type == MetricDataType.UUID:
-        metric.datatype = MetricDataType.UUID
-        metric.string_value = value
-    elif type == MetricDataType.Bytes:
-        metric.datatype = MetricDataType.Bytes
-        metric.bytes_value = value
-    elif type == MetricDataType.File:
-        metric.datatype = MetricDataType.File
-        metric.bytes_value = value
-    elif type == MetricDataType.Template:
-        metric.datatype = MetricDataType.Template
-        metric.template_value = value
-    else:
+    # The current time when no timestamp is given. Callers publishing many metrics should sample the time once
+    metric.timestamp = int(round(time.time() * 1000)) if timestamp is None else timestamp
+
+    codec = CODECS.get(type)
+    if codec is None:
         print( "Invalid: " + str(type))
+    else:
+        metric.datatype = type
+        codec.set_value(metric, value)
 
     # Return the metric
     return metric
@@ -286,44 +339,8 @@ def addNullMetric(container, name, alias, type):
     metric.timestamp = int(round(time.time() * 1000))
     metric.is_null = True
 
-    # print( "Type: " + str(type))
-
-    if type == MetricDataType.Int8:
-        metric.datatype = MetricDataType.Int8
-    elif type == MetricDataType.Int16:
-        metric.datatype = MetricDataType.Int16
-    elif type == MetricDataType.Int32:
-        metric.datatype = MetricDataType.Int32
-    elif type == MetricDataType.Int64:
-        metric.datatype = MetricDataType.Int64
-    elif type == MetricDataType.UInt8:
-        metric.datatype = MetricDataType.UInt8
-    elif type == MetricDataType.UInt16:
-        metric.datatype = MetricDataType.UInt16
-    elif type == MetricDataType.UInt32:
-        metric.datatype = MetricDataType.UInt32
-    elif type == MetricDataType.UInt64:
-        metric.datatype = MetricDataType.UInt64
-    elif type == MetricDataType.Float:
-        metric.datatype = MetricDataType.Float
-    elif type == MetricDataType.Double:
-        metric.datatype = MetricDataType.Double
-    elif type == MetricDataType.Boolean:
-        metric.datatype = MetricDataType.Boolean
-    elif type == MetricDataType.String:
-        metric.datatype = MetricDataType.String
-    elif type == MetricDataType.DateTime:
-        metric.datatype = MetricDataType.DateTime
-    elif type == MetricDataType.Text:
-        metric.datatype = MetricDataType.Text
-    elif type == MetricDataType.UUID:
-        metric.datatype = MetricDataType.UUID
-    elif type == MetricDataType.Bytes:
-        metric.datatype = MetricDataType.Bytes
-    elif type == MetricDataType.File:
-        metric.datatype = MetricDataType.File
-    elif type == MetricDataType.Template:
-        metric.datatype = MetricDataType.Template
+    if type in CODECS:
+        metric.datatype = type
     else:
         print( "Invalid: " + str(type))
 
@@ -1,37 +1,19 @@
+import collections
 import json
 import paho.mqtt.client as mqtt
 import sparkplug_b as sparkplug
 import sparkplug_b_pb2
-from typing import List, Tuple
-import copy
-import time
+from sparkplug_b import CODECS
+from clock import Clock
+from compression import CompressionPolicy, decompress_payload
+from file_transfer import FileTransfer
+from wire_encoder import PAYLOAD_METRIC_TAG, WireEncoder, encode_payload, encode_varint, payload_overhead, split_metrics
+from typing import List, Sequence, Tuple
+import threading
 
 NAMESPACE = 'spBv1.0'
-NUMERIC_SPARKPLUG_METRIC_TYPES = {
-    sparkplug.MetricDataType.Float,
-    sparkplug.MetricDataType.Double,
-    sparkplug.MetricDataType.Int8,
-    sparkplug.MetricDataType.UInt8,
-    sparkplug.MetricDataType.Int16,
-    sparkplug.MetricDataType.UInt16,
-    sparkplug.MetricDataType.Int32,
-    sparkplug.MetricDataType.UInt32,
-    sparkplug.MetricDataType.Int64,
-    sparkplug.MetricDataType.UInt64,
-}
-
-NUMERIC_SPARKPLUG_PARAMETER_TYPES = {
-    sparkplug.ParameterDataType.Float,
-    sparkplug.ParameterDataType.Double,
-    sparkplug.ParameterDataType.Int8,
-    sparkplug.ParameterDataType.UInt8,
-    sparkplug.ParameterDataType.Int16,
-    sparkplug.ParameterDataType.UInt16,
-    sparkplug.ParameterDataType.Int32,
-    sparkplug.ParameterDataType.UInt32,
-    sparkplug.ParameterDataType.Int64,
-    sparkplug.ParameterDataType.UInt64,
-}
+NUMERIC_SPARKPLUG_METRIC_TYPES = {datatype for datatype, codec in sparkplug.CODECS.items() if codec.numeric}
+NUMERIC_SPARKPLUG_PARAMETER_TYPES = {datatype for datatype, codec in sparkplug.PARAMETER_CODECS.items() if codec.numeric}
 
 def sparkplug_type_from_str(datatype_str: str) -> 'sparkplug.MetricDataType':
     """
@@ -46,33 +28,10 @@ def sparkplug_type_from_str(datatype_str: str) -> 'sparkplug.MetricDataType':
     Raises:
         ValueError: If the given data type string is invalid.
     """
-    datatype_str = datatype_str.lower()
-    if datatype_str == "bool":
-        return sparkplug.MetricDataType.Boolean
-    elif datatype_str == "string":
-        return sparkplug.MetricDataType.String
-    elif datatype_str == "float":
-        return sparkplug.MetricDataType.Float
-    elif datatype_str == "double":
-        return sparkplug.MetricDataType.Double
-    elif datatype_str == "int8":
-        return sparkplug.MetricDataType.Int8
-    elif datatype_str == "uint8":
-        return sparkplug.MetricDataType.UInt8
-    elif datatype_str == "int16":
-        return sparkplug.MetricDataType.Int16
-    elif datatype_str == "uint16":
-        return sparkplug.MetricDataType.UInt16
-    elif datatype_str == "int32":
-        return sparkplug.MetricDataType.Int32
-    elif datatype_str == "uint32":
-        return sparkplug.MetricDataType.UInt32
-    elif datatype_str == "int64":
-        return sparkplug.MetricDataType.Int64
-    elif datatype_str == "uint64":
-        return sparkplug.MetricDataType.UInt64
-    else:
+    codec = sparkplug.CODECS_BY_NAME.get(datatype_str.lower())
+    if codec is None:
         raise ValueError(f"Invalid datatype: {datatype_str}")
+    return codec.datatype
 
 def sparkplug_param_type_from_str(datatype_str: str) -> 'sparkplug.ParameterDataType':
     """
@@ -87,40 +46,40 @@ def sparkplug_param_type_from_str(datatype_str: str) -> 'sparkplug.ParameterData
     Raises:
         ValueError: If the given data type string is invalid.
     """
-    datatype_str = datatype_str.lower()
-    if datatype_str == "bool":
-        return sparkplug.ParameterDataType.Boolean
-    elif datatype_str == "string":
-        return sparkplug.ParameterDataType.String
-    elif datatype_str == "float":
-        return sparkplug.ParameterDataType.Float
-    elif datatype_str == "double":
-        return sparkplug.ParameterDataType.Double
-    elif datatype_str == "int8":
-        return sparkplug.ParameterDataType.Int8
-    elif datatype_str == "uint8":
-        return sparkplug.ParameterDataType.UInt8
-    elif datatype_str == "int16":
-        return sparkplug.ParameterDataType.Int16
-    elif datatype_str == "uint16":
-        return sparkplug.ParameterDataType.UInt16
-    elif datatype_str == "int32":
-        return sparkplug.ParameterDataType.Int32
-    elif datatype_str == "uint32":
-        return sparkplug.ParameterDataType.UInt32
-    elif datatype_str == "int64":
-        return sparkplug.ParameterDataType.Int64
-    elif datatype_str == "uint64":
-        return sparkplug.ParameterDataType.UInt64
-    else:
+    codec = sparkplug.CODECS_BY_NAME.get(datatype_str.lower())
+    if codec is None or codec.datatype not in sparkplug.PARAMETER_CODECS:
         raise ValueError(f"Invalid datatype: {datatype_str}")
+    return codec.datatype
+
+DATATYPE_STR_FROM_SPARKPLUG_TYPE = {datatype: codec.name for datatype, codec in sparkplug.CODECS.items()}
 
 class Property():
+    """
+    An immutable metric property. Identical properties are shared between metrics, see `Property.get`.
+    """
+    __slots__ = ('name', 'datatype_sp', 'value')
+
+    _cache = {}
+
     def __init__(self, name: str, datatype_str: str, value=None):
         self.name = name
-        self.datatype_str = datatype_str
         self.datatype_sp = sparkplug_param_type_from_str(datatype_str)
         self.value = value
+
+    @classmethod
+    def get(cls, name: str, datatype_str: str, value=None) -> 'Property':
+        """
+        Returns the shared `Property` with the given name, data type and value, creating it on first use.
+        """
+        key = (name, datatype_str, type(value), value)
+        prop = cls._cache.get(key)
+        if prop is None:
+            prop = cls._cache[key] = cls(name, datatype_str, value)
+        return prop
+
+    @property
+    def datatype_str(self) -> str:
+        return DATATYPE_STR_FROM_SPARKPLUG_TYPE[self.datatype_sp]
     
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -133,20 +92,111 @@ class Property():
     def __ne__(self, other: object) -> bool:
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash((self.name, self.datatype_sp, self.value))
+
     def __repr__(self):
         return f"Property('{self.name}', '{self.datatype_str}', {self.value})"
 
-class Metric(): 
-    def __init__(self, name: str, datatype_str: str, value=None, properties: dict = dict()):
+class MetricSchema():
+    """
+    The invariant part of a metric: its name, alias, data type, properties and report by exception settings.
+
+    A change is only published when it moves the value further from the last published value than the absolute
+    or percentage deadband, or when max_silence seconds have passed since the metric was last published.
+
+    Metrics with max_samples keep every value written between publishes, up to max_samples of them, and publish
+    each one with the time it was written.
+
+    DataSet metrics have columns, a tuple of (column name, DataSetDataType) pairs.
+
+    Metrics in a scan_class are only evaluated for publishing when the period of their scan class has elapsed, see
+    `State.get_changes`. A metric is published at most once every min_interval seconds, and changes within that
+    window are coalesced so that only the latest value is published when it expires.
+    """
+    __slots__ = ('name', 'datatype_sp', 'properties', 'deadband', 'deadband_percent', 'max_silence', 'alias', 'max_samples', 'columns', 'scan_class', 'min_interval')
+
+    def __init__(self, name: str, datatype_sp: int, properties: tuple = (), deadband: float = None, deadband_percent: float = None, max_silence: float = None, alias: int = None, max_samples: int = None, columns: tuple = None, scan_class: str = None, min_interval: float = None):
+        if (columns is None) != (datatype_sp != sparkplug.MetricDataType.DataSet):
+            raise ValueError(f"Metric {name} must have columns if and only if it is a DataSet")
+        if max_samples is not None and max_samples < 1:
+            raise ValueError(f"max_samples of metric {name} must be at least 1, not {max_samples}")
+        if min_interval is not None and min_interval < 0:
+            raise ValueError(f"min_interval of metric {name} must not be negative, not {min_interval}")
+        if (deadband is not None or deadband_percent is not None) and datatype_sp not in NUMERIC_SPARKPLUG_METRIC_TYPES:
+            raise ValueError(f"Deadband is only supported for numeric metrics, not {name} of type {DATATYPE_STR_FROM_SPARKPLUG_TYPE.get(datatype_sp, datatype_sp)}")
         self.name = name
-        self.datatype_str = datatype_str
-        self.datatype_sp = sparkplug_type_from_str(datatype_str)
-        if value:
-            self.value = value
-        else:
-            self.value = self.default_from_sparkplug_type(self.datatype_sp)
-        self.properties = [Property(name, prop.get('datatype', None), prop.get('value', None)) for name, prop in properties.items()]
-        print(f'Created {self}')
+        self.datatype_sp = datatype_sp
+        self.properties = properties
+        self.deadband = deadband or 0
+        self.deadband_percent = deadband_percent or 0
+        self.max_silence = max_silence
+        # Numeric alias sent instead of the name in NDATA/DDATA messages, assigned by State
+        self.alias = alias
+        self.max_samples = max_samples
+        self.columns = columns
+        self.scan_class = scan_class
+        self.min_interval = min_interval or 0
+
+    @staticmethod
+    def from_certificate(name: str, metric: dict, min_interval: float = None) -> 'MetricSchema':
+        """
+        Creates the schema of a metric from its birth certificate entry.
+
+        Args:
+            name (str): The name of the metric.
+            metric (dict): A dictionary with the structure metric['datatype', 'value', 'properties', 'deadband', ...]
+            min_interval (float): The minimum publish interval if the entry does not set one, e.g. that of its device.
+        """
+        properties = tuple(Property.get(prop_name, prop.get('datatype', None), prop.get('value', None)) for prop_name, prop in metric.get('properties', {}).items())
+        columns = None
+        if 'columns' in metric:
+            # DataSet columns have the same types as parameters
+            columns = tuple((column_name, sparkplug_param_type_from_str(datatype_str)) for column_name, datatype_str in metric['columns'].items())
+        return MetricSchema(name, sparkplug_type_from_str(metric['datatype']), properties, metric.get('deadband', None), metric.get('deadband_percent', None), metric.get('max_silence', None), metric.get('alias', None), metric.get('max_samples', None), columns, metric.get('scan_class', None), metric.get('min_interval', min_interval))
+
+    @property
+    def datatype_str(self) -> str:
+        return DATATYPE_STR_FROM_SPARKPLUG_TYPE[self.datatype_sp]
+
+    def __repr__(self):
+        return f"MetricSchema(name: '{self.name}', datatype_str='{self.datatype_str}', properties={list(self.properties)})"
+
+class Metric(): 
+    """
+    The current value of a metric along with its shared `MetricSchema`.
+    """
+    __slots__ = ('schema', 'value', 'last_published')
+
+    # Time the value was written in milliseconds since the epoch, or None if writes are not timestamped, see
+    # TimestampedMetric
+    timestamp = None
+
+    def __init__(self, schema: MetricSchema, value=None, last_published: float = 0.0):
+        self.schema = schema
+        self.value = self.default_from_sparkplug_type(schema.datatype_sp) if value is None else value
+        # clock.monotonic() time at which the value was last published, for the maximum silence interval
+        self.last_published = last_published
+
+    @property
+    def name(self) -> str:
+        return self.schema.name
+
+    @property
+    def alias(self) -> int:
+        return self.schema.alias
+
+    @property
+    def datatype_sp(self) -> int:
+        return self.schema.datatype_sp
+
+    @property
+    def datatype_str(self) -> str:
+        return self.schema.datatype_str
+
+    @property
+    def properties(self) -> tuple:
+        return self.schema.properties
     
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -160,7 +210,30 @@ class Metric():
         return not self.__eq__(other)
     
     def __repr__(self):
-        return f"Metric(name: '{self.name}', datatype_str='{self.datatype_str}', value={self.value}, properties={self.properties})"
+        return f"Metric(name: '{self.name}', datatype_str='{self.datatype_str}', value={self.value}, properties={list(self.properties)})"
+
+    def should_publish(self, published_value, now: float) -> bool:
+        """
+        Returns whether the current value differs enough from the last published value to be published. Both
+        values are compared as they would be encoded for the metric's data type, so a change that a host could not
+        observe is never published.
+
+        Args:
+        published_value (Any): The last published value of the metric.
+        now (float): The current clock.monotonic() time, used for the maximum silence interval.
+        """
+        schema = self.schema
+        to_wire = sparkplug.CODECS[schema.datatype_sp].wire
+        value = to_wire(self.value)
+        published_value = to_wire(published_value)
+        # NaN never compares equal to itself, but a NaN that stays NaN is not a change, as in ColumnarState
+        if value == published_value or (value != value and published_value != published_value):
+            return False
+        if schema.deadband or schema.deadband_percent:
+            band = max(schema.deadband, abs(published_value)*schema.deadband_percent/100)
+            if abs(value - published_value) <= band:
+                return schema.max_silence is not None and now - self.last_published >= schema.max_silence
+        return True
 
     @staticmethod
     def default_from_sparkplug_type(datatype: sparkplug.MetricDataType):
@@ -173,29 +246,182 @@ class Metric():
         Returns:
         The default value for the specified data type.
         """
-        if datatype == sparkplug.MetricDataType.Boolean:
-            return False
-        elif datatype == sparkplug.MetricDataType.String:
-            return ""
-        elif datatype in NUMERIC_SPARKPLUG_METRIC_TYPES:
-            return 0
-        else:
+        codec = sparkplug.CODECS.get(datatype)
+        if codec is None or codec.default is None:
             raise ValueError(f"Invalid datatype: {datatype}")
+        return codec.default
+
+class TimestampedMetric(Metric):
+    """
+    A `Metric` that records the time of every write, so that its changes are published with the time the value was
+    sampled rather than the time of the publish.
+    """
+    __slots__ = ('_value', 'timestamp', '_clock')
+
+    def __init__(self, schema: MetricSchema, value=None, last_published: float = 0.0, clock: Clock = None):
+        self._clock = clock or Clock()
+        super().__init__(schema, value, last_published)
+        # The initial value is published in the birth message
+        self.timestamp = None
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self.timestamp = self._clock.now_ms()
+
+class SampledMetric(Metric):
+    """
+    A `Metric` that also buffers every value written to it since the last publish, with the time it was written,
+    up to `schema.max_samples` samples. The oldest samples are dropped first.
+    """
+    __slots__ = ('_value', 'samples', '_clock')
+
+    def __init__(self, schema: MetricSchema, value=None, last_published: float = 0.0, clock: Clock = None):
+        self.samples = collections.deque(maxlen=schema.max_samples)
+        self._clock = clock or Clock()
+        super().__init__(schema, value, last_published)
+        # The initial value is published in the birth message, not as a sample
+        self.samples.clear()
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self.samples.append((self._clock.now_ms(), value))
+
+    def should_publish(self, published_value, now: float) -> bool:
+        """
+        As `Metric.should_publish`, but a metric whose buffered samples moved away from the last published value
+        is published even if its current value is back at the published value.
+        """
+        if super().should_publish(published_value, now):
+            return True
+        to_wire = sparkplug.CODECS[self.schema.datatype_sp].wire
+        published_value = to_wire(published_value)
+        return any(to_wire(value) != published_value for _, value in self.samples)
+
+    def take_samples(self) -> List[Tuple[int, object]]:
+        """
+        Returns the buffered samples as (timestamp in milliseconds, value) tuples, oldest first, and clears them.
+        """
+        samples = list(self.samples)
+        self.samples.clear()
+        return samples
+
+class MetricTree():
+    """
+    A folder index over slash separated metric names such as 'ac/voltage', so that every metric under a folder
+    can be found without scanning all the metrics of a device.
+
+    Patterns are slash separated. '*' matches any single name segment and a trailing '**' matches everything
+    below a folder, e.g. 'ac/*', '*/voltage' or 'control_constants/**'.
+    """
+    __slots__ = ('folders', 'leaves')
+
+    def __init__(self, metric_names=()):
+        self.folders = {}
+        # Maps the last segment of the metrics directly in this folder to their full names
+        self.leaves = {}
+        for metric_name in metric_names:
+            self.add(metric_name)
+
+    def add(self, metric_name: str):
+        *folders, leaf = metric_name.split('/')
+        node = self
+        for folder in folders:
+            node = node.folders.setdefault(folder, MetricTree())
+        node.leaves[leaf] = metric_name
+
+    def all(self) -> List[str]:
+        """
+        Returns the names of every metric in this folder and below it.
+        """
+        names = list(self.leaves.values())
+        for folder in self.folders.values():
+            names.extend(folder.all())
+        return names
+
+    def match(self, pattern: str) -> List[str]:
+        """
+        Returns the names of the metrics that match a pattern, visiting only the folders the pattern can match.
+        """
+        return self._match(pattern.split('/'))
+
+    def _match(self, segments: List[str]) -> List[str]:
+        segment, rest = segments[0], segments[1:]
+        if segment == '**' and not rest:
+            return self.all()
+        if not rest:
+            if segment == '*':
+                return list(self.leaves.values())
+            return [self.leaves[segment]] if segment in self.leaves else []
+        if segment == '*':
+            folders = self.folders.values()
+        else:
+            folders = [self.folders[segment]] if segment in self.folders else []
+        names = []
+        for folder in folders:
+            names.extend(folder._match(rest))
+        return names
 
 class Device():
     def __init__(self, name: str, metrics: dict[str, Metric]):
         self.name = name
         self.metrics = metrics
+        self.tree = MetricTree(metrics)
+        # Metrics written since the last call to State.get_changes(), mapped to their last published value
+        self.dirty = {}
+        # Metrics whose last change was suppressed by a deadband, mapped to their last published value
+        self.held = {}
+
+class MetricHandle():
+    """
+    A metric resolved once by `State.handle`, so that hot loops can read and write it without name lookups or
+    validation. Writes are tracked for change detection exactly like `State.set_device_metric`.
+    """
+    __slots__ = ('_metric', '_name', '_dirty', '_held', '_lock')
+
+    def __init__(self, metric: Metric, dirty: dict, held: dict, lock: threading.RLock):
+        self._metric = metric
+        self._name = metric.name
+        self._dirty = dirty
+        self._held = held
+        self._lock = lock
+
+    def set(self, value):
+        # Same as State._track_write, inlined to save a call per write
+        name = self._name
+        with self._lock:
+            if name not in self._dirty:
+                held = self._held
+                self._dirty[name] = held.pop(name) if name in held else self._metric.value
+            self._metric.value = value
+
+    def get(self):
+        return self._metric.value
+
+    def __repr__(self):
+        return f"MetricHandle({self._metric})"
 
 class MetricChangeEvent:
     def __init__(self, metric_name: str, metric: Metric, prev_value=None):
         if type(metric_name) is not str:
             raise TypeError(f'Error creating MetricChangeEvent. metric_name must be of type str, not {type(metric_name)}')
-        if type(metric) is not Metric:
+        if not isinstance(metric, Metric):
             raise TypeError(f'Error creating MetricChangeEvent for {metric_name}. metric must be of type Metric, not {type(metric)}')
         self.metric_name = metric_name
         self.new_value = metric.value
         self.datatype_sp = metric.datatype_sp
+        self.alias = metric.schema.alias
+        # Time the value was sampled in milliseconds since the epoch, or None to use the timestamp of the payload
+        self.timestamp = metric.timestamp
         if self.new_value is None:
             print(f'WARNING: new_value=None when creating MetricChangeEvent for {self.metric_name}')
     
@@ -214,22 +440,151 @@ class DeviceChangeEvent:
     def __repr__(self):
         return f"DeviceChangeEvent('{self.device_id}', {self.metric_changes})"
 
+class EventRingBuffer():
+    """
+    A fixed capacity buffer of inbound command events. The paho network thread pushes events and the application
+    drains them with `Client.inbound_events()`. Neither side takes a lock or blocks: the producer only advances
+    `_tail` and the consumer only advances `_head` and `_released`, and each relies on single reference
+    assignments being atomic.
+
+    When the buffer is full, the overflow policy decides what is lost:
+        DROP_OLDEST: the oldest unread event is overwritten by the new one.
+        DROP_NEWEST: the new event is discarded.
+        COALESCE: an unread event for the same metric (or the same set of device metrics) is replaced by the new
+            one, so only the latest value is kept. Otherwise the oldest unread event is overwritten.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    COALESCE = 'coalesce'
+
+    def __init__(self, capacity: int = 1024, overflow_policy: str = DROP_OLDEST):
+        if capacity < 1:
+            raise ValueError(f"EventRingBuffer capacity must be at least 1, not {capacity}")
+        if overflow_policy not in (self.DROP_OLDEST, self.DROP_NEWEST, self.COALESCE):
+            raise ValueError(f"Invalid overflow policy: {overflow_policy}")
+        self.capacity = capacity
+        self.overflow_policy = overflow_policy
+        self._slots = [None]*capacity
+        # Monotonic sequence numbers. Event n lives in _slots[n % capacity]
+        self._tail = 0      # next event to be pushed, owned by the producer
+        self._head = 0      # next event to be claimed by the consumer
+        self._released = 0  # events before this one have been copied out and their slots may be reused
+        # Sequence number of the latest event pushed for each coalescing key, owned by the producer
+        self._latest = {}
+        # Counters
+        self.pushed_count = 0
+        self.overflow_count = 0
+        self.coalesced_count = 0
+
+    def __len__(self) -> int:
+        return self._tail - max(self._head, self._tail - self.capacity)
+
+    @staticmethod
+    def _key(event):
+        if isinstance(event, DeviceChangeEvent):
+            return (event.device_id, tuple(change.metric_name for change in event.metric_changes))
+        return (None, event.metric_name)
+
+    def push(self, event) -> bool:
+        """
+        Adds an event without blocking. Returns False if the event was discarded because the buffer is full.
+        """
+        tail = self._tail
+        self.pushed_count += 1
+        if tail - self._released >= self.capacity:
+            if self.overflow_policy == self.DROP_NEWEST:
+                self.overflow_count += 1
+                return False
+            if self.overflow_policy == self.COALESCE:
+                seq = self._latest.get(self._key(event))
+                # Slots before tail - capacity have been overwritten by newer events, possibly for other keys
+                if seq is not None and seq >= max(self._head, tail - self.capacity):
+                    self._slots[seq % self.capacity] = event
+                    # If the consumer claimed the old event while it was being replaced, it may have copied the old
+                    # one, so the new event is appended below instead. At worst the latest value is delivered twice.
+                    if seq >= self._head:
+                        self.coalesced_count += 1
+                        return True
+            # Overwrite the oldest unread event
+            self.overflow_count += 1
+
+        self._slots[tail % self.capacity] = event
+        if self.overflow_policy == self.COALESCE:
+            self._latest[self._key(event)] = tail
+        self._tail = tail + 1
+        return True
+
+    def drain(self, out: list, max_events: int = None, consume: bool = True) -> list:
+        """
+        Appends unread events, oldest first, to `out` and returns it. Reusing the same `out` list between calls
+        avoids allocating a new list for every batch.
+
+        Args:
+        out (list): The list to append events to.
+        max_events (int): The maximum number of events to drain, or None for all of them.
+        consume (bool): If False, the events are left in the buffer.
+        """
+        tail = self._tail
+        start = max(self._head, tail - self.capacity)
+        if max_events is not None:
+            tail = min(tail, start + max_events)
+        if consume:
+            # Claim the events before copying them, so the producer no longer coalesces into them
+            self._head = tail
+        first = len(out)
+        for seq in range(start, tail):
+            out.append(self._slots[seq % self.capacity])
+        # Events that the producer overwrote while they were being copied were dropped as the oldest
+        overwritten = min(self._tail - self.capacity - start, tail - start)
+        if overwritten > 0:
+            del out[first:first + overwritten]
+        if consume:
+            self._released = tail
+        return out
+
 class BirthCertificate:
     """
     Represents a Sparkplug birth certificate that contains information about the metrics and devices in a node.
     """
     
-    def __init__(self, node_metrics: dict, devices: dict):
+    def __init__(self, node_metrics: dict, devices: dict, templates: dict = None, scan_classes: dict = None, default_scan_class: str = None):
         """
         Initializes a new instance of the BirthCertificate class.
 
         Args:
             node_metrics (dict): A dictionary with the structure node_metrics[metric_name]['datatype', 'value']
             devices (dict): A dictionary with the structure devices[device_name][metric_name]['datatype', 'value']
+            templates (dict): Device types with the structure templates[template_name]['metrics', 'version']. A device
+                {'template': template_name} is an instance of the type and shares its metrics.
+            scan_classes (dict): Maps scan class names to their publish periods in seconds. Metrics join a class
+                with metric['scan_class'].
+            default_scan_class (str): The scan class of metrics that do not name one. Metrics without a scan class
+                are evaluated on every publish.
+
+        Raises:
+            ValueError: If a device references a template that is not defined, or a scan class is invalid.
         """
         #TODO check the structure of node metrics and device metrics 
         self.node_metrics = node_metrics
-        self.devices = devices
+        self.scan_classes = dict(scan_classes or {})
+        for scan_class, period in self.scan_classes.items():
+            if period <= 0:
+                raise ValueError(f"Period of scan class {scan_class} must be positive, not {period}")
+        if default_scan_class is not None and default_scan_class not in self.scan_classes:
+            raise ValueError(f"Default scan class {default_scan_class} not found in scan classes")
+        self.default_scan_class = default_scan_class
+        self.templates = templates or {}
+        # Template name of each device that is an instance of a template
+        self.device_templates = {}
+        self.devices = {}
+        for device_name, device in devices.items():
+            if 'template' in device:
+                template_name = device['template']
+                if template_name not in self.templates:
+                    raise ValueError(f"Template {template_name} of device {device_name} not found in templates")
+                self.device_templates[device_name] = template_name
+                device = {**device, 'metrics': self.templates[template_name]['metrics']}
+            self.devices[device_name] = device
     
     @staticmethod
     def from_file(filename: str) -> 'BirthCertificate':
@@ -246,28 +601,226 @@ class BirthCertificate:
             birth_certificate = json.load(f)
             node_metrics = birth_certificate['node']['metrics']
             devices = birth_certificate['node']['devices']
-            return BirthCertificate(node_metrics, devices)
+            templates = birth_certificate['node'].get('templates', None)
+            scan_classes = birth_certificate['node'].get('scan_classes', None)
+            default_scan_class = birth_certificate['node'].get('default_scan_class', None)
+            return BirthCertificate(node_metrics, devices, templates, scan_classes, default_scan_class)
+
+class StateTransaction():
+    """
+    Collects writes to a `State` and applies them atomically when the `with` block exits without an exception.
+    Use `State.transaction()` to create one. Values written in a transaction are not visible until it commits.
+    """
+
+    def __init__(self, state: 'State'):
+        self._state = state
+        self._node_values = {}
+        self._device_values = {}
+
+    def set_node_metric(self, metric_name: str, value):
+        self._node_values[metric_name] = value
+
+    def set_node_metrics(self, metrics, values: Sequence = None):
+        self._node_values.update(State._batch(metrics, values))
+
+    def set_device_metric(self, device_name: str, metric_name: str, value):
+        self._device_values.setdefault(device_name, {})[metric_name] = value
+
+    def set_device_metrics(self, device_name: str, metrics, values: Sequence = None):
+        self._device_values.setdefault(device_name, {}).update(State._batch(metrics, values))
+
+    def __enter__(self) -> 'StateTransaction':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._state._commit(self._node_values, self._device_values)
 
 class State():
 
-    def __init__(self, birth_certificate: BirthCertificate):
+    def __init__(self, birth_certificate: BirthCertificate, clock: Clock = None, timestamp_writes: bool = False):
         """
         Creates a new instance of the `State` class with metrics initialized to their default values.
         
         Args:
         birth_certificate (BirthCertificate): An instance of the `BirthCertificate` class.
+        clock (Clock): The time source for sample times and max_silence intervals.
+        timestamp_writes (bool): Record the time of every write and publish each change with it, see
+            `TimestampedMetric`. Otherwise changes carry the time of the publish.
         """
-        # self.node_metrics = {metric_name: self.get_default_value(data_type) 
-        #     for metric_name, metric in birth_certificate.node_metrics.items()}
-        self.node_metrics = {metric_name: Metric(metric_name, metric['datatype'], metric.get('value', None), metric.get('properties', {})) for metric_name, metric in birth_certificate.node_metrics.items()}
+        self.clock = clock or Clock()
+        self.timestamp_writes = timestamp_writes
+        # Values from the birth certificate are published in the birth messages
+        self._created = self.clock.monotonic()
+
+        # Publish period in seconds of each scan class, and the monotonic time at which it is next due. Every class
+        # is due on the first call to get_changes()
+        self.scan_periods = dict(birth_certificate.scan_classes)
+        self._default_scan_class = birth_certificate.default_scan_class
+        self._scan_due = {scan_class: self._created for scan_class in self.scan_periods}
+
+        # Minimum publish interval of the metrics of each device that do not set their own
+        self._device_min_intervals = {device_name: device.get('min_interval', None) for device_name, device in birth_certificate.devices.items()}
+        # Monotonic time at which the earliest change held back by its minimum publish interval may be published,
+        # or None if there is no such change
+        self._pending_due = None
+
+        self.node_metrics = {metric_name: self._create_metric(None, metric_name, metric) for metric_name, metric in birth_certificate.node_metrics.items()}
         
         self.devices = {}
         for device_name, device in birth_certificate.devices.items():
-            device_metrics = {metric_name: Metric(metric_name, metric['datatype'], metric['value'], metric.get('properties', {})) for metric_name, metric in device['metrics'].items()}
+            device_metrics = {metric_name: self._create_metric(device_name, metric_name, metric) for metric_name, metric in device['metrics'].items()}
             self.devices[device_name] = Device(device_name, device_metrics)
 
-        self._old_node_metrics = copy.deepcopy(self.node_metrics)
-        self._old_devices = {device_name: copy.deepcopy(device) for device_name, device in self.devices.items()}
+        self.node_tree = MetricTree(self.node_metrics)
+
+        # Template name of each device that is an instance of a Sparkplug Template, see metric_prefix()
+        self.device_templates = dict(birth_certificate.device_templates)
+
+        # Aliases of every node and device metric, mapped to (device_name, metric_name). device_name is None for
+        # node metrics. The state lives as long as the client, so aliases stay the same across rebirths
+        self.aliases = {}
+        self._assign_aliases()
+
+        # Node metrics written since the last call to get_changes(), mapped to their last published value
+        self._node_dirty = {}
+        self._node_held = {}
+
+        # Report by exception counters, to measure how many samples the deadbands save
+        self.published_samples = 0
+        self.suppressed_samples = 0
+
+        # Every write, and the collection of changes, holds this lock. get_changes() copies the changed values into
+        # change events while holding it, so the publisher encodes a consistent snapshot without blocking writers
+        self._lock = threading.RLock()
+
+    def _create_metric(self, device_name: str, metric_name: str, metric: dict) -> Metric:
+        """
+        Creates the metric described by a birth certificate entry. `device_name` is None for node metrics.
+        Subclasses override this to change how metric values are stored.
+        """
+        schema = self._schema(device_name, metric_name, metric)
+        if schema.datatype_sp == sparkplug.MetricDataType.DataSet:
+            # Imported here so that NumPy is only needed by birth certificates with DataSet metrics
+            from dataset import DataSetMetric
+            return DataSetMetric(schema, metric.get('value', None), self._created, metric.get('rows', 0))
+        if schema.max_samples:
+            return SampledMetric(schema, metric.get('value', None), self._created, self.clock)
+        if self.timestamp_writes:
+            return TimestampedMetric(schema, metric.get('value', None), self._created, self.clock)
+        return Metric(schema, metric.get('value', None), self._created)
+
+    def metric_prefix(self, device_name: str) -> str:
+        """
+        Returns the prefix of the names of a device's metrics in DDATA and DCMD messages. The DBIRTH of a Template
+        instance holds its metrics as the members of a Template metric named after the device, so metrics sent
+        without their alias are named "<device_name>/<metric_name>". The prefix is empty for other devices and the
+        node.
+        """
+        return f"{device_name}/" if device_name in self.device_templates else ""
+
+    def _schema(self, device_name: str, metric_name: str, metric: dict) -> MetricSchema:
+        # The schema of a birth certificate entry, in the default scan class and with the minimum publish interval
+        # of its device unless the entry sets its own
+        schema = MetricSchema.from_certificate(metric_name, metric, self._device_min_intervals.get(device_name, None))
+        if schema.scan_class is None:
+            schema.scan_class = self._default_scan_class
+        elif schema.scan_class not in self.scan_periods:
+            raise ValueError(f"Scan class {schema.scan_class} of metric {metric_name} not found in scan classes")
+        return schema
+
+    def _assign_aliases(self):
+        """
+        Gives every metric a numeric alias that is unique within the edge node. Aliases set in the birth certificate
+        are kept and the remaining metrics are numbered in certificate order, skipping aliases already taken.
+
+        Raises:
+        ValueError: If two metrics in the birth certificate have the same alias.
+        """
+        owners = [(None, self.node_metrics)] + [(device_name, device.metrics) for device_name, device in self.devices.items()]
+        for device_name, metrics in owners:
+            for metric_name, metric in metrics.items():
+                if metric.alias is None:
+                    continue
+                if metric.alias in self.aliases:
+                    raise ValueError(f"Alias {metric.alias} of metric {metric_name} is already used by {self.aliases[metric.alias]}")
+                self.aliases[metric.alias] = (device_name, metric_name)
+
+        alias = 0
+        for device_name, metrics in owners:
+            for metric_name, metric in metrics.items():
+                if metric.alias is not None:
+                    continue
+                while alias in self.aliases:
+                    alias += 1
+                metric.schema.alias = alias
+                self.aliases[alias] = (device_name, metric_name)
+
+    @staticmethod
+    def _track_write(metric: Metric, value, dirty: dict, held: dict):
+        # Remember the last published value the first time a metric is touched after a publish
+        if metric.name not in dirty:
+            dirty[metric.name] = held.pop(metric.name) if metric.name in held else metric.value
+        metric.value = value
+
+    def _collect_changes(self, metrics: dict[str, Metric], dirty: dict, held: dict, now: float, due: set = None, flush: bool = False) -> List[MetricChangeEvent]:
+        # Only the metrics touched since the last call are compared, so the cost scales with the number of writes.
+        # Metrics whose scan class is not in due stay dirty until it is
+        changes = []
+        deferred = {}
+        for metric_name, published_value in dirty.items():
+            metric = metrics[metric_name]
+            if due is not None and metric.schema.scan_class is not None and metric.schema.scan_class not in due:
+                deferred[metric_name] = published_value
+                continue
+            if metric.should_publish(published_value, now):
+                min_interval = metric.schema.min_interval
+                pending_due = metric.last_published + min_interval
+                if min_interval and not flush and now < pending_due:
+                    # Published too recently. Later writes replace the value, so the latest one is published when
+                    # the interval expires
+                    deferred[metric_name] = published_value
+                    if self._pending_due is None or pending_due < self._pending_due:
+                        self._pending_due = pending_due
+                    continue
+                if metric.schema.max_samples:
+                    changes.extend(self._sample_changes(metric_name, metric))
+                else:
+                    changes.append(MetricChangeEvent(metric_name, metric))
+                metric.last_published = now
+            elif metric.value != published_value:
+                # Within the deadband or the precision of the wire type. Keep comparing against the last published
+                # value so that slow drifts are still reported
+                held[metric_name] = published_value
+                self.suppressed_samples += 1
+            if metric.schema.max_samples:
+                metric.samples.clear()
+        dirty.clear()
+        dirty.update(deferred)
+
+        # Suppressed changes are published once the metric has been silent for longer than its max_silence
+        for metric_name, published_value in list(held.items()):
+            metric = metrics[metric_name]
+            if due is not None and metric.schema.scan_class is not None and metric.schema.scan_class not in due:
+                continue
+            if metric.schema.max_silence is not None and metric.should_publish(published_value, now):
+                changes.append(MetricChangeEvent(metric_name, metric))
+                metric.last_published = now
+                del held[metric_name]
+
+        self.published_samples += len(changes)
+        return changes
+
+    @staticmethod
+    def _sample_changes(metric_name: str, metric: SampledMetric) -> List[MetricChangeEvent]:
+        # One change per buffered sample, each with the time it was written
+        changes = []
+        for timestamp, value in metric.take_samples():
+            change = MetricChangeEvent(metric_name, metric)
+            change.new_value = value
+            change.timestamp = timestamp
+            changes.append(change)
+        return changes
 
     def set_node_metric(self, metric_name: str, value):
         """
@@ -281,7 +834,8 @@ class State():
         ValueError: If the metric is not found in the node metrics.
         """
         if metric_name in self.node_metrics:
-            self.node_metrics[metric_name].value = value
+            with self._lock:
+                self._track_write(self.node_metrics[metric_name], value, self._node_dirty, self._node_held)
         else:
             raise ValueError(f"Metric {metric_name} not found in node metrics")
 
@@ -301,27 +855,312 @@ class State():
             raise ValueError(f"Device {device_name} not found in devices")
         if metric_name not in self.devices[device_name].metrics:
             raise ValueError(f"Metric {metric_name} not found in device {device_name} metrics")
-        self.devices[device_name].metrics[metric_name].value = value
+        device = self.devices[device_name]
+        with self._lock:
+            self._track_write(device.metrics[metric_name], value, device.dirty, device.held)
+
+    @staticmethod
+    def _batch(metrics, values: Sequence = None) -> dict:
+        # Normalises a mapping of metric names to values, or parallel sequences of names and values, to a dict
+        if values is None:
+            return dict(metrics)
+        if len(metrics) != len(values):
+            raise ValueError(f"Got {len(metrics)} metric names but {len(values)} values")
+        return dict(zip(metrics, values))
+
+    def _write_batch(self, metrics: dict[str, Metric], values: dict, dirty: dict, held: dict):
+        # A single change tracking update for the whole batch, then the writes themselves
+        fresh = values.keys() - dirty.keys()
+        if fresh:
+            dirty.update({metric_name: held.pop(metric_name) if metric_name in held else metrics[metric_name].value for metric_name in fresh})
+        for metric_name, value in values.items():
+            metrics[metric_name].value = value
+
+    def _commit(self, node_values: dict, device_values: dict):
+        # Validate the whole batch before writing anything, so an invalid batch leaves the state untouched
+        unknown = node_values.keys() - self.node_metrics.keys()
+        if unknown:
+            raise ValueError(f"Metrics {sorted(unknown)} not found in node metrics")
+        for device_name, values in device_values.items():
+            if device_name not in self.devices:
+                raise ValueError(f"Device {device_name} not found in devices")
+            unknown = values.keys() - self.devices[device_name].metrics.keys()
+            if unknown:
+                raise ValueError(f"Metrics {sorted(unknown)} not found in device {device_name} metrics")
+
+        with self._lock:
+            if node_values:
+                self._write_batch(self.node_metrics, node_values, self._node_dirty, self._node_held)
+            for device_name, values in device_values.items():
+                device = self.devices[device_name]
+                self._write_batch(device.metrics, values, device.dirty, device.held)
+
+    def set_node_metrics(self, metrics, values: Sequence = None):
+        """
+        Sets the values of several node metrics at once. The metrics are validated once for the whole batch.
+
+        Args:
+        metrics (Mapping[str, Any] | Sequence[str]): A mapping of metric names to values, or a sequence of metric names.
+        values (Sequence): The values for the metric names, if metrics is a sequence of names.
+
+        Raises:
+        ValueError: If any metric is not found in the node metrics. No value is written in that case.
+        """
+        self._commit(self._batch(metrics, values), {})
+
+    def set_device_metrics(self, device_name: str, metrics, values: Sequence = None):
+        """
+        Sets the values of several metrics of a device at once, e.g. from a complete device scan. The metrics are
+        validated once for the whole batch.
+
+        Args:
+        device_name (str): The name of the device.
+        metrics (Mapping[str, Any] | Sequence[str]): A mapping of metric names to values, or a sequence of metric names.
+        values (Sequence): The values for the metric names, if metrics is a sequence of names.
+
+        Raises:
+        ValueError: If the device or any metric is not found. No value is written in that case.
+        """
+        self._commit({}, {device_name: self._batch(metrics, values)})
+
+    def set_devices(self, devices: dict[str, dict]):
+        """
+        Sets the values of metrics of several devices at once.
+
+        Args:
+        devices (Mapping[str, Mapping[str, Any]]): Maps device names to mappings of metric names to values.
+
+        Raises:
+        ValueError: If any device or metric is not found. No value is written in that case.
+        """
+        self._commit({}, {device_name: dict(values) for device_name, values in devices.items()})
+
+    def transaction(self) -> StateTransaction:
+        """
+        Returns a context manager that collects writes and applies them atomically on exit, so a concurrent
+        `get_changes` sees either none or all of them. Nothing is written if the block raises.
+
+        Example:
+            with state.transaction() as tx:
+                tx.set_device_metrics('bess', scan)
+                tx.set_node_metric('uptime', uptime)
+        """
+        return StateTransaction(self)
+
+    def _due_scan_classes(self, now: float) -> set:
+        # The scan classes whose period has elapsed, each rescheduled one period on. A class that fell a whole
+        # period behind is rescheduled from now rather than publishing a burst to catch up
+        due = set()
+        for scan_class, next_due in self._scan_due.items():
+            if now >= next_due:
+                due.add(scan_class)
+                next_due += self.scan_periods[scan_class]
+                self._scan_due[scan_class] = next_due if next_due > now else now + self.scan_periods[scan_class]
+        return due
+
+    def set_scan_period(self, scan_class: str, period: float):
+        """
+        Changes the publish period of a scan class at runtime. The class is next due one new period after it was
+        last evaluated, or immediately if that time has passed.
 
-    def get_changes(self) -> Tuple[List[MetricChangeEvent], List[DeviceChangeEvent]]:
+        Args:
+        scan_class (str): The name of the scan class.
+        period (float): The new period in seconds.
+
+        Raises:
+        ValueError: If the scan class is not found or the period is not positive.
         """
-        Compares the current state of the metrics to the previous state and returns the changes.
+        if scan_class not in self.scan_periods:
+            raise ValueError(f"Scan class {scan_class} not found in scan classes")
+        if period <= 0:
+            raise ValueError(f"Period of scan class {scan_class} must be positive, not {period}")
+        with self._lock:
+            last_due = self._scan_due[scan_class] - self.scan_periods[scan_class]
+            self.scan_periods[scan_class] = period
+            self._scan_due[scan_class] = last_due + period
+
+    def pending_delay(self) -> float:
+        """
+        Returns the number of seconds until the earliest change held back by its minimum publish interval may be
+        published, or None if no change is held back.
+        """
+        with self._lock:
+            if self._pending_due is None:
+                return None
+            return max(0.0, self._pending_due - self.clock.monotonic())
+
+    def next_scan_delay(self) -> float:
+        """
+        Returns the number of seconds until the next scan class is due, 0 if one is overdue, or None if there are no
+        scan classes.
+        """
+        with self._lock:
+            if not self._scan_due:
+                return None
+            return max(0.0, min(self._scan_due.values()) - self.clock.monotonic())
+
+    def get_changes(self, flush: bool = False) -> Tuple[List[MetricChangeEvent], List[DeviceChangeEvent]]:
+        """
+        Returns the metrics whose value differs from the last published value, considering only the metrics
+        written through `set_node_metric` and `set_device_metric` since the previous call. Changes within a
+        metric's deadband are suppressed and counted in `suppressed_samples`. Metrics in a scan class are only
+        considered when their scan class is due, and changes to metrics published less than their min_interval
+        ago are held back. Both are kept for a later call, see `pending_delay` and `next_scan_delay`.
+
+        Args:
+        flush (bool): Return every pending change, regardless of scan classes and minimum publish intervals.
 
         Returns:
         A tuple containing the changes to the node metrics and device metrics respectively.
         """
-        node_changes = [MetricChangeEvent(metric_name, metric) for metric_name, metric in self.node_metrics.items() if self._old_node_metrics[metric_name] != metric]
-        self._old_node_metrics = copy.deepcopy(self.node_metrics)
-
-        device_changes = []
-        for device_name, device in self.devices.items():
-            device_metric_changes = [MetricChangeEvent(metric_name, metric) for metric_name, metric in device.metrics.items() if self._old_devices[device_name].metrics[metric_name] != metric]
-            if device_metric_changes:
-                device_changes.append(DeviceChangeEvent(device_name, device_metric_changes))
-            self._old_devices[device_name] = copy.deepcopy(device)
+        with self._lock:
+            now = self.clock.monotonic()
+            due = self._due_scan_classes(now) if self.scan_periods and not flush else None
+            self._pending_due = None
+            node_changes = self._collect_changes(self.node_metrics, self._node_dirty, self._node_held, now, due, flush)
+
+            device_changes = []
+            for device_name, device in self.devices.items():
+                if not (device.dirty or device.held):
+                    continue
+                device_metric_changes = self._collect_changes(device.metrics, device.dirty, device.held, now, due, flush)
+                if device_metric_changes:
+                    device_changes.append(DeviceChangeEvent(device_name, device_metric_changes))
 
         return node_changes, device_changes
     
+    def _mark_published(self, metrics: dict[str, Metric], dirty: dict, held: dict, now: float):
+        dirty.clear()
+        held.clear()
+        for metric in metrics.values():
+            metric.last_published = now
+            if metric.schema.max_samples:
+                metric.samples.clear()
+
+    def birth_snapshot(self, device_name: str = None) -> List[Tuple[Metric, object]]:
+        """
+        Returns a consistent snapshot of every metric of a device, or of the node if device_name is None, for a
+        birth message. The snapshot values become the last published values, so pending changes that the birth
+        already carries are not published again as data.
+
+        Returns:
+        A list of (metric, value) tuples.
+        """
+        with self._lock:
+            if device_name is None:
+                metrics, dirty, held = self.node_metrics, self._node_dirty, self._node_held
+            else:
+                device = self.devices[device_name]
+                metrics, dirty, held = device.metrics, device.dirty, device.held
+            snapshot = [(metric, metric.value) for metric in metrics.values()]
+            self._mark_published(metrics, dirty, held, self.clock.monotonic())
+        return snapshot
+
+    def handle(self, device_name: str, metric_name: str) -> MetricHandle:
+        """
+        Resolves a metric to a handle whose `set` and `get` skip the name lookups and validation of
+        `set_device_metric` and `get_device_metric_value`. Resolve handles once, e.g. at startup, and reuse them.
+
+        Args:
+        device_name (str): The name of the device, or None for a node metric.
+        metric_name (str): The name of the metric.
+
+        Raises:
+        ValueError: If the device or the metric is not found.
+        """
+        if device_name is None:
+            if metric_name not in self.node_metrics:
+                raise ValueError(f"Metric {metric_name} not found in node metrics")
+            return MetricHandle(self.node_metrics[metric_name], self._node_dirty, self._node_held, self._lock)
+        if device_name not in self.devices:
+            raise ValueError(f"Device {device_name} not found in devices")
+        device = self.devices[device_name]
+        if metric_name not in device.metrics:
+            raise ValueError(f"Metric {metric_name} not found in device {device_name} metrics")
+        return MetricHandle(device.metrics[metric_name], device.dirty, device.held, self._lock)
+
+    def handles(self, device_name: str) -> dict[str, MetricHandle]:
+        """
+        Returns handles for every metric of a device, or of the node if device_name is None, keyed by metric name.
+        """
+        metrics = self.node_metrics if device_name is None else self.devices[device_name].metrics
+        return {metric_name: self.handle(device_name, metric_name) for metric_name in metrics}
+
+    def _tracking(self, device_name: str) -> Tuple[dict[str, Metric], MetricTree, dict, dict]:
+        # The metrics, folder index and change tracking maps of a device, or of the node if device_name is None
+        if device_name is None:
+            return self.node_metrics, self.node_tree, self._node_dirty, self._node_held
+        if device_name not in self.devices:
+            raise ValueError(f"Device {device_name} not found in devices")
+        device = self.devices[device_name]
+        return device.metrics, device.tree, device.dirty, device.held
+
+    def _pending(self, metrics: dict[str, Metric], metric_names: List[str], dirty: dict, held: dict) -> List[str]:
+        return [metric_name for metric_name in metric_names if metric_name in held or (metric_name in dirty and metrics[metric_name].value != dirty[metric_name])]
+
+    def get_node_metrics(self, pattern: str = '**') -> dict:
+        """
+        Returns the values of the node metrics matching a pattern, see `get_device_metrics`.
+        """
+        return self.get_device_metrics(None, pattern)
+
+    def get_device_metrics(self, device_name: str, pattern: str = '**') -> dict:
+        """
+        Returns a consistent snapshot of the values of the metrics of a device that match a pattern. The cost is
+        proportional to the size of the matching folders, not to the number of metrics of the device.
+
+        Args:
+        device_name (str): The name of the device, or None for node metrics.
+        pattern (str): A metric name pattern, e.g. 'ac/*' for every metric directly in the 'ac' folder, '*/voltage',
+            or 'battery/**' for every metric below 'battery'. See `MetricTree`.
+
+        Returns:
+        A dictionary of metric names to values.
+
+        Raises:
+        ValueError: If the device is not found.
+        """
+        metrics, tree, _, _ = self._tracking(device_name)
+        metric_names = tree.match(pattern)
+        with self._lock:
+            return {metric_name: metrics[metric_name].value for metric_name in metric_names}
+
+    def set_device_subtree(self, device_name: str, folder: str, values):
+        """
+        Writes to every metric below a folder of a device, as one batch.
+
+        Args:
+        device_name (str): The name of the device, or None for node metrics.
+        folder (str): The folder, e.g. 'ac' or 'battery/cells'.
+        values (Mapping[str, Any] | Any): A mapping of metric names relative to the folder to values, e.g.
+            {'voltage': 230.0, 'current': 4.2} for folder 'ac', or a single value written to every metric below the folder.
+
+        Raises:
+        ValueError: If the device or a metric is not found. No value is written in that case.
+        """
+        if isinstance(values, dict):
+            batch = {f'{folder}/{metric_name}': value for metric_name, value in values.items()}
+        else:
+            _, tree, _, _ = self._tracking(device_name)
+            batch = dict.fromkeys(tree.match(f'{folder}/**'), values)
+        if device_name is None:
+            self._commit(batch, {})
+        else:
+            self._commit({}, {device_name: batch})
+
+    def changed_metrics(self, device_name: str, pattern: str = '**') -> List[str]:
+        """
+        Returns the names of the metrics matching a pattern whose value differs from the last published value,
+        without consuming the changes. See `get_device_metrics` for the pattern syntax.
+
+        Raises:
+        ValueError: If the device is not found.
+        """
+        metrics, tree, dirty, held = self._tracking(device_name)
+        metric_names = tree.match(pattern)
+        with self._lock:
+            return self._pending(metrics, metric_names, dirty, held)
+
     def get_node_metric_value(self, metric_name: str):
         #TODO add context to key not found error
         return self.node_metrics[metric_name].value
@@ -330,11 +1169,229 @@ class State():
         #TODO add context to key not found error
         return self.devices[device_name].metrics[metric_name].value
 
+class PayloadTemplate():
+    """
+    A reusable NDATA/DDATA payload for the node or one device. Each publish overwrites the metric submessages of
+    the previous publish in place, and a submessage's alias and datatype are only set again when a different metric
+    lands in its position. Publishing the same set of changed metrics every tick only sets values and timestamps.
+
+    Metrics with an alias are identified by the alias alone, as the host learned the name from the birth messages.
+    Metrics without one, or all metrics if use_aliases is False, are identified by name, after `prefix`, see
+    `State.metric_prefix`.
+    """
+
+    def __init__(self, use_aliases: bool = True, prefix: str = ""):
+        self.payload = sparkplug_b_pb2.Payload()
+        self.use_aliases = use_aliases
+        self.prefix = prefix
+        # The submessages of payload.metrics and the alias or name of the metric each currently holds
+        self._metrics = []
+        self._keys = []
+
+    def fill(self, changes: List[MetricChangeEvent], seq: int, timestamp: int) -> sparkplug_b_pb2.Payload:
+        """
+        Refills the payload with the given changes and returns it. The payload is only valid until the next call.
+
+        Args:
+        changes (List[MetricChangeEvent]): The changed metrics to publish.
+        seq (int): The sequence number of the message.
+        timestamp (int): The timestamp of the payload, and of the metrics whose change has no timestamp of its own,
+        in milliseconds since the epoch.
+        """
+        payload = self.payload
+        payload.timestamp = timestamp
+        payload.seq = seq
+        metrics, keys = self._metrics, self._keys
+        use_aliases = self.use_aliases
+        prefix = self.prefix
+        reused = len(metrics)
+        for i, change in enumerate(changes):
+            datatype_sp = change.datatype_sp
+            key = change.alias if use_aliases and change.alias is not None else prefix + change.metric_name
+            if i < reused:
+                metric = metrics[i]
+                if keys[i] != key:
+                    metric.Clear()
+                    self._identify(metric, key, datatype_sp)
+                    keys[i] = key
+            else:
+                metric = payload.metrics.add()
+                self._identify(metric, key, datatype_sp)
+                metrics.append(metric)
+                keys.append(key)
+            metric.timestamp = timestamp if change.timestamp is None else change.timestamp
+            codec = CODECS[datatype_sp]
+            value = change.new_value
+            if codec.message:
+                codec.set_value(metric, value)
+            else:
+                setattr(metric, codec.field, value if codec.encode is None else codec.encode(value))
+
+        if reused > len(changes):
+            del payload.metrics[len(changes):]
+            del metrics[len(changes):]
+            del keys[len(changes):]
+        return payload
+
+    @staticmethod
+    def _identify(metric, key, datatype_sp: int):
+        if type(key) is str:
+            metric.name = key
+        else:
+            metric.alias = key
+        metric.datatype = datatype_sp
+
+# Metrics published first in every NBIRTH, as (name, datatype_sp, value)
+NODE_CONTROL_METRICS = (
+    # TODO track bdSeq over multiple birth-death cycles
+    ("bdSeq", sparkplug.MetricDataType.Int64, 0),
+    ("Node Control/Next Server", sparkplug.MetricDataType.Boolean, False),
+    ("Node Control/Rebirth", sparkplug.MetricDataType.Boolean, False),
+    ("Node Control/Reboot", sparkplug.MetricDataType.Boolean, False),
+)
+
+class BirthTemplate():
+    """
+    The NBIRTH of the node or the DBIRTH of one device, built once with the name, alias, datatype and properties of
+    every metric. Publishing a birth only sets the current values and timestamps. The template is rebuilt when the
+    schemas of the metrics change, see `matches()`.
+
+    The DBIRTH of a device that is an instance of a Sparkplug Template holds a single Template metric referencing
+    the definition published in the NBIRTH. Its member metrics carry their alias, datatype and value, and leave the
+    properties to the definition.
+    """
+    # Encoded PropertySets shared by every metric with the same properties, keyed by the ids of the interned
+    # Property objects. The Property objects are kept in the value so that their ids are not reused
+    _property_sets = {}
+
+    def __init__(self, schemas: Tuple[MetricSchema, ...], control_metrics: Sequence[tuple] = (), definitions: Sequence[sparkplug_b_pb2.Payload.Metric] = (), instance: Tuple[str, str] = None):
+        """
+        Args:
+        schemas (Tuple[MetricSchema]): The schemas of the metrics, in birth order.
+        control_metrics (Sequence[tuple]): (name, datatype_sp, value) of metrics with fixed values that come before
+            the state metrics, e.g. bdSeq and the Node Control metrics of an NBIRTH.
+        definitions (Sequence[Payload.Metric]): Template definitions published after the control metrics, see
+            `template_definition()`.
+        instance (Tuple[str, str]): (metric name, template name) to publish the metrics as the members of a
+            Template instance, or None to publish them as top level metrics.
+        """
+        self.schemas = schemas
+        self.payload = sparkplug_b_pb2.Payload()
+        # Every metric submessage, to set timestamps, and the submessages holding state values with their codecs
+        self._all_metrics = [sparkplug.addMetric(self.payload, name, None, datatype_sp, value, 0) for name, datatype_sp, value in control_metrics]
+        for definition in definitions:
+            metric = self.payload.metrics.add()
+            metric.CopyFrom(definition)
+            self._all_metrics.append(metric)
+        container = self.payload.metrics
+        if instance is not None:
+            metric = self.payload.metrics.add()
+            metric.name = instance[0]
+            metric.datatype = sparkplug.MetricDataType.Template
+            metric.template_value.template_ref = instance[1]
+            metric.template_value.is_definition = False
+            self._all_metrics.append(metric)
+            container = metric.template_value.metrics
+        self._metrics = []
+        self._codecs = []
+        for schema in schemas:
+            metric = container.add()
+            metric.name = schema.name
+            if schema.alias is not None:
+                metric.alias = schema.alias
+            metric.datatype = schema.datatype_sp
+            if schema.properties and instance is None:
+                metric.properties.CopyFrom(self._property_set(schema.properties))
+            self._all_metrics.append(metric)
+            self._metrics.append(metric)
+            self._codecs.append(CODECS[schema.datatype_sp])
+
+    @classmethod
+    def _property_set(cls, properties: tuple) -> sparkplug_b_pb2.Payload.PropertySet:
+        key = tuple(map(id, properties))
+        cached = cls._property_sets.get(key)
+        if cached is None:
+            property_set = sparkplug_b_pb2.Payload.PropertySet()
+            property_set.keys.extend([prop.name for prop in properties])
+            for prop in properties:
+                sp_prop = property_set.values.add()
+                sp_prop.type = prop.datatype_sp
+                CODECS[prop.datatype_sp].set_value(sp_prop, prop.value)
+            cached = cls._property_sets[key] = (properties, property_set)
+        return cached[1]
+
+    @classmethod
+    def template_definition(cls, name: str, template: dict) -> sparkplug_b_pb2.Payload.Metric:
+        """
+        Builds the NBIRTH metric defining a Sparkplug Template from its birth certificate entry, with the datatype,
+        properties and initial value of every member metric.
+
+        Args:
+        name (str): The name of the template.
+        template (dict): A dictionary with the structure template['metrics', 'version'].
+        """
+        definition = sparkplug_b_pb2.Payload.Metric()
+        definition.name = name
+        definition.datatype = sparkplug.MetricDataType.Template
+        definition.template_value.is_definition = True
+        if 'version' in template:
+            definition.template_value.version = template['version']
+        for metric_name, entry in template['metrics'].items():
+            schema = MetricSchema.from_certificate(metric_name, entry)
+            metric = definition.template_value.metrics.add()
+            metric.name = metric_name
+            metric.datatype = schema.datatype_sp
+            if schema.properties:
+                metric.properties.CopyFrom(cls._property_set(schema.properties))
+            codec = CODECS[schema.datatype_sp]
+            if entry.get('value') is not None and not codec.message:
+                codec.set_value(metric, entry['value'])
+        return definition
+
+    def matches(self, schemas: Sequence[MetricSchema]) -> bool:
+        """
+        Returns True if the template was built for exactly these schemas.
+        """
+        return len(schemas) == len(self.schemas) and all(a is b for a, b in zip(schemas, self.schemas))
+
+    def fill(self, values: Sequence, seq: int, timestamp: int) -> sparkplug_b_pb2.Payload:
+        """
+        Sets the values of the metrics, in the order of the schemas, and returns the payload. The payload is only
+        valid until the next call.
+        """
+        payload = self.payload
+        payload.timestamp = timestamp
+        payload.seq = seq
+        for metric in self._all_metrics:
+            metric.timestamp = timestamp
+        for metric, codec, value in zip(self._metrics, self._codecs, values):
+            codec.set_value(metric, value)
+        return payload
+
 class Client(mqtt.Client):
-    def __init__(self, client_id):
+    def __init__(self, client_id, event_capacity: int = 1024, event_overflow_policy: str = EventRingBuffer.DROP_OLDEST, clock: Clock = None):
         super().__init__(client_id)
         self.state = None
-        self.event_buffer = []
+        # Sampled once per publish cycle for the timestamps of payloads and their metrics
+        self.clock = clock or Clock()
+        # Inbound NCMD/DCMD events for inbound_events(). See EventRingBuffer for the overflow policies
+        self.event_buffer = EventRingBuffer(event_capacity, event_overflow_policy)
+        self._event_batch = []
+        self._payload_templates = {}
+        self._birth_templates = {}
+        # Send metric aliases instead of names in NDATA/DDATA messages
+        self.use_aliases = True
+        # Encode NDATA/DDATA with WireEncoder rather than building protobuf messages
+        self.use_wire_encoder = False
+        self._wire_encoder = None
+        # Set to a CompressionPolicy to compress outbound payloads, see compression.py
+        self.compression: CompressionPolicy = None
+        # Maximum size in bytes of an NDATA/DDATA payload, e.g. to stay under the broker's maximum packet size.
+        # Larger sets of changes are split across consecutive messages. None for no limit
+        self.max_payload_size: int = None
+        # Files being sent by send_file(), and the number of chunks publish_changes() sends after the changes
+        self.file_transfers: List[FileTransfer] = []
+        self.transfer_chunks_per_publish = 1
         self.birth_certificate = None
         self.connected = False
         self.on_connect = self.sp_on_connect
@@ -344,6 +1401,21 @@ class Client(mqtt.Client):
         self.bd_seq = None
         self.handle_ncmd = self._handle_ncmd_default
         self.handle_dcmd = self._handle_dcmd_default
+        # publish_changes() and births run on both the caller's thread and paho's network thread. This lock keeps
+        # sequence numbers in publish order. The state is not locked while payloads are encoded.
+        self._publish_lock = threading.RLock()
+        # Background publishing by scan class, see start_scan_scheduler(). scan_interval is the publish period of a
+        # birth certificate without scan classes
+        self.scan_interval = 0.5
+        self._scan_thread = None
+        self._scan_wake = threading.Event()
+        self._scan_stopping = False
+        # Publishes changes held back by their minimum publish interval when it expires, if the scheduler is not
+        # running to do so. One thread waits for _flush_due, the clock.monotonic() time of the earliest expiry
+        self._flush_thread = None
+        self._flush_wake = threading.Event()
+        self._flush_stopping = False
+        self._flush_due = None
 
 
     @staticmethod
@@ -355,18 +1427,25 @@ class Client(mqtt.Client):
         client.subscribe(f"{NAMESPACE}/{client.group_id}/DCMD/{client.node_id}/#")
         client.connected = True
         client._publish_birth()
+        client._scan_wake.set()
 
     @staticmethod
     def sp_on_subscribe(client, userdata, mid, granted_qos):
         pass
         # print(f'Subscribed to "{"something"}"')
 
-    def set_birth_certificate(self, birth_certificate: BirthCertificate): 
+    def set_birth_certificate(self, birth_certificate: BirthCertificate, state_class: type = State, timestamp_writes: bool = False): 
         # Save birth certificate as a property
         self.birth_certificate = birth_certificate
         
-        # Initialise state
-        self.state = State(self.birth_certificate)
+        # Initialise state. state_class selects the value store, e.g. columnar_state.ColumnarState for large sites.
+        # timestamp_writes publishes changes with the time they were written rather than the time of the publish
+        self.state = state_class(self.birth_certificate, self.clock, timestamp_writes)
+        # NDATA/DDATA payloads reused between publishes, keyed by device name or None for the node
+        self._payload_templates = {}
+        self._wire_encoder = None
+        # NBIRTH/DBIRTH payloads, keyed by device name or None for the node
+        self._birth_templates = {}
 
     def set_id(self, group_id, node_id):
         # Set the group id and node id for this client
@@ -374,7 +1453,7 @@ class Client(mqtt.Client):
         self.node_id = node_id
         self.will_set(
             f'{NAMESPACE}/{group_id}/NDEATH/{node_id}',
-            bytearray(sparkplug.getNodeDeathPayload().SerializeToString())
+            bytearray(sparkplug.getNodeDeathPayload(self.clock.now_ms()).SerializeToString())
             )
 
     def connect(self, host, port, keep_alive=60):
@@ -388,9 +1467,16 @@ class Client(mqtt.Client):
         self.loop_start()
 
     def disconnect(self):
+        # The scheduler must not publish between the final flush and NDEATH
+        self.stop_scan_scheduler()
+        self._stop_flush_waiter()
+        # Changes held back by their minimum publish interval or scan class are never lost
+        if self.connected:
+            self.publish_changes(flush=True)
+
         death_topic = f'{NAMESPACE}/{self.group_id}/NDEATH/{self.node_id}'
         payload = sparkplug_b_pb2.Payload()
-        sparkplug.addMetric(payload, "bdSeq", None, sparkplug.MetricDataType.Int64, 0)
+        sparkplug.addMetric(payload, "bdSeq", None, sparkplug.MetricDataType.Int64, 0, self.clock.now_ms())
 
         death_payload_bytes = bytearray(payload.SerializeToString())
         self.publish(death_topic, death_payload_bytes)
@@ -406,7 +1492,18 @@ class Client(mqtt.Client):
         # Placeholder for user handler
         return True
 
+    def _resolve_aliases(self, device_name: str, inbound_payload):
+        # Commands may identify metrics by alias alone. Fill in their names so they can be handled like any other
+        for metric in inbound_payload.metrics:
+            if not metric.name and metric.HasField('alias'):
+                owner, metric_name = self.state.aliases.get(metric.alias, (None, None))
+                if metric_name is None or owner != device_name:
+                    print(f"Received command with invalid alias {metric.alias}. Ignoring this metric.")
+                    continue
+                metric.name = metric_name
+
     def _handle_ncmd(self, inbound_payload):
+        self._resolve_aliases(None, inbound_payload)
         for metric in inbound_payload.metrics:
             if metric.name == "Node Control/Next Server":
                 # 'Node Control/Next Server' is an NCMD used to tell the device/client application to
@@ -419,8 +1516,7 @@ class Client(mqtt.Client):
                 # its full NBIRTH and DBIRTH again.  MQTT Engine will send this NCMD to a device/client
                 # application if it receives an NDATA or DDATA with a metric that was not published in the
                 # original NBIRTH or DBIRTH.  This is why the application must send all known metrics in
-                # its original NBIRTH and DBIRTH messages.
-                self.set_seq(0)
+                # its original NBIRTH and DBIRTH messages. The NBIRTH resets the sequence number.
                 self._publish_birth()
             elif metric.name == "Node Control/Reboot":
 
@@ -431,10 +1527,8 @@ class Client(mqtt.Client):
                 new_value = self.metric_value_from_type(metric, self.state.node_metrics[metric.name].datatype_sp)
                 
                 # Appnd to metric change event bufffer so that user can get new events from .inbound_events()
-                metric_copy = copy.deepcopy(self.state.node_metrics[metric.name])
-                metric_copy.value = new_value
-                event = MetricChangeEvent(metric.name, metric_copy)
-                # self.event_buffer.append(event)
+                event = MetricChangeEvent(metric.name, Metric(self.state.node_metrics[metric.name].schema, new_value))
+                self.event_buffer.push(event)
                 
                 # Run user command handler to check whether to update state
                 if not self.handle_ncmd(event):
@@ -453,28 +1547,32 @@ class Client(mqtt.Client):
             print(f"Received DCMD with invalid device id {device_name}. Ignoring.")
             return
         
+        self._resolve_aliases(device_name, inbound_payload)
+        prefix = self.state.metric_prefix(device_name)
         metric_changes = []
         for metric in inbound_payload.metrics:
+            if prefix and metric.name.startswith(prefix):
+                # A member of the Template instance, named as in DDATA
+                metric.name = metric.name[len(prefix):]
             if metric.name not in self.state.devices[device_name].metrics:
                 print(f"Received DCMD with invalid metric {metric.name}. Ignoring this metric.")
+                continue
             
             # Get value
             new_value = self.metric_value_from_type(metric, self.state.devices[device_name].metrics[metric.name].datatype_sp)
 
             # Appnd to metric change event buffer so that user can get new events from .inbound_events()
-            metric_copy = copy.deepcopy(self.state.devices[device_name].metrics[metric.name])
-            metric_copy.value = new_value
-            metric_changes.append(MetricChangeEvent(metric.name, metric_copy))
+            metric_changes.append(MetricChangeEvent(metric.name, Metric(self.state.devices[device_name].metrics[metric.name].schema, new_value)))
 
         if metric_changes:
             event = DeviceChangeEvent(device_name, metric_changes)
-            # self.event_buffer.append(event)
+            self.event_buffer.push(event)
 
             # Run user command handler to check whether to update state
             if self.handle_dcmd(event):
-                # Update state
+                # Update state in one batch so the command is never published half applied
+                self.state.set_device_metrics(device_name, {change.metric_name: change.new_value for change in event.metric_changes})
                 for change in event.metric_changes:
-                    self.state.set_device_metric(device_name, change.metric_name, change.new_value)
                     print(f'Set {self.group_id}/{self.node_id}/{device_name}/{change.metric_name} to {change.new_value}')
 
     @staticmethod
@@ -485,6 +1583,11 @@ class Client(mqtt.Client):
         if tokens[0] == "spBv1.0" and tokens[1] == client.group_id and tokens[3] == client.node_id:
             inbound_payload = sparkplug_b_pb2.Payload()
             inbound_payload.ParseFromString(msg.payload)
+            try:
+                inbound_payload = decompress_payload(inbound_payload)
+            except Exception as e:
+                print(f"Received {msg.topic} with a payload that could not be decompressed: {e}. Ignoring.")
+                return
             if tokens[2] == 'NCMD': 
                 client._handle_ncmd(inbound_payload)
             elif tokens[2] == 'DCMD':
@@ -494,115 +1597,311 @@ class Client(mqtt.Client):
         client.publish_changes()
 
 
-    def _publish_node_birth(self):
-        # Create the node birth payload
-        payload = sparkplug_b_pb2.Payload()
-        payload.timestamp = int(round(time.time() * 1000))
-        payload.seq = 0
-        self.set_seq(payload.seq)
-        # TODO track bdSeq over multiple birth-death cycles 
-        sparkplug.addMetric(payload, "bdSeq", None, sparkplug.MetricDataType.Int64, 0)
-        
-
-        # Add node control metrics to payload
-        sparkplug.addMetric(payload, "Node Control/Next Server", None, sparkplug.MetricDataType.Boolean, False)
-        sparkplug.addMetric(payload, "Node Control/Rebirth", None, sparkplug.MetricDataType.Boolean, False)
-        sparkplug.addMetric(payload, "Node Control/Reboot", None, sparkplug.MetricDataType.Boolean, False)
+    def _birth_payload(self, device_name: str, seq: int, timestamp: int) -> sparkplug_b_pb2.Payload:
+        # Fill the cached birth template of the node (device_name=None) or a device with the current values. The
+        # template is only rebuilt if the schemas of its metrics have changed
+        snapshot = self.state.birth_snapshot(device_name)
+        schemas = tuple(metric.schema for metric, _ in snapshot)
+        template = self._birth_templates.get(device_name)
+        if template is None or not template.matches(schemas):
+            if device_name is None:
+                # Every template is defined once in the NBIRTH, its instances reference it in their DBIRTH
+                definitions = [BirthTemplate.template_definition(name, entry) for name, entry in self.birth_certificate.templates.items()]
+                template = BirthTemplate(schemas, NODE_CONTROL_METRICS, definitions)
+            else:
+                template_name = self.birth_certificate.device_templates.get(device_name)
+                template = BirthTemplate(schemas, instance=None if template_name is None else (device_name, template_name))
+            self._birth_templates[device_name] = template
+        return template.fill([value for _, value in snapshot], seq, timestamp)
 
-        # Add metrics from state to payload
-        for metric_name, metric in self.state.node_metrics.items():
-            sp_metric = sparkplug.addMetric(payload, metric_name, None, metric.datatype_sp, metric.value)
-            
-            # Add properties to metric
-            if metric.properties:
-                sp_metric.properties.keys.extend([prop.name for prop in metric.properties])
-                for prop in metric.properties:
-                    sp_prop = sp_metric.properties.values.add()
-                    sp_prop.type = prop.datatype_sp
-                    # This is dumb
-                    if sp_prop.type == sparkplug.ParameterDataType.Boolean:
-                        sp_prop.boolean_value = prop.value
-                    elif sp_prop.type == sparkplug.ParameterDataType.String:
-                        sp_prop.string_value = prop.value
-                    else:
-                        sp_prop.int_value = prop.value
+    def _publish_node_birth(self, timestamp: int = None):
+        # The NBIRTH resets the sequence number
+        self.set_seq(0)
+        payload = self._birth_payload(None, 0, self.clock.now_ms() if timestamp is None else timestamp)
 
         # Publish the node birth certificate
-        byteArray = bytearray(payload.SerializeToString())
-        self.publish(f"spBv1.0/{self.group_id}/NBIRTH/{self.node_id}", byteArray, 0, False)
+        self._publish_payload('NBIRTH', f"spBv1.0/{self.group_id}/NBIRTH/{self.node_id}", payload.SerializeToString(), payload.seq, payload.timestamp)
         print(f'Published NBIRTH payload.seq = {payload.seq}')
 
-    def _publish_device_birth(self, device_name: str):
-        # Get the payload
-        payload = sparkplug_b_pb2.Payload()
-        payload.timestamp = int(round(time.time() * 1000))
-        payload.seq = self.next_seq()
-
-        # Add metrics from state for the given device
-        for metric_name, metric in self.state.devices[device_name].metrics.items():
-            sp_metric = sparkplug.addMetric(payload, metric_name, None, metric.datatype_sp, metric.value)
-
-            # Add properties to metric
-            if metric.properties:
-                sp_metric.properties.keys.extend([prop.name for prop in metric.properties])
-                for prop in metric.properties:
-                    sp_prop = sp_metric.properties.values.add()
-                    sp_prop.type = prop.datatype_sp
-                    # This is dumb
-                    if sp_prop.type == sparkplug.ParameterDataType.Boolean:
-                        sp_prop.boolean_value = prop.value
-                    elif sp_prop.type == sparkplug.ParameterDataType.String:
-                        sp_prop.string_value = prop.value
-                    else:
-                        sp_prop.int_value = prop.value
+    def _publish_device_birth(self, device_name: str, timestamp: int = None):
+        payload = self._birth_payload(device_name, self.next_seq(), self.clock.now_ms() if timestamp is None else timestamp)
 
         # Publish the device birth certificate
-        byteArray = bytearray(payload.SerializeToString())
-        self.publish(f"spBv1.0/{self.group_id}/DBIRTH/{self.node_id}/{device_name}", byteArray, 0, False)
+        self._publish_payload('DBIRTH', f"spBv1.0/{self.group_id}/DBIRTH/{self.node_id}/{device_name}", payload.SerializeToString(), payload.seq, payload.timestamp)
         print(f'Published DBIRTH payload.seq = {payload.seq}')
 
     
     def _publish_birth(self):
-        self._publish_node_birth()
-        for device_name in self.birth_certificate.devices:
-            self._publish_device_birth(device_name)
+        with self._publish_lock:
+            # The NBIRTH and every DBIRTH carry the same time
+            timestamp = self.clock.now_ms()
+            self._publish_node_birth(timestamp)
+            for device_name in self.birth_certificate.devices:
+                self._publish_device_birth(device_name, timestamp)
+
+    def publish_changes(self, flush: bool = False):
+        # Publish changes in state since last call. get_changes() returns a snapshot of the changed values, so
+        # writers on other threads are not blocked while the payloads are encoded. flush publishes every pending
+        # change, regardless of scan classes and minimum publish intervals
+        with self._publish_lock:
+            node_changes, device_changes = self.state.get_changes(flush)
+            # One clock sample for every payload and metric of the cycle
+            timestamp = self.clock.now_ms()
+
+            if node_changes:
+                self.publish_node_changes(node_changes, timestamp)
+
+            if device_changes:
+                self.publish_device_changes(device_changes, timestamp)
+
+            # File chunks go after the changes, so a large transfer never holds back data
+            if self.file_transfers:
+                self._publish_file_chunks(timestamp)
+
+            # Changes held back by their minimum publish interval are published when it expires, even if nothing
+            # calls publish_changes() again
+            if self._scan_thread is None:
+                self._schedule_flush()
+
+    def _schedule_flush(self):
+        delay = self.state.pending_delay()
+        if delay is None:
+            return
+        due = self.clock.monotonic() + delay
+        # The waiter is only woken when the earliest expiry moves earlier, not on every publish
+        if self._flush_due is not None and self._flush_due <= due:
+            return
+        self._flush_due = due
+        if self._flush_thread is None:
+            self._flush_stopping = False
+            self._flush_wake.clear()
+            self._flush_thread = threading.Thread(target=self._run_flush_waiter, name='flush waiter', daemon=True)
+            self._flush_thread.start()
+        else:
+            self._flush_wake.set()
 
-    def publish_changes(self):
-        # Publish changes in state since last call
-        node_changes, device_changes = self.state.get_changes()
+    def _stop_flush_waiter(self):
+        if self._flush_thread is None:
+            return
+        self._flush_stopping = True
+        self._flush_wake.set()
+        if self._flush_thread is not threading.current_thread():
+            self._flush_thread.join()
+        self._flush_thread = None
+        self._flush_due = None
+
+    def _run_flush_waiter(self):
+        while not self._flush_stopping:
+            due = self._flush_due
+            delay = None if due is None else due - self.clock.monotonic()
+            if delay is None or delay > 0:
+                self._flush_wake.wait(delay)
+                self._flush_wake.clear()
+                continue
+            # publish_changes() schedules the next expiry, if any change is still held back. Like the scan
+            # scheduler, nothing is published while disconnected, and the births publish the latest values
+            self._flush_due = None
+            if self.connected:
+                self.publish_changes()
+
+    def start_scan_scheduler(self):
+        """
+        Starts a background thread that calls `publish_changes()` whenever a scan class is due, so that the metrics
+        of each class are published at the period of their class. The caller only writes values to the state.
+        """
+        if self._scan_thread is not None:
+            return
+        # The scheduler publishes held back changes itself
+        self._stop_flush_waiter()
+        self._scan_stopping = False
+        self._scan_wake.clear()
+        self._scan_thread = threading.Thread(target=self._run_scan_scheduler, name='scan scheduler', daemon=True)
+        self._scan_thread.start()
+
+    def stop_scan_scheduler(self):
+        """
+        Stops the thread started by `start_scan_scheduler()` and waits for it to finish.
+        """
+        if self._scan_thread is None:
+            return
+        self._scan_stopping = True
+        self._scan_wake.set()
+        self._scan_thread.join()
+        self._scan_thread = None
+        self._schedule_flush()
 
-        if node_changes:
-            self.publish_node_changes(node_changes)
+    def set_scan_period(self, scan_class: str, period: float):
+        """
+        Changes the publish period of a scan class at runtime, see `State.set_scan_period`.
+        """
+        self.state.set_scan_period(scan_class, period)
+        # The scheduler may be waiting for the old period to elapse
+        self._scan_wake.set()
+
+    def _run_scan_scheduler(self):
+        while not self._scan_stopping:
+            if not self.connected:
+                # Nothing is published while disconnected, changes wait in the state until sp_on_connect() wakes
+                # the scheduler
+                self._scan_wake.wait(self.scan_interval)
+                self._scan_wake.clear()
+                continue
+            self.publish_changes()
+            # Sleep until the next scan class is due or a held back change may be published
+            delays = [delay for delay in (self.state.next_scan_delay(), self.state.pending_delay()) if delay is not None]
+            self._scan_wake.wait(min(delays) if delays else self.scan_interval)
+            self._scan_wake.clear()
+
+    def send_file(self, device_name: str, metric_name: str, path: str, chunk_size: int = 64*1024, offset: int = 0, content_type: str = None) -> FileTransfer:
+        """
+        Starts sending a file as ordered chunks of a File or Bytes metric. Each call to `publish_changes()` publishes
+        up to `transfer_chunks_per_publish` chunks after the changes, taking turns between transfers, until the file
+        has been sent. Pass device_name=None for a node metric.
 
-        if device_changes:
-            self.publish_device_changes(device_changes)
+        Args:
+        device_name (str): The name of the device, or None for the node.
+        metric_name (str): The name of a File or Bytes metric in the birth certificate.
+        path (str): The path of the file.
+        chunk_size (int): The number of bytes of the file in each message.
+        offset (int): The offset to resume from, e.g. the `offset` reached by an interrupted transfer.
+        content_type (str): The MIME type of the file, if known.
+
+        Returns:
+        FileTransfer: The transfer, with its progress and current offset.
+
+        Raises:
+        ValueError: If the metric is not found or is not a File or Bytes metric, or if a chunk would not fit in
+            max_payload_size.
+        """
+        metrics = self.state.node_metrics if device_name is None else self.state.devices[device_name].metrics if device_name in self.state.devices else None
+        if metrics is None:
+            raise ValueError(f"Device {device_name} not found in devices")
+        if metric_name not in metrics:
+            raise ValueError(f"Metric {metric_name} not found in {device_name or 'node'} metrics")
+        metric = metrics[metric_name]
+        if metric.datatype_sp not in (sparkplug.MetricDataType.File, sparkplug.MetricDataType.Bytes):
+            raise ValueError(f"Metric {metric_name} must be of type file or bytes, not {metric.datatype_str}")
+        # Named like the changes of the device, see State.metric_prefix()
+        name = self.state.metric_prefix(device_name) + metric_name
+        transfer = FileTransfer(path, device_name, name, metric.alias if self.use_aliases else None, metric.datatype_sp, chunk_size, offset, content_type)
+        if self.max_payload_size is not None:
+            # Chunks are never split, the data and everything around it must fit in one payload
+            payload_size = transfer.max_payload_size(self.clock.now_ms())
+            if payload_size > self.max_payload_size:
+                transfer.close()
+                raise ValueError(f"Chunks of {chunk_size} bytes encode to payloads of up to {payload_size} bytes, more than max_payload_size={self.max_payload_size}")
+        with self._publish_lock:
+            self.file_transfers.append(transfer)
+        return transfer
+
+    def cancel_file_transfer(self, transfer: FileTransfer):
+        """
+        Stops sending a file. `transfer.offset` is where a new transfer of the file can resume from.
+        """
+        with self._publish_lock:
+            if transfer in self.file_transfers:
+                self.file_transfers.remove(transfer)
+                transfer.close()
+
+    def _publish_file_chunks(self, timestamp: int):
+        for _ in range(self.transfer_chunks_per_publish):
+            if not self.file_transfers:
+                return
+            # Round robin, so one large file does not hold back the others
+            transfer = self.file_transfers.pop(0)
+            seq = self.next_seq()
+            if transfer.device_name is None:
+                message_type, topic = 'NDATA', f'{NAMESPACE}/{self.group_id}/NDATA/{self.node_id}'
+            else:
+                message_type, topic = 'DDATA', f'{NAMESPACE}/{self.group_id}/DDATA/{self.node_id}/{transfer.device_name}'
+            self._publish_payload(message_type, topic, transfer.encode_chunk(seq, timestamp), seq, timestamp)
+            if transfer.done:
+                print(f'Sent {transfer.path} ({transfer.size} bytes in {transfer.chunks_sent} chunks)')
+                transfer.close()
+            else:
+                self.file_transfers.append(transfer)
         
-    def publish_node_changes(self, node_changes: List[MetricChangeEvent]):
-        payload = sparkplug.Payload()
-        payload.seq = self.next_seq()
+    def _payload_template(self, device_name: str) -> PayloadTemplate:
+        template = self._payload_templates.get(device_name)
+        if template is None:
+            template = self._payload_templates[device_name] = PayloadTemplate(prefix=self.state.metric_prefix(device_name))
+        template.use_aliases = self.use_aliases
+        return template
+
+    def _encode_changes(self, device_name: str, changes: List[MetricChangeEvent], timestamp: int) -> List[Tuple[int, bytes]]:
+        """
+        Encodes an NDATA (device_name=None) or DDATA payload with the encoder selected for this client. If the
+        payload would be larger than max_payload_size, the changes are split across several payloads.
 
-        for change in node_changes:
-            sparkplug.addMetric(payload, change.metric_name, None, change.datatype_sp, change.new_value)
-        topic = f'{NAMESPACE}/{self.group_id}/NDATA/{self.node_id}'
-        self.publish(topic, bytearray(payload.SerializeToString()))
+        Returns:
+        List[Tuple[int, bytes]]: The seq and encoded payload of each message, in publish order.
+        """
+        max_size = self.max_payload_size
+        if self.use_wire_encoder:
+            if self._wire_encoder is None or self._wire_encoder.use_aliases != self.use_aliases:
+                self._wire_encoder = WireEncoder(self.state, self.use_aliases)
+            if max_size is None:
+                # Sequence numbers are only taken once the payload is known to be encodable
+                payload_bytes = self._wire_encoder.encode(device_name, changes, (self.payload_seq + 1) % 256, timestamp)
+                if payload_bytes is not None:
+                    return [(self.next_seq(), payload_bytes)]
+            else:
+                metrics = self._wire_encoder.encode_metrics(device_name, changes, timestamp)
+                if metrics is not None:
+                    return self._split_payload(metrics, timestamp)
 
-    def publish_device_changes(self, device_changes: List[DeviceChangeEvent]):
-        for device_change in device_changes:
-            payload = sparkplug.getDdataPayload()
+        # Measure with the largest seq, then set the real one once the payload is known to fit
+        payload = self._payload_template(device_name).fill(changes, 255, timestamp)
+        if max_size is None or payload.ByteSize() <= max_size:
             payload.seq = self.next_seq()
+            return [(payload.seq, payload.SerializeToString())]
+        # The payload is never serialized as a whole, each metric is encoded once and the payloads are assembled
+        metrics = [PAYLOAD_METRIC_TAG + encode_varint(metric.ByteSize()) + metric.SerializeToString() for metric in payload.metrics]
+        return self._split_payload(metrics, timestamp)
+
+    def _split_payload(self, metrics: List[bytes], timestamp: int) -> List[Tuple[int, bytes]]:
+        overhead = payload_overhead(timestamp)
+        messages = []
+        for group in split_metrics(metrics, self.max_payload_size, overhead):
+            if overhead + len(group[0]) > self.max_payload_size:
+                print(f"WARNING: a metric of {len(group[0])} bytes does not fit in max_payload_size={self.max_payload_size}. Publishing it on its own.")
+            seq = self.next_seq()
+            messages.append((seq, encode_payload(group, seq, timestamp)))
+        return messages
+
+    def _publish_payload(self, message_type: str, topic: str, payload_bytes: bytes, seq: int, timestamp: int):
+        # Publishes an encoded payload, compressed if the compression policy applies to it
+        if self.compression is not None:
+            payload_bytes = self.compression.compress(message_type, payload_bytes, seq, timestamp)
+        self.publish(topic, bytearray(payload_bytes), 0, False)
+
+    def publish_node_changes(self, node_changes: List[MetricChangeEvent], timestamp: int = None):
+        if timestamp is None:
+            timestamp = self.clock.now_ms()
+        topic = f'{NAMESPACE}/{self.group_id}/NDATA/{self.node_id}'
+        for seq, payload_bytes in self._encode_changes(None, node_changes, timestamp):
+            self._publish_payload('NDATA', topic, payload_bytes, seq, timestamp)
 
+    def publish_device_changes(self, device_changes: List[DeviceChangeEvent], timestamp: int = None):
+        if timestamp is None:
+            timestamp = self.clock.now_ms()
+        for device_change in device_changes:
             device_name = device_change.device_id
-            for metric_change in device_change.metric_changes:
-                sparkplug.addMetric(payload, metric_change.metric_name, None, metric_change.datatype_sp, metric_change.new_value)
             topic = f'{NAMESPACE}/{self.group_id}/DDATA/{self.node_id}/{device_name}'
+            for seq, payload_bytes in self._encode_changes(device_name, device_change.metric_changes, timestamp):
+                self._publish_payload('DDATA', topic, payload_bytes, seq, timestamp)
 
-            self.publish(topic, bytearray(payload.SerializeToString()))
+    def inbound_events(self, clear_buffer=True, max_events: int = None) -> list:
+        """
+        Returns the NCMD/DCMD events received since the last call, oldest first. The same list object is reused
+        by every call, so process or copy the events before calling again.
 
-    def inbound_events(self, clear_buffer=True):
-        events = self.event_buffer
-        if clear_buffer:
-            self.event_buffer = []
-        return events
+        Args:
+        clear_buffer (bool): If False, the events are returned but left in the buffer.
+        max_events (int): The maximum number of events to return, or None for all of them.
+        """
+        self._event_batch.clear()
+        return self.event_buffer.drain(self._event_batch, max_events, clear_buffer)
 
     def set_seq(self, new_seq):
         self.payload_seq = new_seq
@@ -621,29 +1920,5 @@ class Client(mqtt.Client):
 
     @staticmethod
     def metric_value_from_type(metric, data_type: sparkplug.MetricDataType):
-        if data_type == sparkplug.MetricDataType.Boolean:
-            return metric.boolean_value
-        elif data_type == sparkplug.MetricDataType.Int8:
-            return metric.int_value
-        elif data_type == sparkplug.MetricDataType.UInt8:
-            return metric.uint_value
-        elif data_type == sparkplug.MetricDataType.Int16:
-            return metric.int_value
-        elif data_type == sparkplug.MetricDataType.UInt16:
-            return metric.uint_value
-        elif data_type == sparkplug.MetricDataType.Int32:
-            return metric.int_value
-        elif data_type == sparkplug.MetricDataType.UInt32:
-            return metric.uint_value
-        elif data_type == sparkplug.MetricDataType.Int64:
-            return metric.int_value
-        elif data_type == sparkplug.MetricDataType.UInt64:
-            return metric.long_value
-        elif data_type == sparkplug.MetricDataType.Float:
-            return metric.float_value
-        elif data_type == sparkplug.MetricDataType.Double:
-            return metric.float_val
-        elif data_type == sparkplug.MetricDataType.String:
-            return metric.string_value
-        else:
-            return None
\ No newline at end of file
+        codec = CODECS.get(data_type)
+        return None if codec is None else codec.get_value(metric)
\ No newline at end of file
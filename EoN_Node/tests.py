@@ -1,8 +1,27 @@
+import contextlib
+import datetime
+import gzip
+import io
 import os
-
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
+import unittest.mock
+import uuid
+import zlib
+import numpy as np
 import sparkplug_b as sparkplug
+import sparkplug_b_pb2
 from sparkplug_client import *
+from columnar_state import ColumnarState
+from wire_encoder import WireEncoder
+from compression import *
+from dataset import DataSet
+from file_transfer import FileTransfer
+from clock import ManualClock
 
 class TestState(unittest.TestCase):
 
@@ -158,8 +177,1955 @@ class TestBirthCertificate(unittest.TestCase):
             BirthCertificate.get_metric_datatype("invalid")
 
 
+def make_birth_certificate():
+    node_metrics = {
+        "temperature": {"datatype": "float", "value": 0.0},
+        "is_active": {"datatype": "bool", "value": False},
+    }
+    devices = {
+        "device1": {"metrics": {
+            "ac/voltage": {"datatype": "float", "value": 0.0},
+            "ac/current": {"datatype": "float", "value": 0.0},
+            "dc/power": {"datatype": "double", "value": 0.0},
+        }},
+        "device2": {"metrics": {
+            "status": {"datatype": "string", "value": "OK"},
+            "count": {"datatype": "int32", "value": 0},
+        }},
+    }
+    return BirthCertificate(node_metrics, devices)
+
+class TestChangeTracking(unittest.TestCase):
+
+    def setUp(self):
+        self.state = State(make_birth_certificate())
+
+    def test_no_writes_no_changes(self):
+        node_changes, device_changes = self.state.get_changes()
+        self.assertEqual(node_changes, [])
+        self.assertEqual(device_changes, [])
+
+    def test_only_changed_metrics_reported(self):
+        self.state.set_node_metric("temperature", 25.5)
+        self.state.set_node_metric("is_active", False)
+        self.state.set_device_metric("device1", "ac/voltage", 230.0)
+        node_changes, device_changes = self.state.get_changes()
+        self.assertEqual([(c.metric_name, c.new_value) for c in node_changes], [("temperature", 25.5)])
+        self.assertEqual(len(device_changes), 1)
+        self.assertEqual(device_changes[0].device_id, "device1")
+        self.assertEqual([(c.metric_name, c.new_value) for c in device_changes[0].metric_changes], [("ac/voltage", 230.0)])
+
+    def test_changes_cleared_after_get_changes(self):
+        self.state.set_device_metric("device2", "count", 3)
+        self.state.get_changes()
+        self.assertEqual(self.state.get_changes(), ([], []))
+        self.assertEqual(self.state.devices["device2"].dirty, {})
+
+    def test_write_back_to_published_value_is_not_a_change(self):
+        self.state.set_device_metric("device2", "status", "FAULT")
+        self.state.set_device_metric("device2", "status", "OK")
+        self.assertEqual(self.state.get_changes(), ([], []))
+
+    def test_compares_against_last_published_value(self):
+        self.state.set_device_metric("device2", "count", 3)
+        self.state.get_changes()
+        self.state.set_device_metric("device2", "count", 3)
+        self.assertEqual(self.state.get_changes(), ([], []))
+        self.state.set_device_metric("device2", "count", 4)
+        _, device_changes = self.state.get_changes()
+        self.assertEqual([c.new_value for c in device_changes[0].metric_changes], [4])
+
+
+class TestColumnarState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = ColumnarState(make_birth_certificate())
+
+    def test_values_stored_in_typed_columns(self):
+        self.assertEqual(self.state.columns[sparkplug.MetricDataType.Float].values.dtype, np.float32)
+        self.assertEqual(len(self.state.columns[sparkplug.MetricDataType.Float].values), 3)
+        self.state.set_device_metric("device2", "count", 7)
+        self.assertEqual(self.state.get_device_metric_value("device2", "count"), 7)
+        self.assertEqual(self.state.devices["device2"].metrics["count"].value, 7)
+
+    def test_get_changes(self):
+        self.state.set_node_metric("temperature", 25.5)
+        self.state.set_device_metric("device1", "dc/power", 1.5)
+        self.state.set_device_metric("device2", "status", "FAULT")
+        self.state.set_device_metric("device2", "count", 0)
+        node_changes, device_changes = self.state.get_changes()
+        self.assertEqual([(c.metric_name, c.new_value) for c in node_changes], [("temperature", 25.5)])
+        changes = {d.device_id: {c.metric_name: c.new_value for c in d.metric_changes} for d in device_changes}
+        self.assertEqual(changes, {"device1": {"dc/power": 1.5}, "device2": {"status": "FAULT"}})
+        self.assertEqual(self.state.get_changes(), ([], []))
+
+    def test_bulk_array_write(self):
+        names = ["ac/voltage", "ac/current"]
+        self.state.set_device_array("device1", names, np.array([230.0, 4.0]))
+        np.testing.assert_array_equal(self.state.get_device_array("device1", names), [230.0, 4.0])
+        _, device_changes = self.state.get_changes()
+        self.assertEqual({c.metric_name for c in device_changes[0].metric_changes}, set(names))
+
+    def test_index_requires_single_datatype(self):
+        with self.assertRaises(ValueError):
+            self.state.index("device1", ["ac/voltage", "dc/power"])
+        with self.assertRaises(ValueError):
+            self.state.index("device1", ["unknown_metric"])
+
+    def test_client_uses_state_class(self):
+        client = Client("test-client")
+        client.set_birth_certificate(make_birth_certificate(), ColumnarState)
+        self.assertIsInstance(client.state, ColumnarState)
+
+
+def make_deadband_birth_certificate():
+    node_metrics = {
+        "frequency": {"datatype": "float", "value": 50.0, "deadband": 0.01},
+        "voltage": {"datatype": "double", "value": 1000.0, "deadband_percent": 1, "max_silence": 60},
+    }
+    return BirthCertificate(node_metrics, {})
+
+class TestDeadband(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        self.state = self.state_class(make_deadband_birth_certificate())
+
+    def node_changes(self, now=None):
+        if now is None:
+            node_changes, _ = self.state.get_changes()
+        else:
+            with unittest.mock.patch('time.monotonic', return_value=now):
+                node_changes, _ = self.state.get_changes()
+        return {c.metric_name: c.new_value for c in node_changes}
+
+    def test_absolute_deadband(self):
+        self.state.set_node_metric("frequency", 50.005)
+        self.assertEqual(self.node_changes(), {})
+        self.assertEqual(self.state.suppressed_samples, 1)
+        self.state.set_node_metric("frequency", 50.25)
+        self.assertEqual(self.node_changes(), {"frequency": 50.25})
+        self.assertEqual(self.state.published_samples, 1)
+
+    def test_percent_deadband(self):
+        self.state.set_node_metric("voltage", 1005.0)
+        self.assertEqual(self.node_changes(), {})
+        self.state.set_node_metric("voltage", 1011.0)
+        self.assertEqual(self.node_changes(), {"voltage": 1011.0})
+
+    def test_slow_drift_compared_to_last_published_value(self):
+        for voltage in (1004.0, 1008.0, 1012.0):
+            self.state.set_node_metric("voltage", voltage)
+            changes = self.node_changes()
+        self.assertEqual(changes, {"voltage": 1012.0})
+        self.assertEqual(self.state.suppressed_samples, 2)
+
+    def test_max_silence_publishes_suppressed_change(self):
+        start = time.monotonic()
+        self.state.set_node_metric("voltage", 1001.0)
+        self.assertEqual(self.node_changes(start + 1), {})
+        self.assertEqual(self.node_changes(start + 61), {"voltage": 1001.0})
+        self.assertEqual(self.node_changes(start + 200), {})
+
+    def test_deadband_rejected_for_non_numeric_metric(self):
+        with self.assertRaises(ValueError):
+            self.state_class(BirthCertificate({"status": {"datatype": "string", "value": "", "deadband": 1}}, {}))
+
+class TestColumnarDeadband(TestDeadband):
+    state_class = ColumnarState
+
+
+class TestWireChangeDetection(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        self.state = self.state_class(make_birth_certificate())
+
+    def device_changes(self):
+        _, device_changes = self.state.get_changes()
+        return {d.device_id: {c.metric_name: c.new_value for c in d.metric_changes} for d in device_changes}
+
+    def test_float_change_below_float32_precision_not_published(self):
+        self.state.set_device_metric("device1", "ac/voltage", 230.0)
+        self.state.get_changes()
+        self.state.set_device_metric("device1", "ac/voltage", 230.0 + 1e-6)
+        self.assertEqual(self.device_changes(), {})
+        self.state.set_device_metric("device1", "ac/voltage", 230.5)
+        self.assertEqual(self.device_changes(), {"device1": {"ac/voltage": 230.5}})
+
+    def test_float_beyond_float32_range_saturates(self):
+        with np.errstate(over='ignore'):
+            self.state.set_device_metric("device1", "ac/voltage", 1e39)
+            self.assertEqual(list(self.device_changes()), ["device1"])
+            # Both values are infinity on the wire
+            self.state.set_device_metric("device1", "ac/voltage", 2e39)
+            self.assertEqual(self.device_changes(), {})
+            self.state.set_device_metric("device1", "ac/voltage", -1e39)
+            self.assertEqual(list(self.device_changes()), ["device1"])
+        self.assertEqual(sparkplug.CODECS[sparkplug.MetricDataType.Float].wire(-1e39), float('-inf'))
+
+    def test_nan_that_stays_nan_not_published(self):
+        self.state.set_device_metric("device1", "ac/voltage", float('nan'))
+        self.state.set_device_metric("device1", "dc/power", float('nan'))
+        self.assertEqual(sorted(self.device_changes()["device1"]), ["ac/voltage", "dc/power"])
+        self.state.set_device_metric("device1", "ac/voltage", float('nan'))
+        self.state.set_device_metric("device1", "dc/power", float('nan'))
+        self.assertEqual(self.device_changes(), {})
+        self.state.set_device_metric("device1", "dc/power", 1.0)
+        self.assertEqual(self.device_changes(), {"device1": {"dc/power": 1.0}})
+
+    def test_double_change_published(self):
+        self.state.set_device_metric("device1", "dc/power", 1e-9)
+        self.assertEqual(self.device_changes(), {"device1": {"dc/power": 1e-9}})
+
+    def test_out_of_range_integers_wrap(self):
+        state = self.state_class(BirthCertificate({"small": {"datatype": "int8", "value": 0}, "byte": {"datatype": "uint8", "value": 0}}, {}))
+        state.set_node_metric("small", 300)
+        state.handle(None, "byte").set(-1)
+        node_changes, _ = state.get_changes()
+        wire = {change.metric_name: sparkplug.CODECS[change.datatype_sp].wire(change.new_value) for change in node_changes}
+        self.assertEqual(wire, {"small": 44, "byte": 255})
+        # The same values on the wire are not changes
+        state.handle(None, "small").set(44)
+        state.set_node_metric("byte", 255)
+        self.assertEqual(state.get_changes(), ([], []))
+
+    def test_integer_fraction_not_published(self):
+        self.state.set_device_metric("device2", "count", 3)
+        self.state.get_changes()
+        self.state.set_device_metric("device2", "count", 3.4)
+        self.assertEqual(self.device_changes(), {})
+
+    def test_wire_values(self):
+        self.assertEqual(sparkplug.CODECS[sparkplug.MetricDataType.Int8].wire(-1), -1)
+        self.assertEqual(sparkplug.CODECS[sparkplug.MetricDataType.Int8].wire(200), -56)
+        self.assertEqual(sparkplug.CODECS[sparkplug.MetricDataType.UInt16].wire(70000), 4464)
+        self.assertEqual(sparkplug.CODECS[sparkplug.MetricDataType.Float].wire(0.1), np.float32(0.1))
+
+class TestColumnarWireChangeDetection(TestWireChangeDetection):
+    state_class = ColumnarState
+
+
+class TestMetricSchema(unittest.TestCase):
+
+    def test_properties_shared_between_metrics(self):
+        metric = {"datatype": "float", "value": 1.5, "properties": {"EngUnit": {"value": "V", "datatype": "string"}}}
+        state = State(BirthCertificate({"a": metric, "b": metric}, {}))
+        a, b = state.node_metrics["a"], state.node_metrics["b"]
+        self.assertIs(a.properties[0], b.properties[0])
+        self.assertEqual((a.name, a.datatype_str, a.value), ("a", "float", 1.5))
+        self.assertFalse(hasattr(a, '__dict__'))
+
+    def test_default_value(self):
+        self.assertEqual(Metric(MetricSchema("flag", sparkplug.MetricDataType.Boolean)).value, False)
+        self.assertEqual(Metric(MetricSchema("count", sparkplug.MetricDataType.Int32)).value, 0)
+
+    def test_property_cache_distinguishes_types(self):
+        self.assertIsNot(Property.get("ReadOnly", "bool", True), Property.get("ReadOnly", "int32", 1))
+
+
+class TestMetricHandle(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        self.state = self.state_class(make_birth_certificate())
+
+    def test_handle_writes_feed_change_detection(self):
+        voltage = self.state.handle("device1", "ac/voltage")
+        temperature = self.state.handle(None, "temperature")
+        voltage.set(230.0)
+        temperature.set(21.5)
+        self.assertEqual(voltage.get(), 230.0)
+        self.assertEqual(self.state.get_device_metric_value("device1", "ac/voltage"), 230.0)
+        node_changes, device_changes = self.state.get_changes()
+        self.assertEqual([(c.metric_name, c.new_value) for c in node_changes], [("temperature", 21.5)])
+        self.assertEqual([(c.metric_name, c.new_value) for c in device_changes[0].metric_changes], [("ac/voltage", 230.0)])
+        voltage.set(230.0)
+        self.assertEqual(self.state.get_changes(), ([], []))
+
+    def test_handles(self):
+        handles = self.state.handles("device2")
+        self.assertEqual(set(handles), {"status", "count"})
+        self.assertEqual(handles["status"].get(), "OK")
+
+    def test_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            self.state.handle("device1", "unknown_metric")
+        with self.assertRaises(ValueError):
+            self.state.handle("unknown_device", "ac/voltage")
+        with self.assertRaises(ValueError):
+            self.state.handle(None, "unknown_metric")
+
+class TestColumnarMetricHandle(TestMetricHandle):
+    state_class = ColumnarState
+
+
+class TestBulkUpdates(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        self.state = self.state_class(make_birth_certificate())
+
+    def changes(self):
+        node_changes, device_changes = self.state.get_changes()
+        changes = {d.device_id: {c.metric_name: c.new_value for c in d.metric_changes} for d in device_changes}
+        if node_changes:
+            changes[None] = {c.metric_name: c.new_value for c in node_changes}
+        return changes
+
+    def test_set_device_metrics_from_mapping(self):
+        self.state.set_device_metrics("device1", {"ac/voltage": 230.0, "ac/current": 4.0})
+        self.assertEqual(self.changes(), {"device1": {"ac/voltage": 230.0, "ac/current": 4.0}})
+
+    def test_set_device_metrics_from_sequences(self):
+        self.state.set_device_metrics("device2", ["status", "count"], ["FAULT", 2])
+        self.assertEqual(self.changes(), {"device2": {"status": "FAULT", "count": 2}})
+        with self.assertRaises(ValueError):
+            self.state.set_device_metrics("device2", ["status", "count"], ["FAULT"])
+
+    def test_set_node_metrics_and_devices(self):
+        self.state.set_node_metrics({"temperature": 20.5})
+        self.state.set_devices({"device1": {"ac/voltage": 230.0}, "device2": {"count": 1}})
+        self.assertEqual(self.changes(), {None: {"temperature": 20.5}, "device1": {"ac/voltage": 230.0}, "device2": {"count": 1}})
+
+    def test_invalid_batch_writes_nothing(self):
+        with self.assertRaises(ValueError):
+            self.state.set_devices({"device1": {"ac/voltage": 230.0}, "device2": {"unknown_metric": 1}})
+        with self.assertRaises(ValueError):
+            self.state.set_devices({"device1": {"ac/voltage": 230.0}, "unknown_device": {}})
+        self.assertEqual(self.state.get_device_metric_value("device1", "ac/voltage"), 0.0)
+        self.assertEqual(self.changes(), {})
+
+    def test_transaction_applied_on_exit(self):
+        with self.state.transaction() as tx:
+            tx.set_device_metrics("device1", {"ac/voltage": 230.0})
+            tx.set_node_metric("temperature", 20.5)
+            self.assertEqual(self.state.get_device_metric_value("device1", "ac/voltage"), 0.0)
+            self.assertEqual(self.changes(), {})
+        self.assertEqual(self.changes(), {None: {"temperature": 20.5}, "device1": {"ac/voltage": 230.0}})
+
+    def test_transaction_discarded_on_exception(self):
+        with self.assertRaises(RuntimeError):
+            with self.state.transaction() as tx:
+                tx.set_device_metric("device2", "count", 5)
+                raise RuntimeError("scan failed")
+        self.assertEqual(self.changes(), {})
+
+class TestColumnarBulkUpdates(TestBulkUpdates):
+    state_class = ColumnarState
+
+
+class RecordingClient(Client):
+    """
+    A Client that records published messages instead of sending them to a broker.
+    """
+
+    def __init__(self, client_id="test-client", clock=None):
+        super().__init__(client_id, clock=clock)
+        self.published = []
+        self.set_id("test-group", "test-node")
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published.append((topic, bytes(payload)))
+
+    def decoded(self):
+        # Like a host application, learn metric names from the births and fill them in on aliased data messages
+        messages = []
+        names = {}
+        for topic, payload_bytes in self.published:
+            payload = sparkplug_b_pb2.Payload()
+            payload.ParseFromString(payload_bytes)
+            payload = decompress_payload(payload)
+            for metric in payload.metrics:
+                if "BIRTH" in topic and metric.datatype == sparkplug.MetricDataType.Template and not metric.template_value.is_definition:
+                    # Template instance, its members carry the aliases of the metrics named "<instance>/<member>"
+                    names.update((member.alias, f"{metric.name}/{member.name}") for member in metric.template_value.metrics if member.HasField("alias"))
+                elif "BIRTH" in topic and metric.HasField("alias"):
+                    names[metric.alias] = metric.name
+                elif not metric.name and metric.HasField("alias"):
+                    metric.name = names[metric.alias]
+            messages.append((topic, payload))
+        return messages
+
+class TestConcurrency(unittest.TestCase):
+    state_class = State
+    n = 2000
+
+    def test_concurrent_writers_and_commands(self):
+        client = RecordingClient()
+        client.set_birth_certificate(make_birth_certificate(), self.state_class)
+        errors = []
+
+        def run(target):
+            def wrapper():
+                try:
+                    target()
+                except Exception as e:
+                    errors.append(e)
+            return threading.Thread(target=wrapper)
+
+        def write_voltage():
+            voltage = client.state.handle("device1", "ac/voltage")
+            for i in range(1, self.n + 1):
+                voltage.set(float(i))
+
+        def write_scan():
+            for i in range(1, self.n + 1):
+                client.state.set_device_metrics("device1", {"ac/current": float(i), "dc/power": float(i)})
+
+        def write_node():
+            for i in range(1, self.n + 1):
+                client.state.set_node_metric("temperature", float(i))
+
+        def inject_commands():
+            for i in range(1, self.n//10 + 1):
+                payload = sparkplug_b_pb2.Payload()
+                sparkplug.addMetric(payload, "status", None, sparkplug.MetricDataType.String, f"cmd{i}")
+                msg = types.SimpleNamespace(topic="spBv1.0/test-group/DCMD/test-node/device2", payload=payload.SerializeToString())
+                Client.sp_on_message(client, None, msg)
+
+        # Switch threads as often as possible to provoke races
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            client._publish_birth()
+            threads = [run(f) for f in (write_voltage, write_scan, write_node, inject_commands)]
+            for thread in threads:
+                thread.start()
+            while any(thread.is_alive() for thread in threads):
+                client.publish_changes()
+            for thread in threads:
+                thread.join()
+            client.publish_changes()
+
+        self.assertEqual(errors, [])
+        messages = client.decoded()
+        seqs = [payload.seq for _, payload in messages]
+        self.assertEqual(seqs, [(seqs[0] + i) % 256 for i in range(len(seqs))])
+
+        last = {}
+        for topic, payload in messages:
+            values = {}
+            for metric in payload.metrics:
+                value = metric.string_value if metric.datatype == sparkplug.MetricDataType.String else metric.double_value or metric.float_value
+                values[metric.name] = value
+            if "DDATA" in topic and topic.endswith("device1") and ("ac/current" in values or "dc/power" in values):
+                # A scan batch is never published half applied
+                self.assertEqual(values.get("ac/current"), values.get("dc/power"))
+            last.update({(topic.split("/")[-1], name): value for name, value in values.items()})
+
+        self.assertEqual(last[("device1", "ac/voltage")], self.n)
+        self.assertEqual(last[("device1", "dc/power")], self.n)
+        self.assertEqual(last[("test-node", "temperature")], self.n)
+        self.assertEqual(last[("device2", "status")], f"cmd{self.n//10}")
+
+class TestColumnarConcurrency(TestConcurrency):
+    state_class = ColumnarState
+
+
+class TestMetricTree(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        self.state = self.state_class(make_birth_certificate())
+
+    def test_match(self):
+        tree = MetricTree(["ac/voltage", "ac/current", "dc/power", "battery/cells/1", "battery/cells/2", "status"])
+        self.assertEqual(sorted(tree.match("ac/*")), ["ac/current", "ac/voltage"])
+        self.assertEqual(sorted(tree.match("*/power")), ["dc/power"])
+        self.assertEqual(sorted(tree.match("battery/**")), ["battery/cells/1", "battery/cells/2"])
+        self.assertEqual(tree.match("battery/*"), [])
+        self.assertEqual(tree.match("status"), ["status"])
+        self.assertEqual(len(tree.match("**")), 6)
+        self.assertEqual(tree.match("unknown/*"), [])
+
+    def test_get_device_metrics(self):
+        self.state.set_device_metric("device1", "ac/voltage", 230.0)
+        self.assertEqual(self.state.get_device_metrics("device1", "ac/*"), {"ac/voltage": 230.0, "ac/current": 0.0})
+        self.assertEqual(self.state.get_node_metrics(), {"temperature": 0.0, "is_active": False})
+
+    def test_set_device_subtree(self):
+        self.state.set_device_subtree("device1", "ac", {"voltage": 230.0, "current": 4.0})
+        self.assertEqual(self.state.get_device_metrics("device1", "ac/*"), {"ac/voltage": 230.0, "ac/current": 4.0})
+        self.state.set_device_subtree("device1", "ac", 0.0)
+        self.assertEqual(self.state.get_device_metrics("device1", "ac/*"), {"ac/voltage": 0.0, "ac/current": 0.0})
+        with self.assertRaises(ValueError):
+            self.state.set_device_subtree("device1", "ac", {"frequency": 50.0})
+
+    def test_changed_metrics(self):
+        self.state.set_device_metric("device1", "ac/voltage", 230.0)
+        self.state.set_device_metric("device1", "dc/power", 1.0)
+        self.assertEqual(self.state.changed_metrics("device1", "ac/*"), ["ac/voltage"])
+        self.assertEqual(sorted(self.state.changed_metrics("device1")), ["ac/voltage", "dc/power"])
+        self.state.get_changes()
+        self.assertEqual(self.state.changed_metrics("device1"), [])
+
+class TestColumnarMetricTree(TestMetricTree):
+    state_class = ColumnarState
+
+
+class TestEventRingBuffer(unittest.TestCase):
+
+    def event(self, name, value):
+        return MetricChangeEvent(name, Metric(MetricSchema(name, sparkplug.MetricDataType.Int32), value))
+
+    def drained(self, buffer, **kwargs):
+        return [(event.metric_name, event.new_value) for event in buffer.drain([], **kwargs)]
+
+    def test_fifo_and_batches(self):
+        buffer = EventRingBuffer(4)
+        for i in range(3):
+            buffer.push(self.event("a", i))
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(self.drained(buffer, max_events=2), [("a", 0), ("a", 1)])
+        self.assertEqual(self.drained(buffer, consume=False), [("a", 2)])
+        self.assertEqual(self.drained(buffer), [("a", 2)])
+        self.assertEqual(self.drained(buffer), [])
+        # Wraps around the end of the slots
+        for i in range(4):
+            buffer.push(self.event("b", i))
+        self.assertEqual(self.drained(buffer), [("b", i) for i in range(4)])
+        self.assertEqual(buffer.overflow_count, 0)
+
+    def test_drop_oldest(self):
+        buffer = EventRingBuffer(3, EventRingBuffer.DROP_OLDEST)
+        for i in range(5):
+            self.assertTrue(buffer.push(self.event("a", i)))
+        self.assertEqual(self.drained(buffer), [("a", 2), ("a", 3), ("a", 4)])
+        self.assertEqual(buffer.overflow_count, 2)
+
+    def test_drop_newest(self):
+        buffer = EventRingBuffer(3, EventRingBuffer.DROP_NEWEST)
+        results = [buffer.push(self.event("a", i)) for i in range(5)]
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(self.drained(buffer), [("a", 0), ("a", 1), ("a", 2)])
+        self.assertEqual(buffer.overflow_count, 2)
+
+    def test_coalesce(self):
+        buffer = EventRingBuffer(3, EventRingBuffer.COALESCE)
+        for name, value in [("a", 0), ("b", 0), ("c", 0), ("b", 1), ("a", 1), ("d", 0)]:
+            buffer.push(self.event(name, value))
+        # b and a are replaced in place, d overwrites the oldest event
+        self.assertEqual(self.drained(buffer), [("b", 1), ("c", 0), ("d", 0)])
+        self.assertEqual(buffer.coalesced_count, 2)
+        self.assertEqual(buffer.overflow_count, 1)
+        # The slot of the first a was overwritten by c, so the second a is a new event and c is kept
+        buffer = EventRingBuffer(2, EventRingBuffer.COALESCE)
+        for name, value in [("a", 1), ("b", 1), ("c", 1), ("a", 2)]:
+            buffer.push(self.event(name, value))
+        self.assertEqual(self.drained(buffer), [("c", 1), ("a", 2)])
+        self.assertEqual(buffer.coalesced_count, 0)
+        self.assertEqual(buffer.overflow_count, 2)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            EventRingBuffer(0)
+        with self.assertRaises(ValueError):
+            EventRingBuffer(4, "drop_all")
+
+    def test_client_inbound_events(self):
+        client = RecordingClient()
+        client.set_birth_certificate(make_birth_certificate())
+        for i in range(3):
+            payload = sparkplug_b_pb2.Payload()
+            sparkplug.addMetric(payload, "count", None, sparkplug.MetricDataType.Int32, i)
+            client._handle_dcmd("device2", payload)
+        events = client.inbound_events()
+        self.assertEqual([(event.device_id, event.metric_changes[0].new_value) for event in events], [("device2", 0), ("device2", 1), ("device2", 2)])
+        self.assertIs(client.inbound_events(), events)
+        self.assertEqual(events, [])
+
+    def test_concurrent_producer(self):
+        buffer = EventRingBuffer(64, EventRingBuffer.DROP_NEWEST)
+        n = 20000
+        received = []
+
+        def produce():
+            i = 0
+            while i < n:
+                if buffer.push(self.event("a", i)):
+                    i += 1
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+        producer = threading.Thread(target=produce)
+        producer.start()
+        batch = []
+        while producer.is_alive() or len(buffer):
+            batch.clear()
+            received.extend(event.new_value for event in buffer.drain(batch))
+        producer.join()
+        self.assertEqual(received, list(range(n)))
+
+
+class TestPayloadTemplate(unittest.TestCase):
+
+    def changes(self, values):
+        datatypes = {"a": sparkplug.MetricDataType.Float, "b": sparkplug.MetricDataType.Int16, "c": sparkplug.MetricDataType.String}
+        return [MetricChangeEvent(name, Metric(MetricSchema(name, datatypes[name]), value)) for name, value in values]
+
+    def expected(self, changes, seq, timestamp):
+        payload = sparkplug_b_pb2.Payload()
+        payload.timestamp = timestamp
+        payload.seq = seq
+        for change in changes:
+            sparkplug.addMetric(payload, change.metric_name, None, change.datatype_sp, change.new_value, timestamp)
+        return payload
+
+    def test_matches_add_metric(self):
+        template = PayloadTemplate()
+        for seq, values in enumerate([
+            [("a", 1.5), ("b", -2), ("c", "x")],
+            [("a", 2.5), ("b", 3), ("c", "y")],
+            [("c", "z"), ("a", 0.5)],
+            [("b", -32768), ("a", 1.0), ("c", "")],
+            [],
+        ]):
+            changes = self.changes(values)
+            payload = template.fill(changes, seq, 1000 + seq)
+            self.assertEqual(payload, self.expected(changes, seq, 1000 + seq))
+
+    def test_client_reuses_payloads(self):
+        client = RecordingClient()
+        client.set_birth_certificate(make_birth_certificate())
+        with contextlib.redirect_stdout(io.StringIO()):
+            client._publish_birth()
+        for value in (1.0, 2.0):
+            client.state.set_device_metrics("device1", {"ac/voltage": value, "dc/power": value})
+            client.publish_changes()
+        client.state.set_device_metric("device1", "dc/power", 3.0)
+        client.publish_changes()
+        payloads = [payload for topic, payload in client.decoded() if "DDATA" in topic]
+        self.assertEqual([payload.seq for payload in payloads], [3, 4, 5])
+        self.assertEqual([{metric.name: metric.float_value or metric.double_value for metric in payload.metrics} for payload in payloads],
+                         [{"ac/voltage": 1.0, "dc/power": 1.0}, {"ac/voltage": 2.0, "dc/power": 2.0}, {"dc/power": 3.0}])
+        self.assertEqual(list(client._payload_templates), ["device1"])
+
+
+class TestAliases(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(make_birth_certificate(), self.state_class)
+
+    def raw(self):
+        messages = []
+        for topic, payload_bytes in self.client.published:
+            payload = sparkplug_b_pb2.Payload()
+            payload.ParseFromString(payload_bytes)
+            messages.append((topic.split("/")[2], payload))
+        return messages
+
+    def test_assignment(self):
+        aliases = self.client.state.aliases
+        self.assertEqual(sorted(aliases), list(range(7)))
+        self.assertEqual(aliases[0], (None, "temperature"))
+        self.assertEqual(aliases[self.client.state.devices["device2"].metrics["count"].alias], ("device2", "count"))
+
+    def test_certificate_aliases(self):
+        birth_certificate = make_birth_certificate()
+        birth_certificate.devices["device1"]["metrics"]["dc/power"]["alias"] = 1
+        birth_certificate.node_metrics["is_active"]["alias"] = 100
+        state = self.state_class(birth_certificate)
+        self.assertEqual(state.aliases[1], ("device1", "dc/power"))
+        self.assertEqual(state.aliases[100], (None, "is_active"))
+        self.assertEqual(sorted(state.aliases), [0, 1, 2, 3, 4, 5, 100])
+
+        birth_certificate.node_metrics["temperature"]["alias"] = 1
+        with self.assertRaises(ValueError):
+            self.state_class(birth_certificate)
+
+    def test_births_have_names_and_data_has_aliases(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._publish_birth()
+            self.client.state.set_device_metric("device1", "ac/voltage", 230.0)
+            self.client.publish_changes()
+            self.client._publish_birth()
+        births = {}
+        for message_type, payload in self.raw():
+            if message_type == "DDATA":
+                metric, = payload.metrics
+                self.assertEqual(metric.name, "")
+                self.assertEqual(metric.alias, self.client.state.devices["device1"].metrics["ac/voltage"].alias)
+                self.assertEqual(metric.float_value, 230.0)
+            elif message_type in ("NBIRTH", "DBIRTH"):
+                aliased = {metric.name: metric.alias for metric in payload.metrics if metric.HasField("alias")}
+                births.setdefault(message_type, []).append(aliased)
+        # Rebirths carry the same aliases
+        self.assertEqual(births["NBIRTH"][0], {"temperature": 0, "is_active": 1})
+        self.assertEqual(births["NBIRTH"][0], births["NBIRTH"][1])
+        self.assertEqual(births["DBIRTH"][:2], births["DBIRTH"][2:])
+
+    def test_names_without_aliases(self):
+        self.client.use_aliases = False
+        self.client.state.set_node_metric("temperature", 20.0)
+        self.client.publish_changes()
+        (_, payload), = self.raw()
+        self.assertEqual(payload.metrics[0].name, "temperature")
+        self.assertFalse(payload.metrics[0].HasField("alias"))
+
+    def test_inbound_alias(self):
+        payload = sparkplug_b_pb2.Payload()
+        alias = self.client.state.devices["device2"].metrics["count"].alias
+        sparkplug.addMetric(payload, None, alias, sparkplug.MetricDataType.Int32, 7)
+        # An alias of another device is ignored
+        sparkplug.addMetric(payload, None, 0, sparkplug.MetricDataType.Float, 1.0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._handle_dcmd("device2", payload)
+        self.assertEqual(self.client.state.get_device_metric_value("device2", "count"), 7)
+        event, = self.client.inbound_events()
+        self.assertEqual([change.metric_name for change in event.metric_changes], ["count"])
+
+class TestColumnarAliases(TestAliases):
+    state_class = ColumnarState
+
+
+class TestTypeCodec(unittest.TestCase):
+
+    def round_trip(self, datatype, value):
+        payload = sparkplug_b_pb2.Payload()
+        sparkplug.addMetric(payload, "m", None, datatype, value)
+        decoded = sparkplug_b_pb2.Payload()
+        decoded.ParseFromString(payload.SerializeToString())
+        self.assertEqual(decoded.metrics[0].datatype, datatype)
+        return Client.metric_value_from_type(decoded.metrics[0], datatype)
+
+    def test_round_trip(self):
+        T = sparkplug.MetricDataType
+        for datatype, value in [
+            (T.Int8, -128), (T.Int8, 127), (T.Int16, -2), (T.Int32, -2**31), (T.Int64, -2**63), (T.Int64, 2**40),
+            (T.UInt8, 255), (T.UInt16, 65535), (T.UInt32, 2**32 - 1), (T.UInt64, 2**64 - 1),
+            (T.Float, 1.5), (T.Double, 0.1), (T.Boolean, True), (T.String, "abc"),
+            (T.DateTime, 1700000000000), (T.Text, "long text"), (T.UUID, "123e4567-e89b-12d3-a456-426614174000"),
+            (T.Bytes, b"\x00\x01"),
+        ]:
+            with self.subTest(datatype=DATATYPE_STR_FROM_SPARKPLUG_TYPE[datatype], value=value):
+                self.assertEqual(self.round_trip(datatype, value), value)
+
+    def test_unsigned_values_sent_as_compared(self):
+        for use_wire_encoder in (False, True):
+            with self.subTest(use_wire_encoder=use_wire_encoder):
+                client = RecordingClient()
+                client.set_birth_certificate(BirthCertificate({"byte": {"datatype": "uint8", "value": 0}}, {}))
+                client.use_wire_encoder = use_wire_encoder
+                client.use_aliases = False
+                for value in (300, 44, 4.5):
+                    client.state.set_node_metric("byte", value)
+                    client.publish_changes()
+                self.assertEqual([payload.metrics[0].int_value for _, payload in client.decoded()], [44, 4])
+
+    def test_type_from_str(self):
+        for codec in sparkplug.CODECS.values():
+            self.assertEqual(sparkplug_type_from_str(codec.name.upper()), codec.datatype)
+        self.assertEqual(sparkplug_param_type_from_str("Text"), sparkplug.ParameterDataType.Text)
+        with self.assertRaises(ValueError):
+            sparkplug_type_from_str("invalid")
+        with self.assertRaises(ValueError):
+            sparkplug_param_type_from_str("bytes")
+
+    def test_defaults(self):
+        self.assertEqual(Metric.default_from_sparkplug_type(sparkplug.MetricDataType.Text), "")
+        self.assertEqual(Metric.default_from_sparkplug_type(sparkplug.MetricDataType.UInt64), 0)
+        with self.assertRaises(ValueError):
+            Metric.default_from_sparkplug_type(sparkplug.MetricDataType.Template)
+
+    def test_birth_properties(self):
+        schema = MetricSchema("m", sparkplug.MetricDataType.Float, (
+            Property("scale", "float", 0.5), Property("offset", "int16", -3), Property("unit", "string", "V"), Property("ro", "bool", True)))
+        payload = BirthTemplate((schema,)).fill([1.0], 0, 0)
+        values = payload.metrics[0].properties.values
+        self.assertEqual(list(payload.metrics[0].properties.keys), ["scale", "offset", "unit", "ro"])
+        self.assertEqual(values[0].float_value, 0.5)
+        self.assertEqual(values[1].int_value, 2**16 - 3)
+        self.assertEqual(values[2].string_value, "V")
+        self.assertTrue(values[3].boolean_value)
+
+
+class TestNativeTypes(unittest.TestCase):
+    state_class = State
+    instant = datetime.datetime(2023, 11, 14, 22, 13, 20, 123000, tzinfo=datetime.timezone.utc)
+    instant_ms = 1700000000123
+
+    def setUp(self):
+        node_metrics = {
+            "clock": {"datatype": "datetime", "value": 0},
+            "note": {"datatype": "text", "value": "hello"},
+            "id": {"datatype": "uuid"},
+        }
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(BirthCertificate(node_metrics, {}), self.state_class)
+        self.client.use_aliases = False
+        self.state = self.client.state
+
+    def published_metrics(self):
+        self.client.publish_changes()
+        return {metric.name: metric for metric in self.client.decoded()[-1][1].metrics}
+
+    def test_defaults(self):
+        self.assertEqual(self.state.get_node_metric_value("clock"), 0)
+        self.assertEqual(self.state.get_node_metric_value("note"), "hello")
+        self.assertEqual(self.state.get_node_metric_value("id"), "")
+
+    def test_datetime_conversion(self):
+        naive = self.instant.astimezone().replace(tzinfo=None)
+        for value in (self.instant, naive, self.instant_ms):
+            with self.subTest(value=value):
+                self.assertEqual(sparkplug.CODECS[sparkplug.MetricDataType.DateTime].encode(value), self.instant_ms)
+
+    def test_datetime_published_as_long(self):
+        self.state.set_node_metric("clock", self.instant)
+        metric = self.published_metrics()["clock"]
+        self.assertEqual(metric.datatype, sparkplug.MetricDataType.DateTime)
+        self.assertEqual(metric.long_value, self.instant_ms)
+
+    def test_same_instant_not_a_change(self):
+        self.state.set_node_metric("clock", self.instant)
+        self.state.get_changes()
+        self.state.set_node_metric("clock", self.instant_ms)
+        self.assertEqual(self.state.get_changes(), ([], []))
+
+    def test_uuid_and_text(self):
+        value = uuid.UUID("123e4567-e89b-12d3-a456-426614174000")
+        self.state.set_node_metric("id", value)
+        self.state.set_node_metric("note", "spänning")
+        metrics = self.published_metrics()
+        self.assertEqual(metrics["id"].string_value, str(value))
+        self.assertEqual(metrics["note"].datatype, sparkplug.MetricDataType.Text)
+        self.assertEqual(metrics["note"].string_value, "spänning")
+
+    def test_wire_encoder_agrees(self):
+        published = []
+        for use_wire_encoder in (False, True):
+            client = RecordingClient()
+            client.set_birth_certificate(self.client.birth_certificate, self.state_class)
+            client.use_wire_encoder = use_wire_encoder
+            client.state.set_node_metric("clock", self.instant)
+            client.state.set_node_metric("id", uuid.UUID(int=1))
+            with unittest.mock.patch("time.time", return_value=1700000000.0):
+                client.publish_changes()
+            published.append(client.published)
+        self.assertEqual(published[0], published[1])
+
+    def test_command_decoded_as_epoch_ms(self):
+        inbound = sparkplug_b_pb2.Payload()
+        sparkplug.addMetric(inbound, "clock", None, sparkplug.MetricDataType.DateTime, self.instant)
+        self.assertEqual(Client.metric_value_from_type(inbound.metrics[0], sparkplug.MetricDataType.DateTime), self.instant_ms)
+
+class TestColumnarNativeTypes(TestNativeTypes):
+    state_class = ColumnarState
+
+    def test_handle_converts(self):
+        self.state.handle(None, "clock").set(self.instant)
+        self.assertEqual(self.state.get_node_metric_value("clock"), self.instant_ms)
+
+
+class TestWireEncoder(unittest.TestCase):
+
+    def setUp(self):
+        T = sparkplug.MetricDataType
+        self.values = {
+            "int8": (T.Int8, -5), "int16": (T.Int16, -300), "int32": (T.Int32, -2**31), "int64": (T.Int64, -1),
+            "uint8": (T.UInt8, 200), "uint16": (T.UInt16, 65535), "uint32": (T.UInt32, 2**32 - 1), "uint64": (T.UInt64, 2**64 - 1),
+            "float": (T.Float, 0.1), "double": (T.Double, -1e300), "bool": (T.Boolean, True), "string": (T.String, "spänning"),
+            "datetime": (T.DateTime, 1700000000000), "text": (T.Text, ""), "uuid": (T.UUID, "123e4567-e89b-12d3-a456-426614174000"),
+            "bytes": (T.Bytes, b"\x00\xff"),
+        }
+        node_metrics = {f"node/{name}": {"datatype": name, "value": value} for name, (_, value) in self.values.items() if name != "bytes"}
+        devices = {"dev": {"metrics": {f"dev/{name}": {"datatype": name} for name in self.values}}}
+        self.state = State(BirthCertificate(node_metrics, devices))
+
+    def changes(self, metrics, prefix):
+        return [MetricChangeEvent(f"{prefix}/{name}", Metric(metrics[f"{prefix}/{name}"].schema, value)) for name, (_, value) in self.values.items() if f"{prefix}/{name}" in metrics]
+
+    def assert_golden(self, device_name, changes, seq, timestamp, use_aliases=True):
+        expected = PayloadTemplate(use_aliases).fill(changes, seq, timestamp).SerializeToString()
+        self.assertEqual(WireEncoder(self.state, use_aliases).encode(device_name, changes, seq, timestamp), expected)
+
+    def test_golden(self):
+        node_changes = self.changes(self.state.node_metrics, "node")
+        device_changes = self.changes(self.state.devices["dev"].metrics, "dev")
+        for use_aliases in (True, False):
+            for timestamp in (1700000000000, 0, 2**63):
+                for seq in (0, 255):
+                    with self.subTest(use_aliases=use_aliases, timestamp=timestamp, seq=seq):
+                        self.assert_golden(None, node_changes, seq, timestamp, use_aliases)
+                        self.assert_golden("dev", device_changes, seq, timestamp, use_aliases)
+                        self.assert_golden("dev", device_changes[::-1][:3], seq, timestamp, use_aliases)
+                        self.assert_golden("dev", [], seq, timestamp, use_aliases)
+
+    def test_matches_add_metric(self):
+        changes = self.changes(self.state.devices["dev"].metrics, "dev")
+        payload = sparkplug_b_pb2.Payload()
+        payload.timestamp = 1700000000000
+        for change in changes:
+            sparkplug.addMetric(payload, change.metric_name, None, change.datatype_sp, change.new_value, 1700000000000)
+        payload.seq = 7
+        self.assertEqual(WireEncoder(self.state, False).encode("dev", changes, 7, 1700000000000), payload.SerializeToString())
+
+    def test_client_selects_encoder(self):
+        published = []
+        for use_wire_encoder in (False, True):
+            client = RecordingClient()
+            client.set_birth_certificate(make_birth_certificate())
+            client.use_wire_encoder = use_wire_encoder
+            client.set_seq(0)
+            with unittest.mock.patch("time.time", return_value=1700000000.0):
+                client.state.set_node_metric("temperature", 20.5)
+                client.state.set_device_metrics("device2", {"status": "ALARM", "count": -3})
+                client.publish_changes()
+            published.append(client.published)
+        self.assertEqual(published[0], published[1])
+        self.assertEqual(len(published[1]), 2)
+
+
+class TestBirthTemplate(unittest.TestCase):
+
+    def setUp(self):
+        birth_certificate = make_birth_certificate()
+        birth_certificate.devices["device1"]["metrics"]["ac/voltage"]["properties"] = {
+            "EngUnit": {"datatype": "string", "value": "V"}, "Scale": {"datatype": "double", "value": 0.5}}
+        birth_certificate.devices["device1"]["metrics"]["ac/current"]["properties"] = {
+            "EngUnit": {"datatype": "string", "value": "A"}}
+        # A fixed clock, so the births can be compared with payloads built from scratch at the same time
+        self.client = RecordingClient(clock=ManualClock(1700000000000))
+        self.client.set_birth_certificate(birth_certificate)
+
+    def births(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._publish_birth()
+        return {topic.split("/", 2)[2]: payload for topic, payload in self.client.decoded()[-3:]}
+
+    def from_scratch(self, device_name, seq, timestamp):
+        # The births as built before templates were cached
+        payload = sparkplug_b_pb2.Payload()
+        payload.timestamp = timestamp
+        payload.seq = seq
+        if device_name is None:
+            for name, datatype_sp, value in NODE_CONTROL_METRICS:
+                sparkplug.addMetric(payload, name, None, datatype_sp, value, timestamp)
+        metrics = self.client.state.node_metrics if device_name is None else self.client.state.devices[device_name].metrics
+        for metric in metrics.values():
+            sp_metric = sparkplug.addMetric(payload, metric.name, metric.alias, metric.datatype_sp, metric.value, timestamp)
+            if metric.properties:
+                sp_metric.properties.keys.extend([prop.name for prop in metric.properties])
+                for prop in metric.properties:
+                    sp_prop = sp_metric.properties.values.add()
+                    sp_prop.type = prop.datatype_sp
+                    sparkplug.CODECS[prop.datatype_sp].set_value(sp_prop, prop.value)
+        return payload
+
+    def test_matches_from_scratch(self):
+        self.client.state.set_device_metric("device1", "ac/voltage", 230.0)
+        births = self.births()
+        self.assertEqual(births["NBIRTH/test-node"], self.from_scratch(None, 0, 1700000000000))
+        self.assertEqual(births["DBIRTH/test-node/device1"], self.from_scratch("device1", 1, 1700000000000))
+        self.assertEqual(births["DBIRTH/test-node/device2"], self.from_scratch("device2", 2, 1700000000000))
+        self.assertEqual(births["DBIRTH/test-node/device1"].metrics[0].float_value, 230.0)
+
+    def test_rebirth_reuses_template(self):
+        self.births()
+        templates = dict(self.client._birth_templates)
+        self.client.state.set_device_metric("device2", "count", 5)
+        births = self.births()
+        for device_name, template in templates.items():
+            self.assertIs(self.client._birth_templates[device_name], template)
+        self.assertEqual(births["DBIRTH/test-node/device2"].metrics[1].int_value, 5)
+
+    def test_schema_change_invalidates(self):
+        self.births()
+        template, unchanged = self.client._birth_templates["device2"], self.client._birth_templates["device1"]
+        metric = self.client.state.devices["device2"].metrics["count"]
+        metric.schema = MetricSchema("count", metric.datatype_sp, (Property("EngUnit", "string", "pcs"),), alias=metric.alias)
+        births = self.births()
+        self.assertIsNot(self.client._birth_templates["device2"], template)
+        self.assertIs(self.client._birth_templates["device1"], unchanged)
+        self.assertEqual(births["DBIRTH/test-node/device2"].metrics[1].properties.values[0].string_value, "pcs")
+
+    def test_shared_property_sets(self):
+        state = self.client.state
+        schemas = (state.devices["device1"].metrics["ac/current"].schema, state.devices["device1"].metrics["ac/current"].schema)
+        payload = BirthTemplate(schemas).fill([1.0, 2.0], 0, 0)
+        self.assertEqual(payload.metrics[0].properties, payload.metrics[1].properties)
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(make_birth_certificate())
+
+    def raw(self):
+        payloads = []
+        for topic, payload_bytes in self.client.published:
+            payload = sparkplug_b_pb2.Payload()
+            payload.ParseFromString(payload_bytes)
+            payloads.append((topic.split("/")[2], payload))
+        return payloads
+
+    def test_policy(self):
+        self.client.compression = CompressionPolicy(GZIP, threshold=0, message_types=["DBIRTH", "DDATA"])
+        self.client.state.set_device_metric("device2", "status", "y"*1000)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._publish_birth()
+        self.client.state.set_device_metric("device2", "status", "x"*1000)
+        self.client.state.set_node_metric("temperature", 1.0)
+        self.client.publish_changes()
+        compressed = [(message_type, payload.uuid == COMPRESSED_UUID) for message_type, payload in self.raw()]
+        # The small device1 DBIRTH does not get smaller when compressed, so it is sent as is
+        self.assertEqual(compressed, [("NBIRTH", False), ("DBIRTH", False), ("DBIRTH", True), ("NDATA", False), ("DDATA", True)])
+
+        ddata = self.raw()[-1][1]
+        self.assertEqual([(metric.name, metric.string_value) for metric in ddata.metrics], [(ALGORITHM_METRIC, GZIP)])
+        inner = decompress_payload(ddata)
+        self.assertEqual(ddata.seq, inner.seq)
+        self.assertEqual(ddata.timestamp, inner.timestamp)
+        self.assertEqual(inner.metrics[0].string_value, "x"*1000)
+
+        policy = self.client.compression
+        self.assertEqual(policy.compressed_messages, 2)
+        self.assertGreater(policy.ratio, 5)
+        self.assertGreater(policy.cpu_seconds, 0)
+
+    def test_threshold(self):
+        self.client.compression = CompressionPolicy(DEFLATE, threshold=500)
+        self.client.use_aliases = False
+        self.client.state.set_device_metric("device2", "status", "short")
+        self.client.publish_changes()
+        self.client.state.set_device_metric("device2", "status", "long"*200)
+        self.client.publish_changes()
+        self.assertEqual([payload.uuid for _, payload in self.raw()], ["", COMPRESSED_UUID])
+        self.assertEqual(self.client.decoded()[1][1].metrics[0].string_value, "long"*200)
+
+    def test_incompressible_sent_as_is(self):
+        policy = CompressionPolicy(threshold=0)
+        data = os.urandom(2000)
+        self.assertIs(policy.compress("DDATA", data), data)
+        self.assertEqual(policy.compressed_messages, 0)
+
+    def test_inbound_command(self):
+        inner = sparkplug_b_pb2.Payload()
+        sparkplug.addMetric(inner, "count", None, sparkplug.MetricDataType.Int32, 42)
+        for algorithm, body in [(GZIP, gzip.compress(inner.SerializeToString())),
+                                (DEFLATE, zlib.compress(inner.SerializeToString())),
+                                (None, zlib.compress(inner.SerializeToString())[2:-4])]:
+            outer = sparkplug_b_pb2.Payload()
+            outer.uuid = COMPRESSED_UUID
+            outer.body = body
+            if algorithm is not None:
+                sparkplug.addMetric(outer, ALGORITHM_METRIC, None, sparkplug.MetricDataType.String, algorithm)
+            msg = types.SimpleNamespace(topic="spBv1.0/test-group/DCMD/test-node/device2", payload=outer.SerializeToString())
+            self.client.state.set_device_metric("device2", "count", 0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                Client.sp_on_message(self.client, None, msg)
+            self.assertEqual(self.client.state.get_device_metric_value("device2", "count"), 42)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            CompressionPolicy("LZ4")
+        with self.assertRaises(ValueError):
+            CompressionPolicy(message_types=["NDEATH"])
+
+
+class TestPayloadSplitting(unittest.TestCase):
+    use_wire_encoder = False
+
+    def setUp(self):
+        metrics = {f"group/metric_{i}": {"datatype": "float"} for i in range(50)}
+        metrics["notes"] = {"datatype": "string"}
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(BirthCertificate({}, {"device": {"metrics": metrics}}))
+        self.client.use_wire_encoder = self.use_wire_encoder
+        self.client.use_aliases = False
+        self.client.set_seq(10)
+
+    def publish_all(self):
+        self.client.state.set_device_metrics("device", {f"group/metric_{i}": float(i + 1) for i in range(50)})
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.client.publish_changes()
+        return output.getvalue()
+
+    def test_split(self):
+        self.client.max_payload_size = 300
+        self.publish_all()
+        self.assertGreater(len(self.client.published), 1)
+        self.assertTrue(all(len(payload_bytes) <= 300 for _, payload_bytes in self.client.published))
+        payloads = [payload for _, payload in self.client.decoded()]
+        self.assertEqual([payload.seq for payload in payloads], list(range(11, 11 + len(payloads))))
+        self.assertEqual(sorted(metric.float_value for payload in payloads for metric in payload.metrics), [float(i + 1) for i in range(50)])
+        self.assertEqual(len({payload.timestamp for payload in payloads}), 1)
+
+    def test_no_split_under_limit(self):
+        self.client.max_payload_size = 10_000
+        self.publish_all()
+        self.assertEqual(len(self.client.published), 1)
+        self.assertEqual(len(self.client.decoded()[0][1].metrics), 50)
+
+    def test_encoders_agree(self):
+        self.client.max_payload_size = 300
+        with unittest.mock.patch("time.time", return_value=1700000000.0):
+            self.publish_all()
+        other = RecordingClient()
+        other.set_birth_certificate(self.client.birth_certificate)
+        other.use_wire_encoder = not self.use_wire_encoder
+        other.use_aliases = False
+        other.set_seq(10)
+        other.max_payload_size = 300
+        other.state.set_device_metrics("device", {f"group/metric_{i}": float(i + 1) for i in range(50)})
+        with unittest.mock.patch("time.time", return_value=1700000000.0):
+            other.publish_changes()
+        self.assertEqual(other.published, self.client.published)
+
+    def test_oversized_metric(self):
+        self.client.max_payload_size = 100
+        self.client.state.set_device_metrics("device", {"group/metric_0": 1.0, "notes": "x"*500, "group/metric_1": 2.0})
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.client.publish_changes()
+        self.assertIn("WARNING", output.getvalue())
+        names = [[metric.name for metric in payload.metrics] for _, payload in self.client.decoded()]
+        self.assertIn(["notes"], names)
+        self.assertEqual(sorted(name for group in names for name in group), ["group/metric_0", "group/metric_1", "notes"])
+        for (_, payload_bytes), group in zip(self.client.published, names):
+            if group != ["notes"]:
+                self.assertLessEqual(len(payload_bytes), 100)
+
+class TestWirePayloadSplitting(TestPayloadSplitting):
+    use_wire_encoder = True
+
+class TestMultiSample(unittest.TestCase):
+    use_wire_encoder = False
+
+    def setUp(self):
+        node_metrics = {"vibration": {"datatype": "float", "value": 0.0, "max_samples": 3}}
+        devices = {"device": {"metrics": {
+            "current": {"datatype": "double", "value": 0.0, "max_samples": 50},
+            "status": {"datatype": "string", "value": "OK"},
+        }}}
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(BirthCertificate(node_metrics, devices))
+        self.client.use_wire_encoder = self.use_wire_encoder
+        self.client.use_aliases = False
+        self.state = self.client.state
+
+    def write_samples(self, device_name, metric_name, values, start=1700000000.0):
+        for i, value in enumerate(values):
+            with unittest.mock.patch("time.time", return_value=start + i*0.02):
+                if device_name is None:
+                    self.state.set_node_metric(metric_name, value)
+                else:
+                    self.state.set_device_metric(device_name, metric_name, value)
+
+    def test_samples_have_their_own_timestamps(self):
+        self.write_samples("device", "current", [1.0, 2.0, 3.0])
+        _, device_changes = self.state.get_changes()
+        changes = device_changes[0].metric_changes
+        self.assertEqual([change.new_value for change in changes], [1.0, 2.0, 3.0])
+        self.assertEqual([change.timestamp for change in changes], [1700000000000, 1700000000020, 1700000000040])
+
+    def test_cap_drops_oldest_samples(self):
+        self.write_samples(None, "vibration", [1.0, 2.0, 3.0, 4.0, 5.0])
+        node_changes, _ = self.state.get_changes()
+        self.assertEqual([change.new_value for change in node_changes], [3.0, 4.0, 5.0])
+
+    def test_samples_cleared_after_publish(self):
+        self.write_samples("device", "current", [1.0, 2.0])
+        self.state.get_changes()
+        self.write_samples("device", "current", [3.0])
+        _, device_changes = self.state.get_changes()
+        self.assertEqual([change.new_value for change in device_changes[0].metric_changes], [3.0])
+
+    def test_excursion_published_when_value_returns(self):
+        self.write_samples("device", "current", [5.0, 0.0])
+        _, device_changes = self.state.get_changes()
+        self.assertEqual([change.new_value for change in device_changes[0].metric_changes], [5.0, 0.0])
+
+    def test_unchanged_samples_not_published(self):
+        self.write_samples("device", "current", [0.0, 0.0])
+        self.assertEqual(self.state.get_changes(), ([], []))
+        self.write_samples("device", "current", [1.0])
+        _, device_changes = self.state.get_changes()
+        self.assertEqual(len(device_changes[0].metric_changes), 1)
+
+    def test_handles_buffer_samples(self):
+        handle = self.state.handle("device", "current")
+        for value in (1.0, 2.0):
+            handle.set(value)
+        _, device_changes = self.state.get_changes()
+        self.assertEqual([change.new_value for change in device_changes[0].metric_changes], [1.0, 2.0])
+
+    def test_birth_discards_samples(self):
+        self.write_samples("device", "current", [1.0, 2.0])
+        self.state.birth_snapshot("device")
+        self.assertEqual(self.state.get_changes(), ([], []))
+
+    def test_published_in_one_message(self):
+        self.write_samples("device", "current", [1.0, 2.0, 3.0])
+        self.state.set_device_metric("device", "status", "Busy")
+        with unittest.mock.patch("time.time", return_value=1700000001.0):
+            self.client.publish_changes()
+        self.assertEqual(len(self.client.published), 1)
+        payload = self.client.decoded()[0][1]
+        self.assertEqual(payload.timestamp, 1700000001000)
+        metrics = sorted(payload.metrics, key=lambda metric: metric.name)
+        self.assertEqual([(metric.name, metric.timestamp) for metric in metrics], [
+            ("current", 1700000000000), ("current", 1700000000020), ("current", 1700000000040), ("status", 1700000001000)])
+        self.assertEqual([metric.double_value for metric in metrics[:3]], [1.0, 2.0, 3.0])
+
+    def test_columnar_state_rejects_samples(self):
+        with self.assertRaises(ValueError):
+            ColumnarState(BirthCertificate({"x": {"datatype": "float", "max_samples": 10}}, {}))
+
+    def test_invalid_cap(self):
+        with self.assertRaises(ValueError):
+            MetricSchema("x", sparkplug.MetricDataType.Float, max_samples=0)
+
+class TestWireMultiSample(TestMultiSample):
+    use_wire_encoder = True
+
+class TestDataSet(unittest.TestCase):
+    use_wire_encoder = False
+
+    def setUp(self):
+        devices = {"pv": {"metrics": {
+            "strings": {"datatype": "dataset", "rows": 4, "columns": {
+                "index": "int32", "current": "float", "voltage": "double", "ok": "bool", "label": "string", "energy": "uint64",
+            }},
+            "power": {"datatype": "float", "value": 0.0},
+        }}}
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(BirthCertificate({}, devices))
+        self.client.use_wire_encoder = self.use_wire_encoder
+        self.state = self.client.state
+        self.table = {
+            "index": [0, 1, -2, 300000],
+            "current": [1.5, 2.25, float('nan'), -4.0],
+            "voltage": [600.0, 601.5, 0.0, 1e300],
+            "ok": [True, False, True, True],
+            "label": ["a", "", "ünïcode", "x"*200],
+            "energy": [0, 127, 128, 2**64 - 1],
+        }
+
+    def test_default_value(self):
+        value = self.state.get_device_metric_value("pv", "strings")
+        self.assertIsInstance(value, DataSet)
+        self.assertEqual(value.rows, 4)
+        self.assertEqual(value.column("label").tolist(), [""]*4)
+
+    def test_row_level_change_detection(self):
+        self.state.set_device_metric("pv", "strings", self.table)
+        published = self.state.get_device_metric_value("pv", "strings")
+        self.state.get_changes()
+        self.state.set_device_metric("pv", "strings", {"current": [1.5, 2.25, float('nan'), -5.0]})
+        value = self.state.get_device_metric_value("pv", "strings")
+        self.assertEqual(value.changed_rows(published).tolist(), [3])
+        self.assertEqual(value.column("label").tolist(), self.table["label"])
+        _, device_changes = self.state.get_changes()
+        self.assertEqual([change.metric_name for change in device_changes[0].metric_changes], ["strings"])
+
+    def test_unchanged_rows_not_published(self):
+        self.state.set_device_metric("pv", "strings", self.table)
+        self.state.get_changes()
+        self.state.set_device_metric("pv", "strings", dict(self.table))
+        self.assertEqual(self.state.get_changes(), ([], []))
+
+    def test_values_are_immutable(self):
+        self.state.set_device_metric("pv", "strings", self.table)
+        with self.assertRaises(ValueError):
+            self.state.get_device_metric_value("pv", "strings").column("current")[0] = 0.0
+
+    def test_invalid_values(self):
+        with self.assertRaises(ValueError):
+            self.state.set_device_metric("pv", "strings", {"unknown": [1, 2, 3, 4]})
+        with self.assertRaises(ValueError):
+            self.state.set_device_metric("pv", "strings", {"index": [1, 2]})
+        with self.assertRaises(ValueError):
+            MetricSchema("x", sparkplug.MetricDataType.DataSet)
+
+    def test_encode_matches_protobuf(self):
+        self.state.set_device_metric("pv", "strings", self.table)
+        value = self.state.get_device_metric_value("pv", "strings")
+        message = sparkplug_b_pb2.Payload.DataSet()
+        message.num_of_columns = 6
+        message.columns.extend(value.layout.names)
+        message.types.extend(value.layout.types)
+        for i in range(value.rows):
+            row = message.rows.add()
+            for datatype, column in zip(value.layout.types, value.columns):
+                sparkplug.PARAMETER_CODECS[datatype].set_value(row.elements.add(), column[i].item() if hasattr(column[i], "item") else column[i])
+        self.assertEqual(value.encode(), message.SerializeToString())
+        self.assertEqual(self.client.state.devices["pv"].metrics["strings"].layout.empty().encode(), sparkplug_b_pb2.Payload.DataSet(
+            num_of_columns=6, columns=value.layout.names, types=value.layout.types).SerializeToString())
+
+    def test_published_as_one_metric(self):
+        self.client._publish_birth()
+        rows = 500
+        self.state.set_device_metric("pv", "strings", {
+            "index": np.arange(rows), "current": np.linspace(0, 10, rows), "voltage": np.full(rows, 600.0),
+            "ok": np.ones(rows, dtype=bool), "label": [f"string {i}" for i in range(rows)], "energy": np.arange(rows)*1000,
+        })
+        self.client.publish_changes()
+        topic, payload = self.client.decoded()[-1]
+        self.assertIn("DDATA", topic)
+        self.assertEqual(len(payload.metrics), 1)
+        dataset_value = payload.metrics[0].dataset_value
+        self.assertEqual(len(dataset_value.rows), rows)
+        self.assertEqual(dataset_value.rows[499].elements[4].string_value, "string 499")
+        self.assertEqual(dataset_value.rows[3].elements[5].long_value, 3000)
+
+    def test_birth_and_command(self):
+        self.state.set_device_metric("pv", "strings", self.table)
+        self.client._publish_birth()
+        dbirth = [payload for topic, payload in self.client.decoded() if "DBIRTH" in topic][0]
+        message = [metric for metric in dbirth.metrics if metric.name == "strings"][0].dataset_value
+        self.assertEqual(message.rows[2].elements[0].int_value, 2**32 - 2)
+
+        # A command with the same table written back is applied without a change
+        inbound = sparkplug_b_pb2.Payload()
+        metric = inbound.metrics.add()
+        metric.name = "strings"
+        metric.datatype = sparkplug.MetricDataType.DataSet
+        metric.dataset_value.CopyFrom(message)
+        metric.dataset_value.rows[0].elements[1].float_value = 9.5
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._handle_dcmd("pv", inbound)
+        value = self.state.get_device_metric_value("pv", "strings")
+        self.assertEqual(value.column("current")[0], 9.5)
+        self.assertEqual(value.column("index").tolist(), self.table["index"])
+
+    def test_columnar_state_rejects_datasets(self):
+        with self.assertRaises(ValueError):
+            ColumnarState(BirthCertificate({"t": {"datatype": "dataset", "columns": {"a": "int8"}}}, {}))
+
+class TestWireDataSet(TestDataSet):
+    use_wire_encoder = True
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        inverter = {"version": "1.0", "metrics": {
+            "power": {"datatype": "float", "value": 0, "properties": {"EngUnit": {"value": "W", "datatype": "string"}}},
+            "mode": {"datatype": "int8", "value": -1, "properties": {"ReadOnly": {"value": True, "datatype": "bool"}}},
+        }}
+        devices = {f"inverter{i}": {"template": "Inverter"} for i in range(3)}
+        devices["meter"] = {"metrics": {"energy": {"datatype": "double", "value": 0.0, "properties": {"EngUnit": {"value": "Wh", "datatype": "string"}}}}}
+        self.birth_certificate = BirthCertificate({"temperature": {"datatype": "float", "value": 0.0}}, devices, {"Inverter": inverter})
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(self.birth_certificate)
+
+    def births(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._publish_birth()
+        return {topic.split("/")[-1] if "DBIRTH" in topic else "NBIRTH": payload for topic, payload in self.client.decoded()}
+
+    def test_instances_share_metrics(self):
+        self.assertIs(self.birth_certificate.devices["inverter0"]["metrics"], self.birth_certificate.devices["inverter2"]["metrics"])
+        self.assertEqual(self.birth_certificate.device_templates, {f"inverter{i}": "Inverter" for i in range(3)})
+        self.assertEqual(set(self.client.state.devices["inverter1"].metrics), {"power", "mode"})
+
+    def test_unknown_template(self):
+        with self.assertRaises(ValueError):
+            BirthCertificate({}, {"device": {"template": "Missing"}})
+
+    def test_definition_in_nbirth(self):
+        nbirth = self.births()["NBIRTH"]
+        definitions = [metric for metric in nbirth.metrics if metric.datatype == sparkplug.MetricDataType.Template]
+        self.assertEqual([metric.name for metric in definitions], ["Inverter"])
+        definition = definitions[0].template_value
+        self.assertTrue(definition.is_definition)
+        self.assertEqual(definition.version, "1.0")
+        self.assertEqual([metric.name for metric in definition.metrics], ["power", "mode"])
+        self.assertEqual(definition.metrics[0].properties.keys, ["EngUnit"])
+        self.assertEqual(definition.metrics[1].int_value, 0xff)
+
+    def test_instance_in_dbirth(self):
+        self.client.state.set_device_metric("inverter1", "power", 1500.0)
+        births = self.births()
+        instance = births["inverter1"].metrics
+        self.assertEqual(len(instance), 1)
+        self.assertEqual(instance[0].name, "inverter1")
+        self.assertEqual(instance[0].template_value.template_ref, "Inverter")
+        self.assertFalse(instance[0].template_value.is_definition)
+        members = instance[0].template_value.metrics
+        self.assertEqual([(member.name, member.alias) for member in members], [("power", self.client.state.devices["inverter1"].metrics["power"].alias), ("mode", self.client.state.devices["inverter1"].metrics["mode"].alias)])
+        self.assertEqual(members[0].float_value, 1500.0)
+        self.assertEqual(len(members[0].properties.keys), 0)
+        # Devices that are not instances are unchanged
+        self.assertEqual([metric.name for metric in births["meter"].metrics], ["energy"])
+        self.assertEqual(births["meter"].metrics[0].properties.keys, ["EngUnit"])
+
+    def test_instance_dbirth_smaller(self):
+        metrics = {f"string_{i}/current": {"datatype": "float", "properties": {"EngUnit": {"value": "A", "datatype": "string"}}} for i in range(20)}
+        plain, instance = RecordingClient(), RecordingClient()
+        plain.set_birth_certificate(BirthCertificate({}, {"pv": {"metrics": metrics}}))
+        instance.set_birth_certificate(BirthCertificate({}, {"pv": {"template": "PV"}}, {"PV": {"metrics": metrics}}))
+        with contextlib.redirect_stdout(io.StringIO()):
+            plain._publish_birth()
+            instance._publish_birth()
+        size = lambda client: len([payload_bytes for topic, payload_bytes in client.published if "DBIRTH" in topic][0])
+        self.assertLess(size(instance), 0.7*size(plain))
+
+    def test_instance_data_names_members(self):
+        self.births()
+        for use_aliases in (True, False):
+            for use_wire_encoder in (False, True):
+                with self.subTest(use_aliases=use_aliases, use_wire_encoder=use_wire_encoder):
+                    self.client.use_aliases = use_aliases
+                    self.client.use_wire_encoder = use_wire_encoder
+                    self.client.state.set_devices({"inverter2": {"mode": 3 if use_wire_encoder else 4}, "meter": {"energy": 1.0 + use_aliases + 2*use_wire_encoder}})
+                    self.client.publish_changes()
+                    messages = {topic.split("/")[-1]: payload for topic, payload in self.client.decoded()[-2:]}
+                    metric = messages["inverter2"].metrics[0]
+                    # With aliases, the alias of the instance member in the DBIRTH, resolved by decoded()
+                    self.assertEqual((metric.name, metric.HasField("alias"), metric.int_value), ("inverter2/mode", use_aliases, 3 if use_wire_encoder else 4))
+                    self.assertEqual(messages["meter"].metrics[0].HasField("alias"), use_aliases)
+
+    def test_instance_command_by_member_name(self):
+        payload = sparkplug_b_pb2.Payload()
+        sparkplug.addMetric(payload, "inverter0/mode", None, sparkplug.MetricDataType.Int8, 2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._handle_dcmd("inverter0", payload)
+        self.assertEqual(self.client.state.get_device_metric_value("inverter0", "mode"), 2)
+
+    def test_solar_bess_certificate(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        birth_certificate = BirthCertificate.from_file(os.path.join(here, "solar_bess.json"))
+        self.assertEqual(birth_certificate.device_templates, {"bess": "Bess", "pv": "PV", "poc": "POC"})
+
+class TestFileTransfer(unittest.TestCase):
+
+    def setUp(self):
+        devices = {"logger": {"metrics": {
+            "bundle": {"datatype": "file"},
+            "config": {"datatype": "bytes"},
+            "status": {"datatype": "int32", "value": 0},
+        }}}
+        self.client = RecordingClient()
+        self.client.set_birth_certificate(BirthCertificate({"node_file": {"datatype": "file"}}, devices))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._publish_birth()
+        self.births = len(self.client.published)
+        self.data = os.urandom(200_000)
+        self.path = self.write_file(self.data)
+
+    def write_file(self, data):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def publish(self, n=1):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(n):
+                self.client.publish_changes()
+
+    def chunks(self):
+        return [(topic, payload) for topic, payload in self.client.decoded()[self.births:] if payload.metrics[0].datatype in (sparkplug.MetricDataType.File, sparkplug.MetricDataType.Bytes)]
+
+    def test_chunks_reassemble(self):
+        transfer = self.client.send_file("logger", "bundle", self.path, chunk_size=65536, content_type="application/gzip")
+        self.publish(10)
+        self.assertTrue(transfer.done)
+        self.assertEqual(transfer.progress, 1.0)
+        self.assertEqual(self.client.file_transfers, [])
+        chunks = self.chunks()
+        self.assertEqual(len(chunks), 4)
+        for i, (topic, payload) in enumerate(chunks):
+            self.assertTrue(topic.endswith("DDATA/test-node/logger"))
+            metric = payload.metrics[0]
+            self.assertEqual(metric.name, "bundle")
+            self.assertTrue(metric.metadata.is_multi_part)
+            self.assertEqual(metric.metadata.seq, i)
+            self.assertEqual(metric.metadata.size, len(self.data))
+            self.assertEqual(metric.metadata.file_name, os.path.basename(self.path))
+            self.assertEqual(metric.metadata.content_type, "application/gzip")
+            self.assertEqual(metric.properties.keys, ["offset"])
+            self.assertEqual(metric.properties.values[0].long_value, i*65536)
+        self.assertEqual(b"".join(payload.metrics[0].bytes_value for _, payload in chunks), self.data)
+        self.assertEqual([payload.seq for _, payload in chunks], list(range(self.births, self.births + 4)))
+
+    def test_encoding_matches_protobuf(self):
+        transfer = FileTransfer(self.path, "logger", "bundle", 7, sparkplug.MetricDataType.File, chunk_size=1000, offset=2000)
+        self.addCleanup(transfer.close)
+        payload = sparkplug_b_pb2.Payload(timestamp=1700000000000, seq=42)
+        metric = payload.metrics.add(alias=7, timestamp=1700000000000, datatype=sparkplug.MetricDataType.File, bytes_value=self.data[2000:3000])
+        metric.metadata.CopyFrom(sparkplug_b_pb2.Payload.MetaData(is_multi_part=True, size=len(self.data), seq=2, file_name=os.path.basename(self.path)))
+        metric.properties.keys.append("offset")
+        metric.properties.values.add(type=sparkplug.ParameterDataType.UInt64, long_value=2000)
+        self.assertEqual(transfer.encode_chunk(42, 1700000000000), payload.SerializeToString())
+
+    def test_changes_not_starved(self):
+        self.client.send_file("logger", "bundle", self.path, chunk_size=10_000)
+        for i in range(3):
+            self.client.state.set_device_metric("logger", "status", i + 1)
+            self.publish()
+        messages = self.client.decoded()[self.births:]
+        kinds = ["chunk" if payload.metrics[0].datatype == sparkplug.MetricDataType.File else "data" for _, payload in messages]
+        self.assertEqual(kinds, ["data", "chunk"]*3)
+
+    def test_round_robin(self):
+        other = self.write_file(b"x"*30)
+        self.client.transfer_chunks_per_publish = 4
+        self.client.send_file("logger", "bundle", self.path, chunk_size=100_000)
+        self.client.send_file("logger", "config", other, chunk_size=10)
+        self.publish()
+        names = [payload.metrics[0].name for _, payload in self.chunks()]
+        self.assertEqual(names, ["bundle", "config", "bundle", "config"])
+
+    def test_resume(self):
+        transfer = self.client.send_file(None, "node_file", self.path, chunk_size=50_000)
+        self.publish(2)
+        self.client.cancel_file_transfer(transfer)
+        self.assertEqual(transfer.offset, 100_000)
+        self.client.send_file(None, "node_file", self.path, chunk_size=50_000, offset=transfer.offset)
+        self.publish(5)
+        chunks = self.chunks()
+        self.assertTrue(all(topic.endswith("NDATA/test-node") for topic, _ in chunks))
+        self.assertEqual([payload.metrics[0].metadata.seq for _, payload in chunks], [0, 1, 2, 3])
+        self.assertEqual(b"".join(payload.metrics[0].bytes_value for _, payload in chunks), self.data)
+
+    def test_empty_file(self):
+        transfer = self.client.send_file("logger", "config", self.write_file(b""))
+        self.publish(3)
+        self.assertTrue(transfer.done)
+        chunks = self.chunks()
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0][1].metrics[0].bytes_value, b"")
+
+    def test_chunks_fit_max_payload_size(self):
+        self.client.max_payload_size = 10_000
+        with self.assertRaises(ValueError):
+            self.client.send_file("logger", "bundle", self.path, chunk_size=10_000)
+        self.assertEqual(self.client.file_transfers, [])
+        transfer = self.client.send_file("logger", "bundle", self.path, chunk_size=9_900)
+        self.publish(25)
+        self.assertTrue(transfer.done)
+        sizes = [len(payload) for payload in self.client.published[self.births:]]
+        self.assertEqual(len(sizes), 21)
+        self.assertLessEqual(max(sizes), 10_000)
+
+    def test_template_instance(self):
+        templates = {"Logger": {"metrics": {"log": {"datatype": "file"}}}}
+        for use_aliases in (True, False):
+            with self.subTest(use_aliases=use_aliases):
+                self.client = RecordingClient()
+                self.client.set_birth_certificate(BirthCertificate({}, {"dev": {"template": "Logger"}}, templates))
+                self.client.use_aliases = use_aliases
+                with contextlib.redirect_stdout(io.StringIO()):
+                    self.client._publish_birth()
+                self.births = len(self.client.published)
+                self.client.send_file("dev", "log", self.path, chunk_size=100_000)
+                self.publish(3)
+                chunks = self.chunks()
+                self.assertEqual(len(chunks), 2)
+                # By the alias of the instance member in the DBIRTH, or by its name inside the instance
+                self.assertEqual({(payload.metrics[0].name, payload.metrics[0].HasField("alias")) for _, payload in chunks}, {("dev/log", use_aliases)})
+                self.assertEqual(b"".join(payload.metrics[0].bytes_value for _, payload in chunks), self.data)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            self.client.send_file("logger", "status", self.path)
+        with self.assertRaises(ValueError):
+            self.client.send_file("logger", "missing", self.path)
+        with self.assertRaises(ValueError):
+            self.client.send_file("missing", "bundle", self.path)
+        with self.assertRaises(ValueError):
+            self.client.send_file("logger", "bundle", self.path, chunk_size=1000, offset=1500)
+        with self.assertRaises(ValueError):
+            self.client.send_file("logger", "bundle", self.path, chunk_size=1000, offset=300_000)
+
+
+class TestClock(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        node_metrics = {
+            "frequency": {"datatype": "float", "value": 50.0},
+            "voltage": {"datatype": "double", "value": 1000.0, "deadband_percent": 1, "max_silence": 60},
+        }
+        devices = {"device": {"metrics": {"current": {"datatype": "double", "value": 0.0}}}}
+        self.birth_certificate = BirthCertificate(node_metrics, devices)
+        self.clock = ManualClock(1700000000000, 100.0)
+        self.client = RecordingClient(clock=self.clock)
+        self.client.set_birth_certificate(self.birth_certificate, self.state_class)
+        self.client.use_aliases = False
+
+    def test_add_metric_uses_call_time(self):
+        payload = sparkplug.getDdataPayload()
+        with unittest.mock.patch("time.time", return_value=1800000000.0):
+            metric = sparkplug.addMetric(payload, "x", None, sparkplug.MetricDataType.Float, 1.0)
+        self.assertEqual(metric.timestamp, 1800000000000)
+        metric = sparkplug.addMetric(payload, "y", None, sparkplug.MetricDataType.Float, 1.0, 0)
+        self.assertEqual(metric.timestamp, 0)
+
+    def test_births_share_one_timestamp(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._publish_birth()
+        timestamps = {metric.timestamp for _, payload in self.client.decoded() for metric in payload.metrics}
+        timestamps |= {payload.timestamp for _, payload in self.client.decoded()}
+        self.assertEqual(timestamps, {1700000000000})
+
+    def test_changes_share_one_timestamp(self):
+        self.client.state.set_node_metric("frequency", 50.5)
+        self.clock.advance(0.5)
+        self.client.state.set_device_metric("device", "current", 2.0)
+        self.clock.advance(0.5)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client.publish_changes()
+        messages = self.client.decoded()
+        self.assertEqual(len(messages), 2)
+        timestamps = {metric.timestamp for _, payload in messages for metric in payload.metrics}
+        timestamps |= {payload.timestamp for _, payload in messages}
+        self.assertEqual(timestamps, {1700000001000})
+
+    def test_max_silence_follows_clock(self):
+        self.client.state.set_node_metric("voltage", 1001.0)
+        self.clock.advance(1)
+        self.assertEqual(self.client.state.get_changes(), ([], []))
+        self.clock.advance(60)
+        node_changes, _ = self.client.state.get_changes()
+        self.assertEqual([change.new_value for change in node_changes], [1001.0])
+
+class TestColumnarClock(TestClock):
+    state_class = ColumnarState
+
+    def test_timestamp_writes_rejected(self):
+        with self.assertRaises(ValueError):
+            ColumnarState(self.birth_certificate, self.clock, timestamp_writes=True)
+
+class TestTimestampWrites(unittest.TestCase):
+    use_wire_encoder = False
+
+    def setUp(self):
+        devices = {"device": {"metrics": {
+            "current": {"datatype": "double", "value": 0.0},
+            "status": {"datatype": "string", "value": "OK"},
+        }}}
+        self.clock = ManualClock(1700000000000, 100.0)
+        self.client = RecordingClient(clock=self.clock)
+        self.client.set_birth_certificate(BirthCertificate({}, devices), timestamp_writes=True)
+        self.client.use_wire_encoder = self.use_wire_encoder
+        self.client.use_aliases = False
+
+    def test_changes_carry_write_time(self):
+        self.client.state.set_device_metric("device", "current", 1.0)
+        self.clock.advance(0.25)
+        self.client.state.handle("device", "status").set("Busy")
+        self.clock.advance(0.75)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client.publish_changes()
+        payload = self.client.decoded()[0][1]
+        self.assertEqual(payload.timestamp, 1700000001000)
+        metrics = sorted(payload.metrics, key=lambda metric: metric.name)
+        self.assertEqual([(metric.name, metric.timestamp) for metric in metrics], [("current", 1700000000000), ("status", 1700000000250)])
+
+    def test_birth_uses_publish_time(self):
+        self.client.state.set_device_metric("device", "current", 1.0)
+        self.clock.advance(1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.client._publish_birth()
+        self.assertEqual({metric.timestamp for _, payload in self.client.decoded() for metric in payload.metrics}, {1700000001000})
+
+class TestWireTimestampWrites(TestTimestampWrites):
+    use_wire_encoder = True
+
+class TestScanClasses(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        node_metrics = {
+            "setpoint": {"datatype": "double", "value": 0.0, "scan_class": "fast"},
+            "power": {"datatype": "double", "value": 0.0},
+            "temperature": {"datatype": "float", "value": 20.0, "scan_class": "slow"},
+        }
+        devices = {"device": {"metrics": {
+            "readback": {"datatype": "double", "value": 0.0, "scan_class": "fast"},
+            "capacity": {"datatype": "int32", "value": 0, "scan_class": "slow"},
+        }}}
+        self.birth_certificate = BirthCertificate(node_metrics, devices, scan_classes={"fast": 0.1, "normal": 1, "slow": 60}, default_scan_class="normal")
+        self.clock = ManualClock(1700000000000, 100.0)
+        self.state = self.state_class(self.birth_certificate, self.clock)
+
+    def write_all(self, value):
+        self.state.set_node_metrics({"setpoint": value, "power": value, "temperature": value})
+        self.state.set_device_metrics("device", {"readback": value, "capacity": int(value)})
+
+    def changed(self):
+        node_changes, device_changes = self.state.get_changes()
+        names = {change.metric_name for change in node_changes}
+        names.update(change.metric_name for event in device_changes for change in event.metric_changes)
+        return names
+
+    def test_first_call_publishes_every_class(self):
+        self.write_all(1.0)
+        self.assertEqual(self.changed(), {"setpoint", "power", "temperature", "readback", "capacity"})
+
+    def test_only_due_classes_published(self):
+        self.changed()
+        self.write_all(2.0)
+        self.clock.advance(0.1)
+        self.assertEqual(self.changed(), {"setpoint", "readback"})
+        self.clock.advance(0.9)
+        self.assertEqual(self.changed(), {"power"})
+        self.clock.advance(59)
+        self.assertEqual(self.changed(), {"temperature", "capacity"})
+
+    def test_latest_value_published_when_due(self):
+        self.changed()
+        for value in (3.0, 4.0, 5.0):
+            self.state.set_node_metric("temperature", value)
+            self.clock.advance(0.5)
+            self.assertEqual(self.changed(), set())
+        self.clock.advance(60)
+        node_changes, _ = self.state.get_changes()
+        self.assertEqual([(change.metric_name, change.new_value) for change in node_changes], [("temperature", 5.0)])
+
+    def test_next_scan_delay(self):
+        self.assertEqual(self.state.next_scan_delay(), 0.0)
+        self.changed()
+        self.assertAlmostEqual(self.state.next_scan_delay(), 0.1)
+
+    def test_set_scan_period(self):
+        self.changed()
+        self.state.set_scan_period("slow", 5)
+        self.write_all(2.0)
+        self.clock.advance(5)
+        self.assertIn("temperature", self.changed())
+        with self.assertRaises(ValueError):
+            self.state.set_scan_period("unknown", 1)
+        with self.assertRaises(ValueError):
+            self.state.set_scan_period("slow", 0)
+
+    def test_without_scan_classes(self):
+        state = self.state_class(BirthCertificate({"x": {"datatype": "double", "value": 0.0}}, {}), self.clock)
+        self.assertIsNone(state.next_scan_delay())
+        state.set_node_metric("x", 1.0)
+        node_changes, _ = state.get_changes()
+        self.assertEqual(len(node_changes), 1)
+
+    def test_invalid_scan_classes(self):
+        with self.assertRaises(ValueError):
+            self.state_class(BirthCertificate({"x": {"datatype": "double", "scan_class": "missing"}}, {}, scan_classes={"fast": 0.1}))
+        with self.assertRaises(ValueError):
+            BirthCertificate({}, {}, scan_classes={"fast": 0})
+        with self.assertRaises(ValueError):
+            BirthCertificate({}, {}, scan_classes={"fast": 0.1}, default_scan_class="normal")
+
+    def test_scheduler_publishes_by_class(self):
+        client = RecordingClient(clock=self.clock)
+        client.set_birth_certificate(self.birth_certificate, self.state_class)
+        published = threading.Event()
+        client.publish_changes = published.set
+        client.connected = True
+        client.start_scan_scheduler()
+        self.addCleanup(client.stop_scan_scheduler)
+        self.assertTrue(published.wait(5))
+        client.stop_scan_scheduler()
+        self.assertIsNone(client._scan_thread)
+
+    def test_scheduler_idle_while_disconnected(self):
+        client = RecordingClient(clock=self.clock)
+        client.set_birth_certificate(self.birth_certificate, self.state_class)
+        client.scan_interval = 0.01
+        client.state.set_node_metric("setpoint", 1.0)
+        client.start_scan_scheduler()
+        self.addCleanup(client.stop_scan_scheduler)
+        time.sleep(0.1)
+        self.assertEqual(client.published, [])
+
+    def test_disconnect_stops_scheduler(self):
+        client = RecordingClient(clock=self.clock)
+        client.set_birth_certificate(self.birth_certificate, self.state_class)
+        client.connected = True
+        client.start_scan_scheduler()
+        self.addCleanup(client.stop_scan_scheduler)
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.disconnect()
+        self.assertIsNone(client._scan_thread)
+        self.assertEqual(client.published[-1][0].split("/")[2], "NDEATH")
+
+class TestColumnarScanClasses(TestScanClasses):
+    state_class = ColumnarState
+
+class TestMinInterval(unittest.TestCase):
+    state_class = State
+
+    def setUp(self):
+        node_metrics = {"setpoint": {"datatype": "double", "value": 0.0, "min_interval": 1}}
+        devices = {"device": {"min_interval": 0.5, "metrics": {
+            "readback": {"datatype": "double", "value": 0.0},
+            "alarm": {"datatype": "bool", "value": False, "min_interval": 0},
+        }}}
+        self.birth_certificate = BirthCertificate(node_metrics, devices)
+        self.clock = ManualClock(1700000000000, 100.0)
+        self.state = self.state_class(self.birth_certificate, self.clock)
+        self.clock.advance(10)
+
+    def changed(self, flush=False):
+        node_changes, device_changes = self.state.get_changes(flush)
+        values = {change.metric_name: change.new_value for change in node_changes}
+        values.update((change.metric_name, change.new_value) for event in device_changes for change in event.metric_changes)
+        return values
+
+    def test_burst_coalesced_to_latest_value(self):
+        self.state.set_node_metric("setpoint", 1.0)
+        self.assertEqual(self.changed(), {"setpoint": 1.0})
+        for value in (2.0, 3.0, 4.0):
+            self.clock.advance(0.1)
+            self.state.set_node_metric("setpoint", value)
+            self.assertEqual(self.changed(), {})
+        self.assertAlmostEqual(self.state.pending_delay(), 0.7)
+        self.clock.advance(0.75)
+        self.assertEqual(self.changed(), {"setpoint": 4.0})
+        self.assertIsNone(self.state.pending_delay())
+
+    def test_device_default(self):
+        self.state.set_device_metrics("device", {"readback": 1.0, "alarm": True})
+        self.assertEqual(self.changed(), {"readback": 1.0, "alarm": True})
+        self.clock.advance(0.1)
+        self.state.set_device_metrics("device", {"readback": 2.0, "alarm": False})
+        self.assertEqual(self.changed(), {"alarm": False})
+        self.clock.advance(0.4)
+        self.assertEqual(self.changed(), {"readback": 2.0})
+
+    def test_flush_ignores_interval(self):
+        self.state.set_node_metric("setpoint", 1.0)
+        self.changed()
+        self.state.set_node_metric("setpoint", 2.0)
+        self.assertEqual(self.changed(), {})
+        self.assertEqual(self.changed(flush=True), {"setpoint": 2.0})
+        self.assertEqual(self.changed(), {})
+
+    def test_change_reverted_within_interval_not_published(self):
+        self.state.set_node_metric("setpoint", 1.0)
+        self.changed()
+        self.state.set_node_metric("setpoint", 2.0)
+        self.changed()
+        self.state.set_node_metric("setpoint", 1.0)
+        self.clock.advance(1)
+        self.assertEqual(self.changed(), {})
+
+    def test_invalid_interval(self):
+        with self.assertRaises(ValueError):
+            MetricSchema("x", sparkplug.MetricDataType.Float, min_interval=-1)
+
+    def test_held_back_change_published_without_another_call(self):
+        client = RecordingClient(clock=self.clock)
+        client.set_birth_certificate(BirthCertificate({"setpoint": {"datatype": "double", "value": 0.0, "min_interval": 0.05}}, {}), self.state_class)
+        client.use_aliases = False
+        client.connected = True
+        self.clock.advance(1)
+        client.state.set_node_metric("setpoint", 1.0)
+        client.publish_changes()
+        client.state.set_node_metric("setpoint", 2.0)
+        client.publish_changes()
+        self.assertEqual(len(client.published), 1)
+        self.clock.advance(0.05)
+        deadline = time.monotonic() + 5
+        while len(client.published) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([payload.metrics[0].double_value for _, payload in client.decoded()], [1.0, 2.0])
+
+    def test_flush_waiter_idle_while_disconnected(self):
+        client = RecordingClient(clock=self.clock)
+        client.set_birth_certificate(BirthCertificate({"setpoint": {"datatype": "double", "value": 0.0, "min_interval": 0.05}}, {}), self.state_class)
+        self.addCleanup(client._stop_flush_waiter)
+        self.clock.advance(1)
+        client.state.set_node_metric("setpoint", 1.0)
+        client.publish_changes()
+        client.state.set_node_metric("setpoint", 2.0)
+        client.publish_changes()
+        published = len(client.published)
+        self.clock.advance(0.05)
+        deadline = time.monotonic() + 5
+        while client._flush_due is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(client._flush_due)
+        self.assertEqual(len(client.published), published)
+
+    def test_one_flush_waiter(self):
+        client = RecordingClient(clock=self.clock)
+        client.set_birth_certificate(BirthCertificate({"setpoint": {"datatype": "double", "value": 0.0, "min_interval": 60}}, {}), self.state_class)
+        self.clock.advance(60)
+        client.state.set_node_metric("setpoint", 1.0)
+        client.publish_changes()
+        client.state.set_node_metric("setpoint", 2.0)
+        client.publish_changes()
+        waiter = client._flush_thread
+        due = client._flush_due
+        self.assertIsNotNone(waiter)
+        for value in range(100):
+            client.state.set_node_metric("setpoint", float(value))
+            client.publish_changes()
+        self.assertIs(client._flush_thread, waiter)
+        self.assertEqual(client._flush_due, due)
+        client.start_scan_scheduler()
+        self.assertIsNone(client._flush_thread)
+        client.stop_scan_scheduler()
+        client._stop_flush_waiter()
+        self.assertFalse(waiter.is_alive())
+
+    def test_disconnect_flushes(self):
+        client = RecordingClient(clock=self.clock)
+        client.set_birth_certificate(self.birth_certificate, self.state_class)
+        client.state.set_node_metric("setpoint", 1.0)
+        client.connected = True
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.disconnect()
+        topics = [topic.split("/")[2] for topic, _ in client.published]
+        self.assertEqual(topics, ["NDATA", "NDEATH"])
+        # Stamped by the client's clock, like every other message
+        death = sparkplug_b_pb2.Payload.FromString(client.published[-1][1])
+        self.assertEqual(death.metrics[0].timestamp, self.clock.now_ms())
+
+class TestColumnarMinInterval(TestMinInterval):
+    state_class = ColumnarState
+
 if __name__ == '__main__':
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestBirthCertificate))
     suite.addTest(unittest.makeSuite(TestState))
+    suite.addTest(unittest.makeSuite(TestChangeTracking))
+    suite.addTest(unittest.makeSuite(TestColumnarState))
+    suite.addTest(unittest.makeSuite(TestDeadband))
+    suite.addTest(unittest.makeSuite(TestColumnarDeadband))
+    suite.addTest(unittest.makeSuite(TestWireChangeDetection))
+    suite.addTest(unittest.makeSuite(TestColumnarWireChangeDetection))
+    suite.addTest(unittest.makeSuite(TestMetricSchema))
+    suite.addTest(unittest.makeSuite(TestMetricHandle))
+    suite.addTest(unittest.makeSuite(TestColumnarMetricHandle))
+    suite.addTest(unittest.makeSuite(TestBulkUpdates))
+    suite.addTest(unittest.makeSuite(TestColumnarBulkUpdates))
+    suite.addTest(unittest.makeSuite(TestConcurrency))
+    suite.addTest(unittest.makeSuite(TestColumnarConcurrency))
+    suite.addTest(unittest.makeSuite(TestMetricTree))
+    suite.addTest(unittest.makeSuite(TestColumnarMetricTree))
+    suite.addTest(unittest.makeSuite(TestEventRingBuffer))
+    suite.addTest(unittest.makeSuite(TestPayloadTemplate))
+    suite.addTest(unittest.makeSuite(TestAliases))
+    suite.addTest(unittest.makeSuite(TestColumnarAliases))
+    suite.addTest(unittest.makeSuite(TestTypeCodec))
+    suite.addTest(unittest.makeSuite(TestNativeTypes))
+    suite.addTest(unittest.makeSuite(TestColumnarNativeTypes))
+    suite.addTest(unittest.makeSuite(TestWireEncoder))
+    suite.addTest(unittest.makeSuite(TestBirthTemplate))
+    suite.addTest(unittest.makeSuite(TestCompression))
+    suite.addTest(unittest.makeSuite(TestPayloadSplitting))
+    suite.addTest(unittest.makeSuite(TestWirePayloadSplitting))
+    suite.addTest(unittest.makeSuite(TestMultiSample))
+    suite.addTest(unittest.makeSuite(TestWireMultiSample))
+    suite.addTest(unittest.makeSuite(TestDataSet))
+    suite.addTest(unittest.makeSuite(TestWireDataSet))
+    suite.addTest(unittest.makeSuite(TestTemplates))
+    suite.addTest(unittest.makeSuite(TestFileTransfer))
+    suite.addTest(unittest.makeSuite(TestClock))
+    suite.addTest(unittest.makeSuite(TestColumnarClock))
+    suite.addTest(unittest.makeSuite(TestTimestampWrites))
+    suite.addTest(unittest.makeSuite(TestWireTimestampWrites))
+    suite.addTest(unittest.makeSuite(TestScanClasses))
+    suite.addTest(unittest.makeSuite(TestColumnarScanClasses))
+    suite.addTest(unittest.makeSuite(TestMinInterval))
+    suite.addTest(unittest.makeSuite(TestColumnarMinInterval))
     unittest.TextTestRunner().run(suite)
\ No newline at end of file
@@ -0,0 +1,279 @@
+import struct
+import sparkplug_b as sparkplug
+import sparkplug_b_pb2
+from google.protobuf.descriptor import FieldDescriptor
+from typing import List
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+_SMALL_VARINTS = [bytes((i,)) for i in range(0x80)]
+
+def encode_varint(value: int) -> bytes:
+    if 0 <= value < 0x80:
+        return _SMALL_VARINTS[value]
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _tag(descriptor, field_name: str) -> bytes:
+    # The field tags are taken from the generated descriptors, so sparkplug_b_pb2 stays the reference for the format
+    field = descriptor.fields_by_name[field_name]
+    if field.type in (FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES, FieldDescriptor.TYPE_MESSAGE):
+        wire_type = _LENGTH_DELIMITED
+    elif field.type == FieldDescriptor.TYPE_FLOAT:
+        wire_type = _FIXED32
+    elif field.type == FieldDescriptor.TYPE_DOUBLE:
+        wire_type = _FIXED64
+    else:
+        wire_type = _VARINT
+    return encode_varint(field.number << 3 | wire_type)
+
+_PAYLOAD = sparkplug_b_pb2.Payload.DESCRIPTOR
+_METRIC = sparkplug_b_pb2.Payload.Metric.DESCRIPTOR
+PAYLOAD_TIMESTAMP_TAG = _tag(_PAYLOAD, 'timestamp')
+PAYLOAD_METRIC_TAG = _tag(_PAYLOAD, 'metrics')
+PAYLOAD_SEQ_TAG = _tag(_PAYLOAD, 'seq')
+METRIC_NAME_TAG = _tag(_METRIC, 'name')
+METRIC_ALIAS_TAG = _tag(_METRIC, 'alias')
+METRIC_TIMESTAMP_TAG = _tag(_METRIC, 'timestamp')
+METRIC_DATATYPE_TAG = _tag(_METRIC, 'datatype')
+METRIC_METADATA_TAG = _tag(_METRIC, 'metadata')
+METRIC_PROPERTIES_TAG = _tag(_METRIC, 'properties')
+METRIC_BYTES_VALUE_TAG = _tag(_METRIC, 'bytes_value')
+
+_DATASET = sparkplug_b_pb2.Payload.DataSet.DESCRIPTOR
+_DATASET_VALUE = sparkplug_b_pb2.Payload.DataSet.DataSetValue.DESCRIPTOR
+DATASET_NUM_OF_COLUMNS_TAG = _tag(_DATASET, 'num_of_columns')
+DATASET_COLUMNS_TAG = _tag(_DATASET, 'columns')
+DATASET_TYPES_TAG = _tag(_DATASET, 'types')
+DATASET_ROWS_TAG = _tag(_DATASET, 'rows')
+ROW_ELEMENTS_TAG = _tag(sparkplug_b_pb2.Payload.DataSet.Row.DESCRIPTOR, 'elements')
+# Value tag of a DataSet element by column type. DataSet columns have the same types and fields as parameters
+DATASET_VALUE_TAGS = {datatype: _tag(_DATASET_VALUE, codec.field) for datatype, codec in sparkplug.PARAMETER_CODECS.items()}
+
+_FLOAT = struct.Struct('<f')
+_DOUBLE = struct.Struct('<d')
+_FIXED_VALUE_SIZES = {
+    FieldDescriptor.TYPE_FLOAT: _FLOAT.size,
+    FieldDescriptor.TYPE_DOUBLE: _DOUBLE.size,
+    FieldDescriptor.TYPE_BOOL: 1,
+}
+
+def _value_encoder(codec: sparkplug.TypeCodec):
+    """
+    Returns a function that encodes a value to the bytes of the codec's value field, without the tag.
+    """
+    field = _METRIC.fields_by_name[codec.field]
+    convert = codec.encode
+    if field.type == FieldDescriptor.TYPE_FLOAT:
+        def encode(value):
+            try:
+                return _FLOAT.pack(value)
+            except OverflowError:
+                # Out of range doubles become infinity when narrowed, as in the protobuf runtime
+                return _FLOAT.pack(float('inf') if value > 0 else float('-inf'))
+        return encode
+    if field.type == FieldDescriptor.TYPE_DOUBLE:
+        return _DOUBLE.pack
+    if field.type == FieldDescriptor.TYPE_BOOL:
+        return lambda value: b'\x01' if value else b'\x00'
+    if field.type == FieldDescriptor.TYPE_STRING:
+        def encode(value):
+            data = (value if convert is None else convert(value)).encode('utf-8')
+            return encode_varint(len(data)) + data
+        return encode
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return lambda value: encode_varint(len(value)) + bytes(value)
+    if codec.datatype == sparkplug.MetricDataType.DataSet:
+        # Tables encode their own DataSet message, see dataset.DataSet.encode()
+        def encode(value):
+            data = value.encode()
+            return encode_varint(len(data)) + data
+        return encode
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+        return None
+    if convert is None:
+        return encode_varint
+    return lambda value: encode_varint(convert(value))
+
+def payload_overhead(timestamp: int) -> int:
+    """
+    Returns the size of a payload besides its metrics: the timestamp and the largest possible seq.
+    """
+    return len(PAYLOAD_TIMESTAMP_TAG) + len(encode_varint(timestamp)) + len(PAYLOAD_SEQ_TAG) + len(encode_varint(255))
+
+def encode_payload(metrics: List[bytes], seq: int, timestamp: int) -> bytes:
+    """
+    Encodes a payload from metrics that are already encoded with their tag and length, e.g. by
+    `WireEncoder.encode_metrics()`.
+    """
+    return b''.join([PAYLOAD_TIMESTAMP_TAG, encode_varint(timestamp), *metrics, PAYLOAD_SEQ_TAG, encode_varint(seq)])
+
+def split_metrics(metrics: List[bytes], max_size: int, overhead: int) -> List[List[bytes]]:
+    """
+    Groups encoded metrics, in order, so that each group encodes to a payload of at most max_size bytes. A metric
+    that does not fit in a payload of its own gets a group to itself.
+
+    Args:
+    metrics (List[bytes]): The metrics, each encoded with its tag and length.
+    max_size (int): The maximum size of a payload in bytes.
+    overhead (int): The size of the payload besides its metrics, see `payload_overhead()`.
+    """
+    groups = []
+    group = []
+    size = overhead
+    for metric in metrics:
+        if group and size + len(metric) > max_size:
+            groups.append(group)
+            group = []
+            size = overhead
+        group.append(metric)
+        size += len(metric)
+    if group:
+        groups.append(group)
+    return groups
+
+# Length of the metric timestamp field for millisecond timestamps between 1971 and 2109, which all encode to a
+# six byte varint. Metric heads are pre-encoded for this length
+_METRIC_TIMESTAMP_SIZE = len(METRIC_TIMESTAMP_TAG) + len(encode_varint(1 << 35))
+
+class EncodedMetric():
+    """
+    The parts of a metric's NDATA/DDATA submessage that never change, encoded once: the name or alias, the
+    datatype and the value tag. Only the timestamp and value are encoded per message.
+
+    For fixed size values (float, double and bool) the metric's length prefix never changes either, so `head`
+    holds the payload's metrics tag, the length and the name or alias in one pre-encoded string.
+    """
+    __slots__ = ('key', 'tail', 'size', 'head', 'encode_value')
+
+    def __init__(self, key: bytes, tail: bytes, encode_value, value_size: int = None):
+        self.key = key
+        self.tail = tail
+        self.size = len(key) + len(tail)
+        self.encode_value = encode_value
+        self.head = None
+        if value_size is not None:
+            self.head = PAYLOAD_METRIC_TAG + encode_varint(self.size + _METRIC_TIMESTAMP_SIZE + value_size) + key
+
+    @staticmethod
+    def create(name: str, alias: int, datatype_sp: int, use_aliases: bool = True) -> 'EncodedMetric':
+        """
+        Returns the encoded metric, or None if its datatype cannot be encoded without protobuf, e.g. Template.
+        """
+        codec = sparkplug.CODECS.get(datatype_sp)
+        encode_value = _value_encoder(codec) if codec is not None else None
+        if encode_value is None:
+            return None
+        if use_aliases and alias is not None:
+            key = METRIC_ALIAS_TAG + encode_varint(alias)
+        else:
+            data = name.encode('utf-8')
+            key = METRIC_NAME_TAG + encode_varint(len(data)) + data
+        tail = METRIC_DATATYPE_TAG + encode_varint(datatype_sp) + _tag(_METRIC, codec.field)
+        return EncodedMetric(key, tail, encode_value, _FIXED_VALUE_SIZES.get(_METRIC.fields_by_name[codec.field].type))
+
+class WireEncoder():
+    """
+    Encodes NDATA/DDATA payloads straight to wire bytes from a list of changes, without building protobuf
+    messages. The output is byte for byte what `PayloadTemplate` and `SerializeToString()` produce.
+
+    The name or alias, datatype and field tags of every metric are encoded once when the encoder is created from
+    the state, so the encoder must be recreated if the metrics or their aliases change.
+    """
+
+    def __init__(self, state, use_aliases: bool = True):
+        """
+        Args:
+        state (State): The state whose node and device metrics will be encoded.
+        use_aliases (bool): Identify metrics that have an alias by the alias alone.
+        """
+        self.use_aliases = use_aliases
+        # Encoded metrics by device name, or None for the node, then by metric name
+        self.metrics = {None: self._encode_metrics(state.node_metrics)}
+        for device_name, device in state.devices.items():
+            self.metrics[device_name] = self._encode_metrics(device.metrics, state.metric_prefix(device_name))
+
+    def _encode_metrics(self, metrics: dict, prefix: str = "") -> dict:
+        # Metrics are named after the prefix of their device, see State.metric_prefix()
+        return {name: EncodedMetric.create(prefix + name, metric.alias, metric.datatype_sp, self.use_aliases) for name, metric in metrics.items()}
+
+    def encode(self, device_name: str, changes: List, seq: int, timestamp: int) -> bytes:
+        """
+        Encodes the changes of the node or a device as a payload. Pass device_name=None for node metrics.
+
+        Args:
+        device_name (str): The name of the device, or None for the node.
+        changes (List[MetricChangeEvent]): The changed metrics.
+        seq (int): The sequence number of the message.
+        timestamp (int): The timestamp of the payload, and of the metrics whose change has no timestamp of its own,
+        in milliseconds since the epoch.
+
+        Returns:
+        bytes: The encoded payload, or None if a metric cannot be encoded by this encoder and the protobuf path
+        must be used instead.
+        """
+        encoded_metrics = self.metrics[device_name]
+        timestamp_varint = encode_varint(timestamp)
+        metric_timestamp = METRIC_TIMESTAMP_TAG + timestamp_varint
+        use_heads = len(metric_timestamp) == _METRIC_TIMESTAMP_SIZE
+        parts = [PAYLOAD_TIMESTAMP_TAG, timestamp_varint]
+        append = parts.append
+        for change in changes:
+            encoded = encoded_metrics[change.metric_name]
+            if encoded is None:
+                return None
+            value = encoded.encode_value(change.new_value)
+            if change.timestamp is None:
+                sample_timestamp, sample_heads = metric_timestamp, use_heads
+            else:
+                sample_timestamp = METRIC_TIMESTAMP_TAG + encode_varint(change.timestamp)
+                sample_heads = len(sample_timestamp) == _METRIC_TIMESTAMP_SIZE
+            if sample_heads and encoded.head is not None:
+                append(encoded.head)
+            else:
+                append(PAYLOAD_METRIC_TAG)
+                append(encode_varint(encoded.size + len(sample_timestamp) + len(value)))
+                append(encoded.key)
+            append(sample_timestamp)
+            append(encoded.tail)
+            append(value)
+        append(PAYLOAD_SEQ_TAG)
+        append(encode_varint(seq))
+        return b''.join(parts)
+
+    def encode_metrics(self, device_name: str, changes: List, timestamp: int) -> List[bytes]:
+        """
+        Encodes each change as a metric of a payload, with its tag and length, so that the metrics can be split
+        across payloads with `split_metrics()` and `encode_payload()` without encoding them again.
+
+        Returns:
+        List[bytes]: The encoded metrics, or None if a metric cannot be encoded by this encoder.
+        """
+        encoded_metrics = self.metrics[device_name]
+        metric_timestamp = METRIC_TIMESTAMP_TAG + encode_varint(timestamp)
+        use_heads = len(metric_timestamp) == _METRIC_TIMESTAMP_SIZE
+        metrics = []
+        for change in changes:
+            encoded = encoded_metrics[change.metric_name]
+            if encoded is None:
+                return None
+            value = encoded.encode_value(change.new_value)
+            if change.timestamp is None:
+                sample_timestamp, sample_heads = metric_timestamp, use_heads
+            else:
+                sample_timestamp = METRIC_TIMESTAMP_TAG + encode_varint(change.timestamp)
+                sample_heads = len(sample_timestamp) == _METRIC_TIMESTAMP_SIZE
+            if sample_heads and encoded.head is not None:
+                head = encoded.head
+            else:
+                head = PAYLOAD_METRIC_TAG + encode_varint(encoded.size + len(sample_timestamp) + len(value)) + encoded.key
+            metrics.append(b''.join((head, sample_timestamp, encoded.tail, value)))
+        return metrics